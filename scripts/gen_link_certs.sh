@@ -0,0 +1,38 @@
+#!/usr/bin/env bash
+set -euo pipefail
+
+# Generate a private CA plus DCS (server) and PPP (client) certificates for the
+# PPP<->DCS link TLS (src/tls_link.py). For lab/testing; keep the CA key offline in production.
+#
+# Usage: scripts/gen_link_certs.sh [OUT_DIR] [DCS_NAME]
+# Then on the DCS:
+#   SOCKS_PROXY_TLS_CA=OUT/ca.pem SOCKS_PROXY_TLS_CERT=OUT/dcs.pem SOCKS_PROXY_TLS_KEY=OUT/dcs.key
+# and on the PPP:
+#   SOCKS_PROXY_TLS_CA=OUT/ca.pem SOCKS_PROXY_TLS_CERT=OUT/ppp.pem SOCKS_PROXY_TLS_KEY=OUT/ppp.key \
+#   SOCKS_PROXY_TLS_SERVER_NAME=DCS_NAME
+
+OUT=${1:-certs}
+DCS_NAME=${2:-dcs}
+DAYS=${DAYS:-825}
+
+mkdir -p "$OUT"
+cd "$OUT"
+
+openssl ecparam -name prime256v1 -genkey -noout -out ca.key
+openssl req -x509 -new -key ca.key -sha256 -days "$DAYS" -subj "/CN=socks-proxy link CA" -out ca.pem
+
+issue() {
+  local name=$1 cn=$2 usage=$3 san=$4
+  openssl ecparam -name prime256v1 -genkey -noout -out "$name.key"
+  openssl req -new -key "$name.key" -subj "/CN=$cn" -out "$name.csr"
+  printf "basicConstraints=CA:FALSE\nkeyUsage=digitalSignature\nextendedKeyUsage=%s\nsubjectAltName=%s\n" \
+    "$usage" "$san" > "$name.ext"
+  openssl x509 -req -in "$name.csr" -CA ca.pem -CAkey ca.key -CAcreateserial \
+    -days "$DAYS" -sha256 -extfile "$name.ext" -out "$name.pem"
+  rm -f "$name.csr" "$name.ext"
+}
+
+issue dcs "$DCS_NAME" serverAuth "DNS:$DCS_NAME,DNS:localhost,IP:127.0.0.1"
+issue ppp ppp clientAuth "DNS:ppp"
+chmod 600 ./*.key
+echo "certificates written to $OUT/"
@@ -0,0 +1,140 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List, Optional
+
+# Benchmarks spawn the real components as child processes so their CPU/RSS is measured apart from the load generator
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.dirname(BENCH_DIR)
+MUX_DIR = os.path.join(SRC_DIR, "MUX")
+HOST = "127.0.0.1"
+
+
+def free_port(kind: int = socket.SOCK_STREAM) -> int:
+    with socket.socket(socket.AF_INET, kind) as s:
+        s.bind((HOST, 0))
+        return s.getsockname()[1]
+
+
+def unix_path(name: str) -> str:
+    """A fresh Unix socket path in a private temp directory."""
+    return os.path.join(tempfile.mkdtemp(prefix="bench-"), name + ".sock")
+
+
+def spawn(code: str, quiet: bool = True) -> subprocess.Popen:
+    """Run a snippet of Python in a child with src/, src/MUX and src/BENCH importable."""
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([SRC_DIR, MUX_DIR, BENCH_DIR, env.get("PYTHONPATH", "")])
+    out = subprocess.DEVNULL if quiet else None
+    return subprocess.Popen([sys.executable, "-c", code], cwd=SRC_DIR, env=env, stdout=out, stderr=out)
+
+
+def wait_port(port: int, host: str = HOST, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError(f"{host}:{port} did not come up")
+
+
+def wait_unix(path: str, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.socket(socket.AF_UNIX) as s:
+                s.settimeout(0.2)
+                s.connect(path)
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError(f"{path} did not come up")
+
+
+def stop(procs: List[subprocess.Popen]):
+    for p in procs:
+        if p.poll() is None:
+            p.terminate()
+    for p in procs:
+        try:
+            p.wait(timeout=3)
+        except subprocess.TimeoutExpired:
+            p.kill()
+
+
+def proc_usage(pid: int) -> dict:
+    """CPU seconds (user+sys) and current RSS of a child, read from /proc."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        ticks = os.sysconf("SC_CLK_TCK")
+        cpu = (int(fields[11]) + int(fields[12])) / ticks
+        with open(f"/proc/{pid}/status") as f:
+            rss = next(int(line.split()[1]) for line in f if line.startswith("VmRSS:"))
+        return {"cpu_s": round(cpu, 3), "rss_kb": rss}
+    except (OSError, StopIteration, IndexError):
+        return {"cpu_s": 0.0, "rss_kb": 0}
+
+
+def tree_usage(pid: int) -> dict:
+    """proc_usage summed over a process and all of its descendants (e.g. worker processes)."""
+    total = {"cpu_s": 0.0, "rss_kb": 0}
+    pending = [pid]
+    while pending:
+        p = pending.pop()
+        u = proc_usage(p)
+        total["cpu_s"] += u["cpu_s"]
+        total["rss_kb"] += u["rss_kb"]
+        try:
+            for tid in os.listdir(f"/proc/{p}/task"):
+                with open(f"/proc/{p}/task/{tid}/children") as f:
+                    pending.extend(int(c) for c in f.read().split())
+        except OSError:
+            pass
+    total["cpu_s"] = round(total["cpu_s"], 3)
+    return total
+
+
+def percentile(sorted_vals: List[float], p: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    k = min(len(sorted_vals) - 1, max(0, int(round(p / 100.0 * (len(sorted_vals) - 1)))))
+    return sorted_vals[k]
+
+
+def latency_summary(samples_s: List[float]) -> dict:
+    """p50/p99/p999 in microseconds."""
+    vals = sorted(samples_s)
+    return {f"p{k}_us": round(percentile(vals, q) * 1e6, 1)
+            for k, q in (("50", 50), ("99", 99), ("999", 99.9))}
+
+
+def raise_nofile():
+    """Lift the soft fd limit to the hard limit; tens of thousands of sockets need it."""
+    import resource
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+def git_rev() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=SRC_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def write_results(path: str, results: dict):
+    results.setdefault("git_rev", git_rev())
+    results.setdefault("timestamp", time.time())
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"results written to {path}")
@@ -0,0 +1,385 @@
+import argparse
+import asyncio
+import json
+import socket
+import struct
+import sys
+import time
+from typing import Callable, Dict, List, Tuple
+
+from bench_common import (HOST, SRC_DIR, free_port, latency_summary, proc_usage,
+                          spawn, stop, unix_path, wait_port, wait_unix, write_results)
+
+sys.path.insert(0, SRC_DIR)
+import mux_wire
+
+# -----------------------
+# Components under test
+# -----------------------
+# Each scenario starts its processes on loopback and returns how to open one tunnel
+# to the echo target. Component stdout is discarded: the per-chunk logging would
+# otherwise dominate the measurement.
+
+ECHO_CODE = "import asyncio, test_server; asyncio.run(test_server.main('127.0.0.1', {port}))"
+RECEIVER_CODE = "import asyncio, socks5_reciever; asyncio.run(socks5_reciever.main('127.0.0.1', {port}))"
+DCS_CODE = "import asyncio, socks5_dcs; asyncio.run(socks5_dcs.main('127.0.0.1', {port}, {path!r}))"
+PPP_CODE = """
+import asyncio, socks5_ppp
+socks5_ppp._DEBUG = False
+socks5_ppp.agent_log = lambda *a, **k: None
+socks5_ppp.DCS_HOST, socks5_ppp.DCS_PORT = {dcs_host!r}, {dcs_port}
+socks5_ppp.INGRESS_BIND_HOST, socks5_ppp.INGRESS_PORT = '127.0.0.1', {port}
+socks5_ppp.INGRESS_UNIX_PATH = {path!r}
+asyncio.run(socks5_ppp.main())
+"""
+MUX_CODE = "import asyncio, ppp_mux_server; asyncio.run(ppp_mux_server.main('127.0.0.1', {port}, {path!r}))"
+MUX_DCS_CODE = "import asyncio, mux_dcs_server; asyncio.run(mux_dcs_server.main('127.0.0.1', {port}, {path!r}))"
+
+
+class Tunnel:
+    """One end-to-end byte stream to the echo target."""
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader, self.writer = reader, writer
+
+    async def send(self, data: bytes):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def recv(self, n: int) -> bytes:
+        return await self.reader.readexactly(n)
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except Exception:
+            pass
+
+
+async def socks5_tunnel(port: int, target_port: int) -> Tunnel:
+    r, w = await asyncio.open_connection(HOST, port)
+    w.write(b"\x05\x01\x00" + b"\x05\x01\x00\x01" + socket.inet_aton(HOST) + struct.pack("!H", target_port))
+    await w.drain()
+    await r.readexactly(2)
+    rep = await r.readexactly(10)
+    if rep[1] != 0:
+        raise ConnectionError(f"SOCKS5 CONNECT failed: {rep[1]}")
+    return Tunnel(r, w)
+
+
+async def connect(addr) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    """addr: a loopback port, or a Unix socket path."""
+    if isinstance(addr, str):
+        return await asyncio.open_unix_connection(addr)
+    return await asyncio.open_connection(HOST, addr)
+
+
+async def header_tunnel(addr, target_port: int) -> Tunnel:
+    # Direct ingress into socks5_ppp: routing header in the first packet
+    r, w = await connect(addr)
+    w.write(f"{HOST}:{target_port}\n".encode())
+    return Tunnel(r, w)
+
+
+class MuxStream:
+    def __init__(self, client: "MuxClient", stream_id: int):
+        self.client, self.stream_id = client, stream_id
+        self.buf = bytearray()
+        self.event = asyncio.Event()
+        self.opened = asyncio.get_running_loop().create_future()
+        self.eof = False
+        self.closed = False
+
+    async def send(self, data: bytes):
+        self.client.writer.write(mux_wire.encode_frame(2, self.stream_id, data))
+        await self.client.writer.drain()
+
+    async def recv(self, n: int) -> bytes:
+        while len(self.buf) < n:
+            if self.eof:
+                raise asyncio.IncompleteReadError(bytes(self.buf), n)
+            self.event.clear()
+            await self.event.wait()
+        data = bytes(self.buf[:n])
+        del self.buf[:n]
+        return data
+
+    async def close(self):
+        self.closed = True
+        self.client.writer.write(mux_wire.encode_frame(3, self.stream_id))
+        if self.eof:
+            self.client.release(self)
+
+
+class MuxClient:
+    """One mux connection carrying many streams; frames are dispatched by stream id."""
+    def __init__(self):
+        self.streams: Dict[int, MuxStream] = {}
+        self.ids = mux_wire.StreamIds()
+        self.ready = None  # connect task, shared by all workers
+
+    async def connect(self, addr):
+        self.reader, self.writer = await connect(addr)
+        await mux_wire.client_hello(self.reader, self.writer)
+        self.task = asyncio.create_task(self._dispatch())
+
+    async def _dispatch(self):
+        try:
+            while True:
+                msg_type, _, _, sid, body = await mux_wire.read_frame(self.reader)
+                st = self.streams.get(sid)
+                if st is None:
+                    continue
+                if msg_type == 2:
+                    st.buf += body
+                elif msg_type == 1:
+                    if not st.opened.done():
+                        st.opened.set_result(True)
+                    continue
+                elif msg_type == 3:
+                    st.eof = True
+                    if not st.opened.done():
+                        st.opened.set_exception(ConnectionError(body.decode(errors="replace")))
+                    if st.closed:
+                        self.release(st)
+                st.event.set()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            for st in self.streams.values():
+                st.eof = True
+                st.event.set()
+
+    async def open(self, target_port: int) -> MuxStream:
+        sid = self.ids.alloc()
+        st = self.streams[sid] = MuxStream(self, sid)
+        self.writer.write(mux_wire.encode_frame(1, sid, mux_wire.pack_addr(HOST, target_port)))
+        await st.opened
+        return st
+
+    def release(self, st: MuxStream):
+        # Both sides sent CLOSE: the id can be handed out again
+        if self.streams.get(st.stream_id) is st:
+            del self.streams[st.stream_id]
+            self.ids.release(st.stream_id)
+
+    async def close(self):
+        self.task.cancel()
+        self.writer.close()
+
+
+Scenario = Tuple[list, Callable]
+
+
+def setup(name: str, echo_port: int) -> Scenario:
+    """Start the processes for a scenario; returns (procs, async open_tunnel factory)."""
+    if name == "direct":
+        async def opener():
+            return Tunnel(*await asyncio.open_connection(HOST, echo_port))
+        return [], opener
+
+    if name == "socks5":
+        port = free_port()
+        procs = [spawn(RECEIVER_CODE.format(port=port))]
+        wait_port(port)
+        return procs, lambda: socks5_tunnel(port, echo_port)
+
+    # *_unix: the same components with the producer -> PPP and PPP -> DCS hops on Unix sockets
+    if name in ("chain", "chain_unix"):
+        dcs_port, ppp_port = free_port(), free_port()
+        dcs_path = ppp_path = ""
+        if name == "chain_unix":
+            dcs_path, ppp_path = unix_path("dcs"), unix_path("ppp")
+        procs = [spawn(DCS_CODE.format(port=dcs_port, path=dcs_path))]
+        wait_port(dcs_port)
+        procs.append(spawn(PPP_CODE.format(port=ppp_port, dcs_host=dcs_path or HOST, dcs_port=dcs_port, path=ppp_path)))
+        wait_port(ppp_port)
+        if ppp_path:
+            wait_unix(ppp_path)
+        return procs, lambda: header_tunnel(ppp_path or ppp_port, echo_port)
+
+    if name in ("mux", "mux_dcs", "mux_unix"):
+        port = free_port()
+        path = unix_path("mux") if name == "mux_unix" else ""
+        procs = [spawn((MUX_DCS_CODE if name == "mux_dcs" else MUX_CODE).format(port=port, path=path))]
+        wait_port(port)
+        if path:
+            wait_unix(path)
+        client = MuxClient()
+
+        async def opener():
+            if client.ready is None:
+                client.ready = asyncio.ensure_future(client.connect(path or port))
+            await client.ready
+            return await client.open(echo_port)
+        opener.client = client
+        return procs, opener
+
+    raise ValueError(f"unknown scenario {name}")
+
+
+SCENARIOS = ["direct", "socks5", "chain", "chain_unix", "mux", "mux_dcs", "mux_unix"]
+
+# -----------------------
+# Load patterns
+# -----------------------
+
+
+async def pattern_rr(opener, size: int, deadline: float, lat: List[float], counters: dict):
+    """Request/response: one tunnel, send `size` bytes, wait for the echo, repeat."""
+    t = await opener()
+    payload = b"r" * size
+    try:
+        while time.perf_counter() < deadline:
+            t0 = time.perf_counter()
+            await t.send(payload)
+            await t.recv(size)
+            lat.append(time.perf_counter() - t0)
+            counters["bytes"] += size
+            counters["ops"] += 1
+    finally:
+        await t.close()
+
+
+async def pattern_connect(opener, size: int, deadline: float, lat: List[float], counters: dict):
+    """Connection churn: open a tunnel, one small exchange, close."""
+    payload = b"c" * size
+    while time.perf_counter() < deadline:
+        t0 = time.perf_counter()
+        t = await opener()
+        await t.send(payload)
+        await t.recv(size)
+        lat.append(time.perf_counter() - t0)
+        await t.close()
+        counters["bytes"] += size
+        counters["ops"] += 1
+
+
+async def pattern_bulk(opener, size: int, deadline: float, lat: List[float], counters: dict):
+    """Bulk: stream `size`-byte chunks as fast as the echo comes back (bounded in flight)."""
+    t = await opener()
+    chunk = b"b" * size
+    window = asyncio.Semaphore(8)
+    sent_at: List[float] = []
+    done = asyncio.Event()
+
+    async def sender():
+        while time.perf_counter() < deadline:
+            await window.acquire()
+            sent_at.append(time.perf_counter())
+            await t.send(chunk)
+        done.set()
+
+    send_task = asyncio.create_task(sender())
+    try:
+        while not (done.is_set() and not sent_at):
+            if not sent_at:
+                await asyncio.sleep(0.001)
+                continue
+            await t.recv(size)
+            lat.append(time.perf_counter() - sent_at.pop(0))
+            window.release()
+            counters["bytes"] += size
+            counters["ops"] += 1
+    finally:
+        send_task.cancel()
+        await t.close()
+
+
+PATTERNS = {"rr": pattern_rr, "connect": pattern_connect, "bulk": pattern_bulk}
+
+
+async def drive(opener, pattern: str, concurrency: int, size: int, duration: float) -> dict:
+    lat: List[float] = []
+    counters = {"bytes": 0, "ops": 0, "errors": 0}
+    deadline = time.perf_counter() + duration
+    fn = PATTERNS[pattern]
+
+    async def worker():
+        try:
+            await fn(opener, size, deadline, lat, counters)
+        except Exception:
+            counters["errors"] += 1
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - t0
+    result = {
+        "ops": counters["ops"],
+        "errors": counters["errors"],
+        "ops_per_s": round(counters["ops"] / elapsed, 1),
+        "mb_per_s": round(counters["bytes"] / elapsed / 1e6, 3),
+        **latency_summary(lat),
+    }
+    if pattern == "connect":
+        result["conns_per_s"] = result["ops_per_s"]
+    client = getattr(opener, "client", None)
+    if client is not None and client.ready is not None:
+        await client.close()
+    return result
+
+
+def run_case(scenario: str, pattern: str, concurrency: int, size: int, duration: float) -> dict:
+    echo_port = free_port()
+    procs = [spawn(ECHO_CODE.format(port=echo_port))]
+    try:
+        wait_port(echo_port)
+        more, opener = setup(scenario, echo_port)
+        procs += more
+        before = [proc_usage(p.pid) for p in procs]
+        result = asyncio.run(drive(opener, pattern, concurrency, size, duration))
+        after = [proc_usage(p.pid) for p in procs]
+        # The echo target is shared by every scenario; report only the proxy components
+        result["proxy_cpu_s"] = round(sum(a["cpu_s"] - b["cpu_s"] for a, b in zip(after[1:], before[1:])), 3)
+        result["proxy_rss_kb"] = sum(a["rss_kb"] for a in after[1:])
+        return result
+    finally:
+        stop(procs)
+
+
+def compare(old_path: str, new_path: str):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"{'case':40} {'metric':12} {'old':>12} {'new':>12} {'delta':>8}")
+    for case, n in new["cases"].items():
+        o = old["cases"].get(case)
+        if not o:
+            continue
+        for metric in ("ops_per_s", "mb_per_s", "p50_us", "p99_us", "p999_us", "proxy_cpu_s", "proxy_rss_kb"):
+            if metric in o and metric in n and o[metric]:
+                delta = 100.0 * (n[metric] - o[metric]) / o[metric]
+                print(f"{case:40} {metric:12} {o[metric]:>12} {n[metric]:>12} {delta:>+7.1f}%")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Loopback benchmark for every proxy path")
+    ap.add_argument("--scenario", action="append", choices=SCENARIOS, help="repeatable; default: all")
+    ap.add_argument("--pattern", action="append", choices=list(PATTERNS), help="repeatable; default: all")
+    ap.add_argument("--concurrency", type=int, action="append", help="repeatable; default: 1 and 32")
+    ap.add_argument("--size", type=int, action="append", help="payload bytes; repeatable; default: 64 and 16384")
+    ap.add_argument("--duration", type=float, default=5.0)
+    ap.add_argument("--json", help="write machine-readable results here")
+    ap.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="diff two result files and exit")
+    args = ap.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    cases = {}
+    for scenario in args.scenario or SCENARIOS:
+        for pattern in args.pattern or list(PATTERNS):
+            for conc in args.concurrency or [1, 32]:
+                for size in args.size or [64, 16384]:
+                    key = f"{scenario}/{pattern}/c{conc}/s{size}"
+                    res = run_case(scenario, pattern, conc, size, args.duration)
+                    cases[key] = res
+                    print(f"{key:40} {res['ops_per_s']:>10} ops/s {res['mb_per_s']:>9} MB/s "
+                          f"p50={res['p50_us']}us p99={res['p99_us']}us p999={res['p999_us']}us "
+                          f"cpu={res['proxy_cpu_s']}s rss={res['proxy_rss_kb']}kB err={res['errors']}")
+    if args.json:
+        write_results(args.json, {"benchmark": "proxy_paths", "duration_s": args.duration, "cases": cases})
+
+
+if __name__ == "__main__":
+    main()
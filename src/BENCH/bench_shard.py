@@ -0,0 +1,124 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import time
+from typing import List
+
+from bench_common import (free_port, latency_summary, spawn, stop, tree_usage,
+                          wait_port, write_results)
+from bench_proxy import MuxClient
+
+# -----------------------
+# Sharded mux server scaling
+# -----------------------
+# Many streams on a few PPP mux connections, request/response echo on every stream.
+# The same load runs against the single-loop ppp_mux_server (workers=0) and then
+# mux_shard with 1, 2, 4... workers. The load generator and the echo targets run
+# in several processes of their own so that they are not the bottleneck.
+
+MUX_CODE = "import asyncio, ppp_mux_server; asyncio.run(ppp_mux_server.main('127.0.0.1', {port}))"
+SHARD_CODE = "import asyncio, mux_shard; asyncio.run(mux_shard.main('127.0.0.1', {port}, {workers}))"
+ECHO_CODE = "import soak; soak.serve('echo', {port})"
+
+
+async def _client(port: int, echo_ports: List[int], streams: int, size: int, duration: float) -> dict:
+    client = MuxClient()
+    await client.connect(port)
+    opened = [await client.open(random.choice(echo_ports)) for _ in range(streams)]
+    lat: List[float] = []
+    ops = 0
+    payload = b"s" * size
+    deadline = time.perf_counter() + duration
+
+    async def rr(st):
+        nonlocal ops
+        while time.perf_counter() < deadline:
+            t0 = time.perf_counter()
+            await st.send(payload)
+            await st.recv(size)
+            lat.append(time.perf_counter() - t0)
+            ops += 1
+
+    await asyncio.gather(*(rr(st) for st in opened))
+    for st in opened:
+        await st.close()
+    await client.close()
+    return {"ops": ops, "lat": lat[::max(1, len(lat) // 20000)]}
+
+
+def client_proc(args) -> dict:
+    return asyncio.run(_client(*args))
+
+
+def run_case(workers: int, streams: int, clients: int, echoes: List[int], size: int, duration: float) -> dict:
+    port = free_port()
+    code = MUX_CODE.format(port=port) if workers == 0 else SHARD_CODE.format(port=port, workers=workers)
+    proc = spawn(code)
+    try:
+        wait_port(port)
+        time.sleep(0.5 + 0.3 * workers)  # workers come up after the listener
+        per_client = max(1, streams // clients)
+        before = tree_usage(proc.pid)
+        t0 = time.perf_counter()
+        with multiprocessing.get_context("spawn").Pool(clients) as pool:
+            results = pool.map(client_proc, [(port, echoes, per_client, size, duration)] * clients)
+        elapsed = time.perf_counter() - t0
+        after = tree_usage(proc.pid)
+    finally:
+        stop([proc])
+    ops = sum(r["ops"] for r in results)
+    cpu = after["cpu_s"] - before["cpu_s"]
+    return {
+        "workers": workers,
+        "streams": per_client * clients,
+        "ops_per_s": round(ops / duration, 1),
+        "proxy_cpu_s": round(cpu, 3),
+        "proxy_cores": round(cpu / elapsed, 2),
+        "ops_per_core_s": round(ops / cpu, 1) if cpu else 0.0,
+        "proxy_rss_kb": after["rss_kb"],
+        **latency_summary([x for r in results for x in r["lat"]]),
+    }
+
+
+def main():
+    cores = os.cpu_count() or 1
+    ap = argparse.ArgumentParser(description="Streams-per-core scaling of the sharded mux server")
+    ap.add_argument("--workers", type=int, action="append",
+                    help="repeatable; 0 = unsharded ppp_mux_server; default: 0, 1, 2, 4 ... up to the core count")
+    ap.add_argument("--streams", type=int, action="append", help="repeatable; default: 64 and 256")
+    ap.add_argument("--clients", type=int, default=max(1, cores // 2), help="load generator processes (one mux connection each)")
+    ap.add_argument("--echo-procs", type=int, default=max(1, cores // 4))
+    ap.add_argument("--size", type=int, default=512)
+    ap.add_argument("--duration", type=float, default=5.0)
+    ap.add_argument("--json", help="write machine-readable results here")
+    args = ap.parse_args()
+
+    workers = args.workers or [0] + [w for w in (1, 2, 4, 8, 16, 32) if w <= cores]
+    echo_ports = [free_port() for _ in range(args.echo_procs)]
+    echoes = [spawn(ECHO_CODE.format(port=p)) for p in echo_ports]
+    cases = {}
+    try:
+        for p in echo_ports:
+            wait_port(p)
+        for streams in args.streams or [64, 256]:
+            base = None
+            for w in workers:
+                res = run_case(w, streams, args.clients, echo_ports, args.size, args.duration)
+                if w == 1:
+                    base = res["ops_per_s"]
+                res["speedup_vs_1"] = round(res["ops_per_s"] / base, 2) if base and w >= 1 else None
+                cases[f"w{w}/s{streams}"] = res
+                print(f"workers={w:<3} streams={res['streams']:<5} {res['ops_per_s']:>10} ops/s "
+                      f"speedup={res['speedup_vs_1']} cores={res['proxy_cores']} "
+                      f"ops/core-s={res['ops_per_core_s']} p50={res['p50_us']}us p99={res['p99_us']}us")
+    finally:
+        stop(echoes)
+    if args.json:
+        write_results(args.json, {"benchmark": "mux_shard_scaling", "cores": cores, "size": args.size,
+                                  "duration_s": args.duration, "cases": cases})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import argparse
+import socket
+import struct
+import time
+
+from bench_common import HOST, free_port, latency_summary, proc_usage, spawn, stop, wait_port, write_results
+
+# UDP echo target, run in its own process
+ECHO_CODE = """
+import socket
+s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+s.bind(("127.0.0.1", {port}))
+while True:
+    data, addr = s.recvfrom(65535)
+    s.sendto(data, addr)
+"""
+
+DCS_CODE = """
+import asyncio, socks5_dcs
+asyncio.run(socks5_dcs.main("127.0.0.1", {port}))
+"""
+
+
+def udp_associate(dcs_port: int):
+    """Open the TCP control connection and return (control_sock, relay_addr)."""
+    ctl = socket.create_connection((HOST, dcs_port))
+    ctl.sendall(b"\x05\x01\x00")
+    assert ctl.recv(2) == b"\x05\x00"
+    ctl.sendall(b"\x05\x03\x00\x01" + socket.inet_aton("0.0.0.0") + struct.pack("!H", 0))
+    rep = ctl.recv(10)
+    if len(rep) < 10 or rep[1] != 0:
+        raise RuntimeError(f"UDP ASSOCIATE refused: {rep!r}")
+    return ctl, (socket.inet_ntoa(rep[4:8]), struct.unpack("!H", rep[8:10])[0])
+
+
+def ping_pong(sock: socket.socket, dest, wrap: bytes, payload: bytes, count: int) -> list:
+    samples = []
+    msg = wrap + payload
+    for _ in range(count):
+        t0 = time.perf_counter()
+        sock.sendto(msg, dest)
+        try:
+            sock.recvfrom(65535)
+        except socket.timeout:
+            continue
+        samples.append(time.perf_counter() - t0)
+    return samples
+
+
+def flood(sock: socket.socket, dest, wrap: bytes, payload: bytes, duration: float, window: int) -> dict:
+    """Keep `window` datagrams in flight for `duration` seconds; count round trips."""
+    msg = wrap + payload
+    sent = received = 0
+    inflight = 0
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        while inflight < window:
+            sock.sendto(msg, dest)
+            sent += 1
+            inflight += 1
+        try:
+            sock.recvfrom(65535)
+            received += 1
+            inflight -= 1
+        except socket.timeout:
+            inflight = 0  # treat outstanding datagrams as lost
+    return {"sent": sent, "received": received, "datagrams_per_s": round(received / duration, 1),
+            "loss_pct": round(100.0 * (sent - received) / max(sent, 1), 2)}
+
+
+def main():
+    ap = argparse.ArgumentParser(description="UDP ASSOCIATE relay benchmark (socks5_dcs)")
+    ap.add_argument("--size", type=int, default=256, help="payload bytes per datagram")
+    ap.add_argument("--count", type=int, default=2000, help="ping-pong samples for latency")
+    ap.add_argument("--duration", type=float, default=5.0, help="seconds of throughput flood")
+    ap.add_argument("--window", type=int, default=32, help="datagrams in flight during the flood")
+    ap.add_argument("--json", help="write results to this file")
+    args = ap.parse_args()
+
+    echo_port, dcs_port = free_port(socket.SOCK_DGRAM), free_port()
+    procs = [spawn(ECHO_CODE.format(port=echo_port)), spawn(DCS_CODE.format(port=dcs_port))]
+    try:
+        wait_port(dcs_port)
+        time.sleep(0.2)
+        ctl, relay = udp_associate(dcs_port)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+        sock.settimeout(1.0)
+        payload = b"x" * args.size
+        wrap = b"\x00\x00\x00\x01" + socket.inet_aton(HOST) + struct.pack("!H", echo_port)
+        echo = (HOST, echo_port)
+
+        direct = ping_pong(sock, echo, b"", payload, args.count)
+        relayed = ping_pong(sock, relay, wrap, payload, args.count)
+        d, r = latency_summary(direct), latency_summary(relayed)
+        usage0 = proc_usage(procs[1].pid)
+        tput = flood(sock, relay, wrap, payload, args.duration, args.window)
+        usage1 = proc_usage(procs[1].pid)
+        ctl.close()
+
+        results = {
+            "benchmark": "udp_associate",
+            "payload_bytes": args.size,
+            "direct_latency": d,
+            "relayed_latency": r,
+            "added_latency": {k: round(r[k] - d[k], 1) for k in d},
+            "throughput": tput,
+            "dcs_cpu_s": round(usage1["cpu_s"] - usage0["cpu_s"], 3),
+            "dcs_rss_kb": usage1["rss_kb"],
+        }
+        print(f"direct   p50={d['p50_us']}us p99={d['p99_us']}us")
+        print(f"relayed  p50={r['p50_us']}us p99={r['p99_us']}us  (added p50={results['added_latency']['p50_us']}us)")
+        print(f"relay    {tput['datagrams_per_s']} datagrams/s, loss {tput['loss_pct']}%, DCS cpu {results['dcs_cpu_s']}s")
+        if args.json:
+            write_results(args.json, results)
+    finally:
+        stop(procs)
+
+
+if __name__ == "__main__":
+    main()
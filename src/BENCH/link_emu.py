@@ -0,0 +1,391 @@
+import argparse
+import asyncio
+import json
+import random
+import re
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+# -----------------------
+# Constrained-link emulator
+# -----------------------
+# A TCP proxy for loopback tests that behaves like the PPP's radio uplink:
+#
+#   PPP --> [listen] link_emu [upstream] --> DCS
+#
+# Each direction is one shared bottleneck (all connections through the emulator
+# compete for it, like streams on one radio):
+#   bandwidth  bytes leave the bottleneck queue at this rate, packet by packet
+#   queue      bounded bottleneck queue; when full, reading from the sender stops
+#              (TCP backpressure instead of a silent drop, which would corrupt the stream)
+#   delay      one-way propagation delay, plus uniform jitter; order is kept per connection
+#   loss       Gilbert-Elliott losses (mean burst length in packets); TCP on the real link
+#              repairs a loss by retransmitting, so a lost packet arrives one RTO late
+#   stalls     the link goes dark at random (exponential gaps and durations)
+#   schedule   scripted changes over time, e.g. "10:bw=64k,delay=400ms;20:bw=0;25:bw=1M;40:drop"
+#              ("drop" resets every connection, to exercise reconnect logic)
+#
+# Rates are bit/s with k/M/G suffixes; durations are seconds or take ms/s suffixes.
+
+PACKET = 1400            # bytes per emulated packet
+CHUNK = 65536            # read size from each socket
+MIN_SLEEP = 0.001        # serialisation debt below this is carried, not slept
+
+
+def parse_rate(text: str) -> float:
+    """ "256k" -> 32000.0 bytes/s; "0" = link down."""
+    m = re.fullmatch(r"\s*([\d.]+)\s*([kKmMgG]?)(?:bit|bps|b)?\s*", text)
+    if not m:
+        raise ValueError(f"bad rate: {text!r}")
+    mult = {"": 1, "k": 1e3, "m": 1e6, "g": 1e9}[m.group(2).lower()]
+    return float(m.group(1)) * mult / 8
+
+
+def parse_duration(text: str) -> float:
+    m = re.fullmatch(r"\s*([\d.]+)\s*(ms|s)?\s*", text)
+    if not m:
+        raise ValueError(f"bad duration: {text!r}")
+    return float(m.group(1)) / (1000 if m.group(2) == "ms" else 1)
+
+
+def parse_schedule(text: str) -> List[Tuple[float, Dict[str, object]]]:
+    """ "10:bw=64k,delay=400ms;40:drop" or a JSON list of [t, {...}] pairs."""
+    text = text.strip()
+    if text.startswith("["):
+        return [(float(t), dict(change)) for t, change in json.loads(text)]
+    steps = []
+    for step in filter(None, (s.strip() for s in text.split(";"))):
+        t, _, changes = step.partition(":")
+        change: Dict[str, object] = {}
+        for item in filter(None, (c.strip() for c in changes.split(","))):
+            key, _, value = item.partition("=")
+            change[key] = value if value else True
+        steps.append((parse_duration(t), change))
+    return sorted(steps, key=lambda s: s[0])
+
+
+class Link:
+    """One direction of the bottleneck."""
+
+    def __init__(self, name: str, rate: float, delay: float = 0.0, jitter: float = 0.0,
+                 queue_limit: int = 64 * 1024, loss: float = 0.0, burst: float = 1.0, rto: float = 0.2):
+        self.name = name
+        self.rate = rate
+        self.delay = delay
+        self.jitter = jitter
+        self.queue_limit = queue_limit
+        self.loss = loss
+        self.burst = burst
+        self.rto = rto
+        self.stalled_until = 0.0
+        self.queue: Deque[Tuple["_Pipe", Optional[bytes]]] = deque()
+        self.queued = 0
+        self.bad = False                     # Gilbert-Elliott state
+        self.has_room = asyncio.Event()
+        self.has_room.set()
+        self.has_data = asyncio.Event()
+        self.rate_changed = asyncio.Event()
+        self.stats = {"bytes": 0, "packets": 0, "lost": 0, "stalls": 0, "queue_full": 0, "max_queue": 0}
+
+    async def put(self, pipe: "_Pipe", data: bytes):
+        """Queue data for the bottleneck; waits while the queue is full."""
+        for i in range(0, len(data), PACKET):
+            while self.queued >= self.queue_limit:
+                self.stats["queue_full"] += 1
+                self.has_room.clear()
+                await self.has_room.wait()
+            if pipe.dropped:
+                return
+            pkt = data[i:i + PACKET]
+            self.queue.append((pipe, pkt))
+            self.queued += len(pkt)
+            self.stats["max_queue"] = max(self.stats["max_queue"], self.queued)
+            self.has_data.set()
+
+    def put_eof(self, pipe: "_Pipe"):
+        """EOF travels behind the data already queued, and takes no link time."""
+        if pipe.dropped:
+            pipe.finish()
+            return
+        self.queue.append((pipe, None))
+        self.has_data.set()
+
+    def discard(self, pipes):
+        """Forget the queued packets of dropped connections, so they cost no link time."""
+        self.queue = deque(entry for entry in self.queue if entry[0] not in pipes)
+        self.queued = sum(len(pkt) for _, pkt in self.queue if pkt is not None)
+        if self.queued < self.queue_limit:
+            self.has_room.set()
+
+    def set_rate(self, rate: float):
+        self.rate = rate
+        self.rate_changed.set()
+
+    def stall(self, seconds: float):
+        self.stalled_until = max(self.stalled_until, time.monotonic() + seconds)
+        self.stats["stalls"] += 1
+
+    def _lost(self) -> bool:
+        # Gilbert-Elliott: good -> bad with p such that the long-run loss rate is `loss`,
+        # bad -> good with 1/burst, every packet in the bad state is lost
+        if self.loss <= 0:
+            return False
+        leave_bad = 1.0 / max(self.burst, 1.0)
+        enter_bad = self.loss * leave_bad / max(1e-9, 1.0 - self.loss)
+        self.bad = random.random() < (1.0 - leave_bad if self.bad else enter_bad)
+        return self.bad
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        next_free = loop.time()
+        while True:
+            if not self.queue:
+                self.has_data.clear()
+                await self.has_data.wait()
+            now = time.monotonic()
+            if self.stalled_until > now:
+                await asyncio.sleep(self.stalled_until - now)
+            while self.rate <= 0:
+                self.rate_changed.clear()
+                await self.rate_changed.wait()
+            if not self.queue:
+                continue  # discarded while we waited
+            pipe, pkt = self.queue.popleft()
+            if pkt is None:
+                pipe.deliver(loop.time() + self.delay, None)
+                continue
+            self.queued -= len(pkt)
+            if self.queued < self.queue_limit:
+                self.has_room.set()
+
+            # Serialisation at the bottleneck rate; short debts are batched into one sleep
+            now = loop.time()
+            next_free = max(next_free, now) + len(pkt) / self.rate
+            if next_free - now > MIN_SLEEP:
+                await asyncio.sleep(next_free - now)
+
+            arrive = loop.time() + self.delay + (random.uniform(0, self.jitter) if self.jitter else 0.0)
+            if self._lost():
+                arrive += self.rto
+                self.stats["lost"] += 1
+            pipe.deliver(arrive, pkt)
+            self.stats["bytes"] += len(pkt)
+            self.stats["packets"] += 1
+
+
+class _Pipe:
+    """One direction of one connection: packets leave the link in order and reach the writer."""
+    __slots__ = ("writer", "last_arrival", "done", "dropped")
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+        self.last_arrival = 0.0
+        self.dropped = False
+        self.done = asyncio.get_running_loop().create_future()  # EOF delivered
+
+    def deliver(self, arrive: float, pkt: Optional[bytes]):
+        # Jitter and retransmissions must not reorder a byte stream; the loop's timer heap
+        # does not keep insertion order for equal deadlines, so deadlines strictly increase
+        arrive = max(arrive, self.last_arrival + 1e-6)
+        self.last_arrival = arrive
+        asyncio.get_running_loop().call_at(arrive, self._write, pkt)
+
+    def finish(self):
+        if not self.done.done():
+            self.done.set_result(None)
+
+    def _write(self, pkt: Optional[bytes]):
+        w = self.writer
+        if pkt is not None:
+            if not w.is_closing():
+                w.write(pkt)
+            return
+        self.finish()
+        if w.is_closing():
+            return
+        try:
+            if w.can_write_eof():
+                w.write_eof()
+            else:
+                w.close()
+        except (OSError, RuntimeError):
+            w.close()
+
+
+class LinkEmulator:
+    def __init__(self, listen: Tuple[str, int], upstream: Tuple[str, int], up: Link, down: Link,
+                 schedule: Optional[List[Tuple[float, dict]]] = None,
+                 stall_every: float = 0.0, stall_for: float = 0.0):
+        self.listen = listen
+        self.upstream = upstream
+        self.up = up
+        self.down = down
+        self.schedule = schedule or []
+        self.stall_every = stall_every
+        self.stall_for = stall_for
+        # (client writer, upstream writer, pipe towards upstream, pipe towards client)
+        self.conns: List[Tuple[asyncio.StreamWriter, asyncio.StreamWriter, _Pipe, _Pipe]] = []
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.tasks: List[asyncio.Task] = []
+        self.started = 0.0
+        self.accepted = 0
+
+    async def start(self):
+        self.started = time.monotonic()
+        self.server = await asyncio.start_server(self._handle, *self.listen)
+        self.tasks = [asyncio.create_task(self.up.run()), asyncio.create_task(self.down.run())]
+        if self.schedule:
+            self.tasks.append(asyncio.create_task(self._run_schedule()))
+        if self.stall_every > 0:
+            self.tasks.append(asyncio.create_task(self._random_stalls()))
+
+    async def stop(self):
+        for t in self.tasks:
+            t.cancel()
+        if self.server:
+            self.server.close()
+        self.drop_all()
+
+    def drop_all(self):
+        pipes = set()
+        for a, b, to_up, to_down in self.conns:
+            for w in (a, b):
+                try:
+                    w.transport.abort()
+                except Exception:
+                    pass
+            pipes.update((to_up, to_down))
+        for pipe in pipes:
+            pipe.dropped = True
+            pipe.finish()  # its EOF may be among the discarded packets
+        # Their backlog would otherwise hold up reconnected flows for queued/rate seconds
+        self.up.discard(pipes)
+        self.down.discard(pipes)
+        self.conns.clear()
+
+    def apply(self, change: dict):
+        for key, value in change.items():
+            if key == "drop":
+                self.drop_all()
+            elif key == "stall":
+                for link in (self.up, self.down):
+                    link.stall(parse_duration(str(value)))
+            elif key in ("bw", "up_bw", "down_bw"):
+                for link in self._links(key):
+                    link.set_rate(parse_rate(str(value)))
+            elif key in ("delay", "jitter", "rto"):
+                for link in (self.up, self.down):
+                    setattr(link, key, parse_duration(str(value)))
+            elif key in ("loss", "burst"):
+                for link in (self.up, self.down):
+                    setattr(link, key, float(value))
+            elif key == "queue":
+                for link in (self.up, self.down):
+                    link.queue_limit = int(parse_rate(str(value)) * 8)  # same k/M suffixes, in bytes
+            else:
+                raise ValueError(f"unknown schedule key {key!r}")
+        print(f"[link] t={time.monotonic() - self.started:.1f}s {change}", flush=True)
+
+    def _links(self, key: str) -> List[Link]:
+        return [self.up] if key == "up_bw" else [self.down] if key == "down_bw" else [self.up, self.down]
+
+    async def _run_schedule(self):
+        for t, change in self.schedule:
+            await asyncio.sleep(max(0.0, self.started + t - time.monotonic()))
+            self.apply(change)
+
+    async def _random_stalls(self):
+        while True:
+            await asyncio.sleep(random.expovariate(1.0 / self.stall_every))
+            seconds = random.expovariate(1.0 / self.stall_for) if self.stall_for > 0 else 0.0
+            for link in (self.up, self.down):
+                link.stall(seconds)
+            print(f"[link] stall {seconds * 1000:.0f} ms", flush=True)
+
+    async def _handle(self, c_reader: asyncio.StreamReader, c_writer: asyncio.StreamWriter):
+        self.accepted += 1
+        try:
+            u_reader, u_writer = await asyncio.open_connection(*self.upstream)
+        except OSError as e:
+            print(f"[link] upstream {self.upstream} unreachable: {e}", flush=True)
+            c_writer.close()
+            return
+        pair = (c_writer, u_writer)
+        to_up, to_down = _Pipe(u_writer), _Pipe(c_writer)
+        conn = (c_writer, u_writer, to_up, to_down)
+        self.conns.append(conn)
+        try:
+            await asyncio.gather(self._pump(c_reader, self.up, to_up), self._pump(u_reader, self.down, to_down),
+                                 to_up.done, to_down.done)
+        finally:
+            if conn in self.conns:
+                self.conns.remove(conn)
+            for w in pair:
+                w.close()
+
+    @staticmethod
+    async def _pump(reader: asyncio.StreamReader, link: Link, pipe: _Pipe):
+        try:
+            while data := await reader.read(CHUNK):
+                await link.put(pipe, data)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            link.put_eof(pipe)
+
+    def stats(self) -> dict:
+        return {"connections": len(self.conns), "accepted": self.accepted,
+                "up": dict(self.up.stats, queued=self.up.queued), "down": dict(self.down.stats, queued=self.down.queued)}
+
+
+def host_port(text: str) -> Tuple[str, int]:
+    host, _, port = text.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+async def main_async(args):
+    up = Link("up", parse_rate(args.up_bw or args.bw), parse_duration(args.delay), parse_duration(args.jitter),
+              int(parse_rate(args.queue) * 8), args.loss, args.burst, parse_duration(args.rto))
+    down = Link("down", parse_rate(args.down_bw or args.bw), parse_duration(args.delay), parse_duration(args.jitter),
+                int(parse_rate(args.queue) * 8), args.loss, args.burst, parse_duration(args.rto))
+    emu = LinkEmulator(host_port(args.listen), host_port(args.upstream), up, down,
+                       parse_schedule(args.schedule) if args.schedule else None,
+                       args.stall_every, parse_duration(args.stall_for))
+    await emu.start()
+    print(f"[link] {args.listen} -> {args.upstream}: up {args.up_bw or args.bw}bit/s down {args.down_bw or args.bw}bit/s "
+          f"delay {args.delay} jitter {args.jitter} queue {args.queue}B loss {args.loss} burst {args.burst}", flush=True)
+    try:
+        while True:
+            await asyncio.sleep(args.report)
+            print(f"[link] {json.dumps(emu.stats())}", flush=True)
+    finally:
+        await emu.stop()
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Emulate a slow, lossy uplink between PPP and DCS on loopback")
+    ap.add_argument("--listen", default="127.0.0.1:9100", help="where the PPP connects")
+    ap.add_argument("--upstream", default="127.0.0.1:9000", help="the DCS (or mux server)")
+    ap.add_argument("--bw", default="1M", help="bottleneck rate each way, bit/s (k/M/G)")
+    ap.add_argument("--up-bw", help="PPP -> DCS rate, overrides --bw")
+    ap.add_argument("--down-bw", help="DCS -> PPP rate, overrides --bw")
+    ap.add_argument("--delay", default="50ms", help="one-way delay")
+    ap.add_argument("--jitter", default="0ms", help="extra one-way delay, uniform in [0, jitter]")
+    ap.add_argument("--queue", default="64k", help="bottleneck queue size in bytes (k/M)")
+    ap.add_argument("--loss", type=float, default=0.0, help="long-run packet loss rate")
+    ap.add_argument("--burst", type=float, default=1.0, help="mean loss burst length, packets")
+    ap.add_argument("--rto", default="200ms", help="extra delay of a lost (retransmitted) packet")
+    ap.add_argument("--stall-every", type=float, default=0.0, help="mean seconds between random stalls; 0 = none")
+    ap.add_argument("--stall-for", default="1s", help="mean stall length")
+    ap.add_argument("--schedule", help='e.g. "10:bw=64k,delay=400ms;20:bw=0;25:bw=1M;40:drop" or a JSON list')
+    ap.add_argument("--report", type=float, default=5.0, help="seconds between stats lines")
+    args = ap.parse_args()
+    try:
+        asyncio.run(main_async(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
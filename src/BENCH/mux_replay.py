@@ -0,0 +1,246 @@
+import argparse
+import asyncio
+import sys
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+from bench_common import (HOST, SRC_DIR, free_port, latency_summary, proc_usage,
+                          spawn, stop, wait_port, write_results)
+
+sys.path.insert(0, SRC_DIR)
+import mux_trace
+import mux_wire
+import tls_link
+from mux_trace import CLOSE, DATA, OPEN, RX, TX
+
+# -----------------------
+# Mux trace replay
+# -----------------------
+# Plays a trace from mux_trace back on the compact wire format, on the trace's
+# own clock (scaled by --speed; 0 = as fast as the link takes it). The schedule
+# never waits for answers, so two runs of one trace send the same frames in the
+# same order at the same offsets.
+#
+#   --mode server   we are the PPP: send the frames the recorded server received
+#                   to a mux server (--connect, or --spawn one), every OPEN going
+#                   to a local sink/echo target unless --keep-targets
+#   --mode client   we are the DCS: listen, and send the frames the recorded server
+#                   sent to the mux client that connects
+#
+# Bodies missing from the trace (recorded without payloads) are sent as zero bytes.
+
+SPAWN_CODE = {
+    "mux": "import asyncio, ppp_mux_server; asyncio.run(ppp_mux_server.main('127.0.0.1', {port}))",
+    "mux_dcs": "import asyncio, mux_dcs_server; asyncio.run(mux_dcs_server.main('127.0.0.1', {port}))",
+}
+# Sleeps shorter than this are skipped: the frame is sent at once and counted as late
+MIN_SLEEP = 0.0005
+# After the last frame, wait this long for the peer's remaining frames
+LINGER = 2.0
+
+
+def load(path: str, direction: int):
+    header, frames = mux_trace.read_trace(path)
+    return header, [fr for fr in frames if fr.direction == direction]
+
+
+def encode(fr: mux_trace.TraceFrame, target: Optional[bytes]) -> bytes:
+    if fr.msg_type == OPEN and target is not None and fr.direction == RX:
+        body = target
+    elif fr.body is not None:
+        body = fr.body
+    else:
+        body = bytes(fr.length)
+    return mux_wire.encode_frame(fr.msg_type, fr.stream_id, body, priority=fr.priority)
+
+
+class Peer:
+    """Counts what the other side sends back; OPEN/CLOSE answers give per-stream open latency."""
+    def __init__(self):
+        self.frames = Counter()
+        self.data_bytes = 0
+        self.opened_at: Dict[int, float] = {}
+        self.open_latency: List[float] = []
+        self.open_failed = 0
+        self.idle = asyncio.Event()
+
+    async def drain_frames(self, reader: asyncio.StreamReader):
+        try:
+            while True:
+                msg_type, _, _, sid, body = await mux_wire.read_frame(reader)
+                self.frames[msg_type] += 1
+                if msg_type == DATA:
+                    self.data_bytes += len(body)
+                elif sid in self.opened_at and msg_type in (OPEN, CLOSE):
+                    self.open_latency.append(time.perf_counter() - self.opened_at.pop(sid))
+                    if msg_type == CLOSE:
+                        self.open_failed += 1
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.idle.set()
+
+
+async def play(frames: List[mux_trace.TraceFrame], writer: asyncio.StreamWriter, speed: float,
+               peer: Peer, target: Optional[bytes]) -> dict:
+    loop = asyncio.get_running_loop()
+    lateness: List[float] = []
+    sent = Counter()
+    sent_bytes = 0
+    t0 = loop.time()
+    for fr in frames:
+        if speed > 0:
+            due = t0 + fr.t / speed
+            delay = due - loop.time()
+            if delay > MIN_SLEEP:
+                await asyncio.sleep(delay)
+            lateness.append(max(0.0, loop.time() - due))
+        if fr.msg_type == OPEN:
+            peer.opened_at[fr.stream_id] = time.perf_counter()
+        writer.write(encode(fr, target))
+        sent[fr.msg_type] += 1
+        if fr.msg_type == DATA:
+            sent_bytes += fr.length
+        await writer.drain()
+    return {
+        "wall_s": round(loop.time() - t0, 3),
+        "sent_frames": {mux_trace.NAMES.get(k, k): v for k, v in sent.items()},
+        "sent_data_bytes": sent_bytes,
+        "lateness": dict(latency_summary(lateness), max_us=round(max(lateness, default=0) * 1e6, 1)),
+    }
+
+
+def results(header: mux_trace.Header, frames: List[mux_trace.TraceFrame], played: dict, peer: Peer, speed: float) -> dict:
+    trace_s = frames[-1].t if frames else 0.0
+    res = {
+        "trace": {"component": header.component, "peer": header.peer, "payload": header.payload,
+                  "seconds": round(trace_s, 3), "frames": len(frames)},
+        "speed": speed,
+        "target_wall_s": round(trace_s / speed, 3) if speed > 0 else None,
+        **played,
+        "received_frames": {mux_trace.NAMES.get(k, k): v for k, v in peer.frames.items()},
+        "received_data_bytes": peer.data_bytes,
+    }
+    if peer.open_latency or peer.open_failed:
+        res["open_latency"] = latency_summary(peer.open_latency)
+        res["open_failed"] = peer.open_failed
+    return res
+
+
+async def drive_server(path: str, host: str, port: int, speed: float, target: Optional[bytes]) -> dict:
+    header, frames = load(path, RX)
+    reader, writer = await tls_link.open_connection(host, port, "replay")
+    await mux_wire.client_hello(reader, writer)
+    peer = Peer()
+    task = asyncio.create_task(peer.drain_frames(reader))
+    played = await play(frames, writer, speed, peer, target)
+    try:
+        await asyncio.wait_for(peer.idle.wait(), LINGER)
+    except asyncio.TimeoutError:
+        pass
+    task.cancel()
+    writer.close()
+    return results(header, frames, played, peer, speed)
+
+
+async def drive_client(path: str, port: int, speed: float) -> dict:
+    header, frames = load(path, TX)
+    accepted: asyncio.Future = asyncio.get_running_loop().create_future()
+
+    async def on_client(reader, writer):
+        if accepted.done():
+            writer.close()
+            return
+        await mux_wire.accept_hello(reader, writer)
+        accepted.set_result((reader, writer))
+
+    server = await asyncio.start_server(on_client, HOST, port, ssl=tls_link.server_context())
+    print(f"waiting for a mux client on {HOST}:{port}")
+    reader, writer = await accepted
+    server.close()
+    peer = Peer()
+    task = asyncio.create_task(peer.drain_frames(reader))
+    played = await play(frames, writer, speed, peer, None)
+    try:
+        await asyncio.wait_for(peer.idle.wait(), LINGER)
+    except asyncio.TimeoutError:
+        pass
+    task.cancel()
+    writer.close()
+    return results(header, frames, played, peer, speed)
+
+
+async def start_target(mode: str) -> Tuple[asyncio.AbstractServer, int]:
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while data := await reader.read(65536):
+                if mode == "echo":
+                    writer.write(data)
+                    await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    port = free_port()
+    return await asyncio.start_server(handle, HOST, port), port
+
+
+async def run(args) -> dict:
+    if args.mode == "client":
+        return await drive_client(args.trace, args.listen or free_port(), args.speed)
+
+    target = None
+    target_server = None
+    if not args.keep_targets:
+        target_server, tport = await start_target(args.target_mode)
+        target = mux_wire.pack_addr(HOST, tport)
+    procs = []
+    try:
+        if args.spawn:
+            port = free_port()
+            procs.append(spawn(SPAWN_CODE[args.spawn].format(port=port)))
+            wait_port(port)
+            host = HOST
+        else:
+            host, _, p = args.connect.rpartition(":")
+            port = int(p)
+        res = await drive_server(args.trace, host, port, args.speed, target)
+        if procs:
+            res["server"] = args.spawn
+            res["server_usage"] = proc_usage(procs[0].pid)
+        return res
+    finally:
+        stop(procs)
+        if target_server:
+            target_server.close()
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Replay a mux frame trace against a mux server or client")
+    ap.add_argument("trace")
+    ap.add_argument("--mode", choices=("server", "client"), default="server")
+    ap.add_argument("--connect", default=f"{HOST}:9000", help="server mode: mux server to drive")
+    ap.add_argument("--spawn", choices=sorted(SPAWN_CODE), help="server mode: start this server on loopback instead")
+    ap.add_argument("--listen", type=int, default=0, help="client mode: port to accept the client on")
+    ap.add_argument("--speed", type=float, default=1.0, help="time scale: 2 = twice as fast, 0 = unpaced")
+    ap.add_argument("--target-mode", choices=("sink", "echo"), default="sink", help="local target behind every OPEN")
+    ap.add_argument("--keep-targets", action="store_true", help="open the recorded targets instead of the local one")
+    ap.add_argument("--json", help="write machine-readable results here")
+    args = ap.parse_args()
+
+    res = asyncio.run(run(args))
+    lat = res["lateness"]
+    print(f"replayed {res['trace']['frames']} frames ({res['trace']['seconds']}s traced) in {res['wall_s']}s "
+          f"at speed {args.speed}: late p50={lat['p50_us']}us p99={lat['p99_us']}us max={lat['max_us']}us")
+    print(f"sent {res['sent_frames']} ({res['sent_data_bytes']} data bytes), "
+          f"received {res['received_frames']} ({res['received_data_bytes']} data bytes)")
+    if "open_latency" in res:
+        print(f"open latency {res['open_latency']}, failed {res['open_failed']}")
+    if args.json:
+        write_results(args.json, dict(res, benchmark="mux_replay"))
+
+
+if __name__ == "__main__":
+    main()
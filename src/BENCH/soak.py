@@ -0,0 +1,348 @@
+import argparse
+import asyncio
+import gc
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+from typing import Dict, List, Optional
+
+from bench_common import (HOST, free_port, percentile, raise_nofile, spawn, stop,
+                          wait_port, write_results)
+from bench_proxy import MuxClient, socks5_tunnel
+
+# -----------------------
+# Soak: how many tunnels can one proxy process hold?
+# -----------------------
+# The proxy under test runs in a child with an in-process sampler that appends one
+# JSON line per interval: RSS, traced Python heap, tracemalloc top allocators, open
+# fds, asyncio task count and event-loop lag. The parent opens the tunnels, holds
+# them for the configured duration, closes them and keeps sampling to catch leaks.
+
+SERVE_CODE = "import soak; soak.serve({kind!r}, {port}, {samples!r}, {interval}, {trace})"
+KINDS = ["dcs", "mux"]
+
+LAG_PROBE = 0.05     # seconds between event-loop lag probes
+TOP_ALLOCATORS = 8   # tracemalloc lines kept per sample
+OPEN_TIMEOUT = 10.0
+
+# Counters that must return to their baseline once every tunnel is closed
+LEAK_SLACK = {"fds": 8, "tasks": 8}
+# Heap a closed tunnel may leave behind: the selector map and the task WeakSet keep their peak
+# hash-table capacity, and pools/caches hold a little per destination
+LEAK_TRACED_PER_TUNNEL = 1024
+
+
+# -----------------------
+# Child side
+# -----------------------
+
+def _fd_count() -> int:
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return -1
+
+
+def _rss_kb() -> int:
+    try:
+        with open("/proc/self/status") as f:
+            return next(int(line.split()[1]) for line in f if line.startswith("VmRSS:"))
+    except (OSError, StopIteration):
+        return 0
+
+
+async def _echo(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except Exception:
+        pass
+    finally:
+        writer.close()
+
+
+async def _sampler(path: str, interval: float):
+    lags: List[float] = []
+
+    async def probe():
+        while True:
+            t0 = time.perf_counter()
+            await asyncio.sleep(LAG_PROBE)
+            lags.append(time.perf_counter() - t0 - LAG_PROBE)
+
+    probe_task = asyncio.create_task(probe())
+    try:
+        with open(path, "a", buffering=1) as out:
+            while True:
+                await asyncio.sleep(interval)
+                # Closed transports sit in reference cycles until the collector runs; collect
+                # first so retained objects mean a real leak, not a pending gc generation
+                gc.collect()
+                sample = {
+                    "t": time.time(),
+                    "rss_kb": _rss_kb(),
+                    "fds": _fd_count(),
+                    "tasks": len(asyncio.all_tasks()),
+                    "lag_ms_max": round(max(lags, default=0.0) * 1e3, 2),
+                    "lag_ms_avg": round(sum(lags) / len(lags) * 1e3, 2) if lags else 0.0,
+                }
+                lags.clear()
+                if tracemalloc.is_tracing():
+                    sample["traced"] = tracemalloc.get_traced_memory()[0]
+                    stats = tracemalloc.take_snapshot().statistics("lineno")[:TOP_ALLOCATORS]
+                    sample["top"] = [[f"{s.traceback[0].filename}:{s.traceback[0].lineno}", s.size, s.count]
+                                     for s in stats]
+                out.write(json.dumps(sample) + "\n")
+    finally:
+        probe_task.cancel()
+
+
+async def _serve(kind: str, port: int, samples: Optional[str], interval: float):
+    if kind == "dcs":
+        import socks5_dcs
+        server = socks5_dcs.main(HOST, port)
+    elif kind == "mux":
+        import ppp_mux_server
+        server = ppp_mux_server.main(HOST, port)
+    else:
+        srv = await asyncio.start_server(_echo, HOST, port, backlog=4096)
+        server = srv.serve_forever()
+    if samples:
+        await asyncio.gather(server, _sampler(samples, interval))
+    else:
+        await server
+
+
+def serve(kind: str, port: int, samples: Optional[str] = None, interval: float = 1.0, trace: bool = False):
+    """Child entry point: run one component, optionally sampling itself into `samples`."""
+    raise_nofile()
+    if trace:
+        tracemalloc.start()
+    asyncio.run(_serve(kind, port, samples, interval))
+
+
+# -----------------------
+# Parent side: tunnel mixes
+# -----------------------
+
+async def idle_tunnel(t, stop_evt: asyncio.Event, counters: dict):
+    # One exchange proves the path works, then the tunnel just sits there
+    await t.send(b"i")
+    await t.recv(1)
+    await stop_evt.wait()
+
+
+async def trickle_tunnel(t, stop_evt: asyncio.Event, counters: dict, period: float = 1.0):
+    msg = b"t" * 32
+    # Spread the ticks so thousands of trickle tunnels don't fire in lockstep
+    await asyncio.sleep(random.random() * period)
+    while not stop_evt.is_set():
+        await t.send(msg)
+        await t.recv(len(msg))
+        counters["bytes"] += len(msg)
+        try:
+            await asyncio.wait_for(stop_evt.wait(), period)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def bulk_tunnel(t, stop_evt: asyncio.Event, counters: dict, size: int = 16384):
+    chunk = b"b" * size
+    while not stop_evt.is_set():
+        await t.send(chunk)
+        await t.recv(size)
+        counters["bytes"] += size
+
+
+async def run_load(kind: str, proxy_port: int, echo_port: int, args) -> dict:
+    stop_evt = asyncio.Event()
+    counters = {"opened": 0, "errors": 0, "bytes": 0}
+    tunnels = []
+    tasks: List[asyncio.Task] = []
+    slots = asyncio.Semaphore(args.ramp_concurrency)
+    client: Optional[MuxClient] = None
+
+    if kind == "mux":
+        client = MuxClient()
+        await client.connect(proxy_port)
+
+        async def opener():
+            return await client.open(echo_port)
+    else:
+        async def opener():
+            return await socks5_tunnel(proxy_port, echo_port)
+
+    n_bulk = int(args.tunnels * args.bulk)
+    n_trickle = int(args.tunnels * args.trickle)
+    mix = ([bulk_tunnel] * n_bulk + [trickle_tunnel] * n_trickle
+           + [idle_tunnel] * (args.tunnels - n_bulk - n_trickle))
+
+    async def one(behaviour):
+        try:
+            async with slots:
+                t = await asyncio.wait_for(opener(), OPEN_TIMEOUT)
+            tunnels.append(t)
+            counters["opened"] += 1
+            await behaviour(t, stop_evt, counters)
+        except Exception:
+            counters["errors"] += 1
+
+    phases = {"ramp_start": time.time()}
+    print(f"opening {args.tunnels} tunnels ({n_bulk} bulk, {n_trickle} trickle, "
+          f"{args.tunnels - n_bulk - n_trickle} idle) through {kind}")
+    for behaviour in mix:
+        tasks.append(asyncio.create_task(one(behaviour)))
+    while counters["opened"] + counters["errors"] < args.tunnels:
+        await asyncio.sleep(0.5)
+    phases["hold_start"] = time.time()
+    print(f"holding {counters['opened']} tunnels for {args.duration}s (errors={counters['errors']})")
+    await asyncio.sleep(args.duration)
+
+    phases["close_start"] = time.time()
+    stop_evt.set()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    for t in tunnels:
+        await t.close()
+    if client is not None:
+        # Give the server the CLOSE frames before the mux connection itself goes
+        await client.writer.drain()
+        await client.close()
+    phases["closed"] = time.time()
+    print(f"closed; watching the proxy settle for {args.settle}s")
+    await asyncio.sleep(args.settle)
+    phases["end"] = time.time()
+    return {"counters": counters, "phases": phases}
+
+
+# -----------------------
+# Report
+# -----------------------
+
+def _window(samples: List[dict], start: float, end: float) -> List[dict]:
+    return [s for s in samples if start <= s["t"] <= end]
+
+
+def _mean(samples: List[dict], key: str) -> float:
+    vals = [s[key] for s in samples if key in s]
+    return sum(vals) / len(vals) if vals else 0.0
+
+
+def analyse(samples: List[dict], phases: Dict[str, float], tunnels: int) -> dict:
+    base = _window(samples, 0, phases["ramp_start"])[-3:]
+    hold = _window(samples, phases["hold_start"], phases["close_start"])
+    # Skip the first couple of settle samples: closes are still being processed
+    settle = _window(samples, phases["closed"] + 2.0, phases["end"])
+    if not base or not hold or not settle:
+        return {"error": "not enough samples; lengthen --duration/--settle or shorten --interval"}
+
+    keys = ["rss_kb", "fds", "tasks"] + (["traced"] if "traced" in base[-1] else [])
+    b = {k: _mean(base, k) for k in keys}
+    h = {k: _mean(hold, k) for k in keys}
+    f = {k: settle[-1][k] for k in keys}
+    n = max(1, tunnels)
+
+    report = {
+        "tunnels": tunnels,
+        "baseline": {k: round(v, 1) for k, v in b.items()},
+        "hold": {k: round(v, 1) for k, v in h.items()},
+        "after_close": f,
+        "per_tunnel": {
+            "rss_bytes": round((h["rss_kb"] - b["rss_kb"]) * 1024 / n, 1),
+            "fds": round((h["fds"] - b["fds"]) / n, 3),
+            "tasks": round((h["tasks"] - b["tasks"]) / n, 3),
+        },
+    }
+    if "traced" in b:
+        report["per_tunnel"]["heap_bytes"] = round((h["traced"] - b["traced"]) / n, 1)
+
+    lags = sorted(s["lag_ms_max"] for s in samples if s["t"] >= phases["ramp_start"])
+    report["loop_lag_ms"] = {"max": lags[-1] if lags else 0.0, "p99": percentile(lags, 99),
+                             "hold_avg": round(_mean(hold, "lag_ms_avg"), 3)}
+
+    # Leaks: counters still above baseline after close, or still climbing while idle
+    leaks = []
+    for k, slack in LEAK_SLACK.items():
+        if f[k] - b[k] > slack:
+            leaks.append(f"{k} retained: {f[k]} vs baseline {b[k]:.0f}")
+    if "traced" in b and f["traced"] - b["traced"] > LEAK_TRACED_PER_TUNNEL * n:
+        leaks.append(f"heap retained: {(f['traced'] - b['traced']) / n:.0f} bytes/tunnel after close")
+    half = len(settle) // 2
+    if half:
+        for k in keys:
+            early, late = _mean(settle[:half], k), _mean(settle[half:], k)
+            if k == "rss_kb" or late <= early:
+                continue  # RSS rarely shrinks or grows smoothly in CPython; judge it by the heap instead
+            if late - early > (LEAK_SLACK.get(k, 0) or 0.01 * max(early, 1)):
+                leaks.append(f"{k} still growing after close: {early:.0f} -> {late:.0f}")
+    report["leaks"] = leaks
+    if "top" in hold[-1]:
+        report["top_allocators_hold"] = hold[-1]["top"]
+        report["top_allocators_after"] = settle[-1].get("top", [])
+    return report
+
+
+def read_samples(path: str) -> List[dict]:
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Hold many concurrent tunnels through one proxy process")
+    ap.add_argument("--kind", choices=KINDS, default="dcs", help="socks5_dcs or ppp_mux_server")
+    ap.add_argument("--tunnels", type=int, default=10000)
+    ap.add_argument("--trickle", type=float, default=0.09, help="fraction sending 32 B every second")
+    ap.add_argument("--bulk", type=float, default=0.01, help="fraction streaming 16 KiB echoes")
+    ap.add_argument("--duration", type=float, default=60.0, help="seconds to hold all tunnels open")
+    ap.add_argument("--settle", type=float, default=15.0, help="seconds to keep sampling after close")
+    ap.add_argument("--interval", type=float, default=1.0, help="sampling interval in the proxy")
+    ap.add_argument("--ramp-concurrency", type=int, default=100, help="tunnel opens in flight")
+    ap.add_argument("--no-tracemalloc", action="store_true",
+                    help="skip tracemalloc (it slows the proxy and inflates RSS)")
+    ap.add_argument("--samples", help="keep the raw JSON-lines samples here")
+    ap.add_argument("--json", help="write the report here")
+    args = ap.parse_args()
+
+    limit = raise_nofile()
+    if args.tunnels + 64 > limit:
+        print(f"warning: fd limit is {limit}; the load generator needs one fd per tunnel")
+
+    samples_path = args.samples or f"/tmp/soak-{os.getpid()}.jsonl"
+    if os.path.exists(samples_path):
+        os.remove(samples_path)
+    echo_port, proxy_port = free_port(), free_port()
+    procs = [spawn(SERVE_CODE.format(kind="echo", port=echo_port, samples=None, interval=0, trace=False))]
+    try:
+        wait_port(echo_port)
+        procs.append(spawn(SERVE_CODE.format(kind=args.kind, port=proxy_port, samples=samples_path,
+                                             interval=args.interval, trace=not args.no_tracemalloc)))
+        wait_port(proxy_port)
+        time.sleep(max(3 * args.interval, 2.0))  # baseline samples
+        load = asyncio.run(run_load(args.kind, proxy_port, echo_port, args))
+    finally:
+        stop(procs)
+
+    samples = read_samples(samples_path)
+    report = analyse(samples, load["phases"], load["counters"]["opened"])
+    report.update({"kind": args.kind, "errors": load["counters"]["errors"],
+                   "bytes_echoed": load["counters"]["bytes"]})
+
+    print(json.dumps({k: v for k, v in report.items() if not k.startswith("top_")}, indent=2))
+    for where, size, count in report.get("top_allocators_hold", []):
+        print(f"  {size / 1024:10.1f} KiB {count:8d}  {where}")
+    print("LEAKS: " + "; ".join(report["leaks"]) if report.get("leaks") else "no leaks detected")
+    if args.json:
+        report["samples"] = samples
+        write_results(args.json, {"benchmark": "soak", **report})
+    if not args.samples:
+        os.remove(samples_path)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
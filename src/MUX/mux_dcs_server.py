@@ -1,8 +1,23 @@
 import asyncio
+import os
 import struct
-from dataclasses import dataclass
+import sys
 from typing import Dict, Optional, Tuple
 
+# Shared modules live one level up in src/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import admin
+import fastopen
+import flow_log
+import mux_re
+import mux_sched
+import mux_trace
+import mux_wire
+import spans
+import splice
+import tls_link
+from target_pool import TargetPool
+
 # -----------------------
 # Minimal PPP framing
 # -----------------------
@@ -13,24 +28,42 @@ HDR_LEN = struct.calcsize(HDR_FMT)
 OPEN  = 1
 DATA  = 2
 CLOSE = 3
+PRIORITY = mux_wire.PRIORITY
+RE = mux_wire.RE
+RE_DATA = mux_wire.RE_DATA
+
+# Early DATA held per stream while its target connect is still in flight
+MAX_PENDING_BYTES = 256 * 1024
+# Target connects in flight at once (across all PPP connections)
+MAX_CONCURRENT_CONNECTS = 64
+connect_slots = asyncio.Semaphore(MAX_CONCURRENT_CONNECTS)
+# Co-located PPP: also accept on this Unix socket
+UNIX_PATH = os.environ.get("SOCKS_PROXY_MUX_UNIX", "")
 
-BUFFER = 64 * 1024
+# Pre-warmed target connections: (host, port) -> (min_idle, max_idle); others are learned
+POOL_ROUTES: Dict[Tuple[str, int], Tuple[int, int]] = {}
+target_pool = TargetPool(asyncio.open_connection, routes=POOL_ROUTES)
 
 
-@dataclass
 class StreamState:
-    reader: asyncio.StreamReader
-    writer: asyncio.StreamWriter
-    back_task: asyncio.Task
-    closed: bool = False
+    # target stays None until the connect completes; after that the stream runs on callbacks, no task
+    __slots__ = ("target", "task", "pending", "closed", "span", "re")
+
+    def __init__(self, span: spans.Span):
+        self.target: Optional[splice.Feed] = None
+        self.task: Optional[asyncio.Task] = None
+        self.pending = bytearray()
+        self.closed = False
+        self.span = span
+        self.re = False  # its RE offer was accepted: return data may go out as RE_DATA
 
 
 async def read_exact(r: asyncio.StreamReader, n: int) -> bytes:
     return await r.readexactly(n)
 
 
-async def read_frame(r: asyncio.StreamReader) -> Tuple[int, int, int, bytes]:
-    hdr = await read_exact(r, HDR_LEN)
+async def read_frame(r: asyncio.StreamReader, prefix: bytes = b"") -> Tuple[int, int, int, bytes]:
+    hdr = prefix + await read_exact(r, HDR_LEN - len(prefix))
     msg_type, priority, stream_id, payload_len = struct.unpack(HDR_FMT, hdr)
     payload = await read_exact(r, payload_len) if payload_len else b""
     return msg_type, priority, stream_id, payload
@@ -40,6 +73,24 @@ def encode_frame(msg_type: int, priority: int, stream_id: int, payload: bytes =
     return struct.pack(HDR_FMT, msg_type, priority, stream_id, len(payload)) + payload
 
 
+async def read_compact_frame(r: asyncio.StreamReader) -> Tuple[int, int, int, bytes]:
+    msg_type, _, priority, stream_id, payload = await mux_wire.read_frame(r)
+    return msg_type, max(priority, 0), stream_id, payload
+
+
+def encode_compact_frame(msg_type: int, priority: int, stream_id: int, payload: bytes = b"") -> bytes:
+    # Priority 0 is the default, so it costs no header byte
+    return mux_wire.encode_frame(msg_type, stream_id, payload, priority=priority or -1)
+
+
+def traced_encode(encode, trace: mux_trace.Recorder):
+    """encode_frame/encode_compact_frame that also records each frame as TX."""
+    def encode_traced(msg_type: int, priority: int, stream_id: int, payload: bytes = b"") -> bytes:
+        trace.tx(msg_type, stream_id, priority, payload)
+        return encode(msg_type, priority, stream_id, payload)
+    return encode_traced
+
+
 async def safe_send(writer: asyncio.StreamWriter, data: bytes) -> bool:
     """
     Return False if the connection is gone (prevents BrokenPipe noise).
@@ -56,40 +107,20 @@ async def safe_send(writer: asyncio.StreamWriter, data: bytes) -> bool:
         return False
 
 
-def parse_target(payload: bytes) -> Tuple[str, int]:
+def parse_target(payload: bytes) -> Tuple[str, int, bytes]:
     """
-    OPEN payload is ASCII: b"ip:port" or b"hostname:port"
+    OPEN payload is ASCII: b"ip:port" or b"hostname:port" (no trace context)
     """
     text = payload.decode("utf-8", errors="replace").strip()
     host, port_str = text.rsplit(":", 1)
-    return host, int(port_str)
+    return host, int(port_str), b""
 
 
-async def target_to_ppp(stream_id: int,
-                        target_reader: asyncio.StreamReader,
-                        ppp_writer: asyncio.StreamWriter):
+def parse_target_binary(payload: bytes) -> Tuple[str, int, bytes]:
     """
-    Reads bytes from the target socket and forwards them back to PPP as DATA frames.
-    Stops cleanly if PPP disconnects (no BrokenPipe).
+    OPEN payload after a HELLO with CAP_BINARY_ADDR: atyp + addr + port [+ trace context]
     """
-    try:
-        while True:
-            data = await target_reader.read(BUFFER)
-            if not data:
-                break
-
-            ok = await safe_send(ppp_writer, encode_frame(DATA, 0, stream_id, data))
-            if not ok:
-                return  # PPP connection is gone; stop quietly
-
-    except asyncio.CancelledError:
-        return
-    except Exception:
-        # In a spike/simple server, just stop.
-        return
-    finally:
-        # Try to send CLOSE (only if PPP still alive)
-        await safe_send(ppp_writer, encode_frame(CLOSE, 0, stream_id))
+    return mux_wire.unpack_open(payload)
 
 
 async def handle_ppp(ppp_reader: asyncio.StreamReader, ppp_writer: asyncio.StreamWriter):
@@ -97,6 +128,61 @@ async def handle_ppp(ppp_reader: asyncio.StreamReader, ppp_writer: asyncio.Strea
     print(f"[DCS] PPP connected: {peer}")
 
     streams: Dict[int, StreamState] = {}
+    # Return frames queue by the stream's PPP priority whenever the PPP link backs up
+    gate = mux_sched.PriorityGate(ppp_writer)
+    trace = mux_trace.recorder("mux_dcs", peer)
+    # The link's RE caches, from the first accepted offer on (shared by its RE streams)
+    re_link: Optional[mux_re.Session] = None
+
+    async def run_stream(stream_id: int, st: StreamState, host: str, port: int, priority: int):
+        try:
+            async with connect_slots:
+                tr, tw = await target_pool.acquire(host, port)
+        except Exception as e:
+            if streams.get(stream_id) is st:
+                streams.pop(stream_id, None)
+            st.closed = True
+            # Let PPP know it failed (optional); CLOSE is simplest
+            gate.send(stream_id, encode(CLOSE, 0, stream_id, b"open_failed"))
+            gate.close(stream_id)
+            print(f"[DCS] OPEN failed stream={stream_id}: {e} trace={st.span.tag}")
+            st.span.end(error=str(e))
+            return
+        if st.closed:
+            # PPP closed the stream while we were connecting
+            tw.close()
+            gate.close(stream_id)
+            return
+
+        st.span.mark("target_connect")
+        print(f"[DCS] OPEN stream={stream_id} -> {host}:{port} (PPP priority={priority}) trace={st.span.tag}")
+
+        # Optional: ACK OPEN (can help debugging)
+        gate.send(stream_id, encode(OPEN, 0, stream_id, b"ok"))
+
+        def on_data(data: bytes):
+            if st.re:
+                # Encoded when the gate writes it: the link-wide cache must move in wire order
+                gate.send_later(stream_id, lambda: encode(RE_DATA, 0, stream_id, re_link.encode(data)), len(data))
+            else:
+                gate.send(stream_id, encode(DATA, 0, stream_id, data))
+
+        def on_close():
+            # Send CLOSE only if PPP is still alive
+            if not ppp_writer.is_closing():
+                gate.send(stream_id, encode(CLOSE, 0, stream_id))
+            gate.close(stream_id)
+            st.span.end(up=feed.up, down=feed.down)
+
+        # Publish the target and flush early DATA in one step so ordering holds;
+        # from here the return path runs on callbacks and this task ends
+        st.target = feed = splice.feed(tr, tw, gate, on_data, on_close, flow_log.open_flow(peer, splice.label(host, port)))
+        gate.bind(stream_id, st.target)
+        admin.track("stream", splice.label(host, port), peer, st.target, lambda: gate.describe(stream_id))
+        st.task = None
+        if st.pending:
+            st.target.write(bytes(st.pending))
+        st.pending = bytearray()
 
     async def close_stream(stream_id: int):
         st = streams.get(stream_id)
@@ -104,61 +190,120 @@ async def handle_ppp(ppp_reader: asyncio.StreamReader, ppp_writer: asyncio.Strea
             return
         st.closed = True
 
-        # Stop back task first (prevents it writing after close)
-        st.back_task.cancel()
-        await asyncio.gather(st.back_task, return_exceptions=True)
+        if st.target is None:
+            # Still connecting: abandon the connect attempt
+            st.task.cancel()
+            gate.close(stream_id)
+            st.span.end(error="closed while connecting")
+            streams.pop(stream_id, None)
+            print(f"[DCS] stream closed: {stream_id}")
+            return
 
-        # Close target socket
-        try:
-            st.writer.close()
-            await st.writer.wait_closed()
-        except Exception:
-            pass
+        # Close target socket; the return path reports CLOSE from connection_lost
+        st.target.close()
 
         streams.pop(stream_id, None)
         print(f"[DCS] stream closed: {stream_id}")
 
     try:
+        # A PPP that opens with HELLO gets the compact header and binary OPEN targets
+        caps, prefix = await mux_wire.accept_hello(ppp_reader, ppp_writer)
+        if caps >= 0:
+            print(f"[DCS] HELLO from {peer}: compact framing, caps=0x{caps:02x}")
+            read, encode = read_compact_frame, encode_compact_frame
+            target_of = parse_target_binary if caps & mux_wire.CAP_BINARY_ADDR else parse_target
+        else:
+            read, encode, target_of = read_frame, encode_frame, parse_target
+        if trace:
+            encode = traced_encode(encode, trace)
+
         while True:
-            msg_type, priority, stream_id, payload = await read_frame(ppp_reader)
+            if prefix:
+                # First legacy frame: part of its header was consumed while probing for HELLO
+                msg_type, priority, stream_id, payload = await read_frame(ppp_reader, prefix)
+                prefix = b""
+            else:
+                msg_type, priority, stream_id, payload = await read(ppp_reader)
+            if trace and msg_type != OPEN:
+                trace.rx(msg_type, stream_id, priority, payload)
 
             if msg_type == OPEN:
-                # Create outbound connection for this stream_id
+                # Connect in the background; the frame loop keeps serving other streams
                 try:
-                    host, port = parse_target(payload)
-                    tr, tw = await asyncio.open_connection(host, port)
+                    host, port, context = target_of(payload)
+                    if trace:
+                        trace.open(mux_trace.RX, stream_id, host, port, priority)
                 except Exception as e:
-                    # Let PPP know it failed (optional); CLOSE is simplest
-                    await safe_send(ppp_writer, encode_frame(CLOSE, 0, stream_id, b"open_failed"))
+                    await safe_send(ppp_writer, encode(CLOSE, 0, stream_id, b"open_failed"))
                     print(f"[DCS] OPEN failed stream={stream_id}: {e}")
                     continue
 
-                # Start the return path task
-                back_task = asyncio.create_task(target_to_ppp(stream_id, tr, ppp_writer))
-                streams[stream_id] = StreamState(reader=tr, writer=tw, back_task=back_task)
+                st = StreamState(spans.start("mux_dcs.stream", context, stream=stream_id,
+                                             target=f"{host}:{port}", priority=priority))
+                streams[stream_id] = st
+                gate.open(stream_id, priority)
+                st.task = asyncio.create_task(run_stream(stream_id, st, host, port, priority))
 
-                print(f"[DCS] OPEN stream={stream_id} -> {host}:{port} (PPP priority={priority})")
-
-                # Optional: ACK OPEN (can help debugging)
-                await safe_send(ppp_writer, encode_frame(OPEN, 0, stream_id, b"ok"))
-
-            elif msg_type == DATA:
+            elif msg_type == DATA or msg_type == RE_DATA:
                 st = streams.get(stream_id)
+                if msg_type == RE_DATA:
+                    # Decoded even for a stream that is gone, to keep the link cache in step
+                    try:
+                        if re_link is None:
+                            raise mux_re.Desync("RE_DATA before RE")
+                        payload = re_link.decode(payload)
+                    except mux_re.Desync as e:
+                        print(f"[DCS] RE stream={stream_id}: {e}")
+                        if st and not st.closed:
+                            await close_stream(stream_id)
+                            gate.send(stream_id, encode(CLOSE, 0, stream_id, b"re_desync"))
+                            gate.close(stream_id)
+                        continue
                 if not st or st.closed:
                     # Unknown stream; ignore (or CLOSE back)
                     continue
 
+                if st.target is None:
+                    # Target not connected yet: buffer up to the limit
+                    if len(st.pending) + len(payload) > MAX_PENDING_BYTES:
+                        await close_stream(stream_id)
+                        gate.send(stream_id, encode(CLOSE, 0, stream_id, b"pending_overflow"))
+                        gate.close(stream_id)
+                    else:
+                        st.pending += payload
+                    continue
+
                 try:
-                    st.writer.write(payload)
-                    await st.writer.drain()
+                    st.target.write(payload)
+                    await st.target.drain()
                 except Exception:
                     # If target write fails, close stream and notify PPP
                     await close_stream(stream_id)
-                    await safe_send(ppp_writer, encode_frame(CLOSE, 0, stream_id, b"target_write_failed"))
+                    gate.send(stream_id, encode(CLOSE, 0, stream_id, b"target_write_failed"))
 
             elif msg_type == CLOSE:
                 await close_stream(stream_id)
 
+            elif msg_type == PRIORITY:
+                # Re-class a live stream; return frames it already has queued move with it
+                prio, weight = mux_wire.decode_priority(payload)
+                if stream_id in streams:
+                    gate.queues.reprioritize(stream_id, prio, weight)
+                    print(f"[DCS] PRIORITY stream={stream_id} -> {prio} (weight {weight})")
+
+            elif msg_type == RE:
+                # Redundancy elimination offer: answer with the agreed cache size, or stay silent
+                st = streams.get(stream_id)
+                if st and not st.closed and not st.re:
+                    kb = mux_re.accept(payload, re_link)
+                    if kb:
+                        if re_link is None:
+                            re_link = mux_re.Session(kb)
+                            print(f"[DCS] RE on link {peer}: {kb} KiB cache")
+                        st.re = True
+                        gate.send(stream_id, encode(RE, 0, stream_id, mux_re.encode_offer(kb)))
+                        print(f"[DCS] RE stream={stream_id}")
+
             else:
                 # Unknown message type - ignore for simplicity
                 pass
@@ -166,11 +311,15 @@ async def handle_ppp(ppp_reader: asyncio.StreamReader, ppp_writer: asyncio.Strea
     except asyncio.IncompleteReadError:
         # PPP disconnected
         print(f"[DCS] PPP disconnected: {peer}")
+    except (ValueError, mux_wire.HelloError) as e:
+        print(f"[DCS] protocol error from {peer}: {e}")
 
     finally:
         # Clean up all streams BEFORE closing PPP writer
         for sid in list(streams.keys()):
             await close_stream(sid)
+        if trace:
+            trace.close()
 
         # Now close the PPP writer (don't let errors bubble)
         try:
@@ -182,12 +331,31 @@ async def handle_ppp(ppp_reader: asyncio.StreamReader, ppp_writer: asyncio.Strea
             pass
 
 
-async def main(host: str = "127.0.0.1", port: int = 9000):
-    server = await asyncio.start_server(handle_ppp, host, port)
+admin.command("trace", mux_trace.configure)
+admin.stats_source("target_pool", target_pool.stats)
+admin.stats_source("spans", spans.stats)
+admin.stats_source("re", mux_re.stats)
+
+
+async def main(host: str = "127.0.0.1", port: int = 9000, unix_path: str = ""):
+    unix_path = unix_path or UNIX_PATH
+    server = await asyncio.start_server(handle_ppp, host, port, ssl=tls_link.server_context())
+    fastopen.listen(server)
+    unix_server = None
+    if unix_path:
+        unix_server = await tls_link.start_unix_server(handle_ppp, unix_path, tls_link.server_context())
+        print(f"[DCS] mux server also listening on {unix_path}")
+    target_pool.start()
+    flow_log.start("mux_dcs")
+    spans.start_export("mux_dcs")
+    await admin.start("mux_dcs")
     addrs = ", ".join(str(s.getsockname()) for s in server.sockets or [])
     print(f"[DCS] mux server listening on {addrs}")
-    async with server:
-        await server.serve_forever()
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        tls_link.close_unix_server(unix_server, unix_path)
 
 
 if __name__ == "__main__":
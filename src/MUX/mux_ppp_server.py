@@ -1,6 +1,20 @@
 import asyncio
+import os
+import socket
 import struct
+import sys
+import time
 from collections import deque
+from typing import Optional
+
+# Shared modules live one level up in src/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import admin
+import mux_re
+import mux_sched
+import mux_wire
+import spans
+import tls_link
 
 # Header: type(1) priority(1) stream_id(2) payload_len(4)
 HDR_FMT = "!BBHI"
@@ -9,6 +23,12 @@ HDR_LEN = struct.calcsize(HDR_FMT)
 OPEN  = 1
 DATA  = 2
 CLOSE = 3
+PRIORITY = mux_wire.PRIORITY
+RE = mux_wire.RE
+RE_DATA = mux_wire.RE_DATA
+
+# Negotiate the compact header with HELLO; set False to talk to an old DCS
+USE_COMPACT = True
 
 def encode_frame(msg_type: int, priority: int, stream_id: int, payload: bytes = b"") -> bytes:
     return struct.pack(HDR_FMT, msg_type, priority, stream_id, len(payload)) + payload
@@ -22,56 +42,435 @@ async def read_frame(r: asyncio.StreamReader):
     payload = await read_exact(r, payload_len) if payload_len else b""
     return msg_type, priority, stream_id, payload
 
+def encode_compact_frame(msg_type: int, priority: int, stream_id: int, payload: bytes = b"") -> bytes:
+    return mux_wire.encode_frame(msg_type, stream_id, payload, priority=priority or -1)
+
+async def read_compact_frame(r: asyncio.StreamReader):
+    msg_type, _, priority, stream_id, payload = await mux_wire.read_frame(r)
+    return msg_type, max(priority, 0), stream_id, payload
+
+def encode_frame_header(msg_type: int, priority: int, stream_id: int, length: int) -> bytes:
+    return struct.pack(HDR_FMT, msg_type, priority, stream_id, length)
+
+def encode_compact_header(msg_type: int, priority: int, stream_id: int, length: int) -> bytes:
+    return mux_wire.encode_header(msg_type, stream_id, length, priority=priority or -1)
+
+# Header-only twin of each frame encoder, for frames built in place (PPP.pump)
+FRAME_HEADERS = {encode_frame: encode_frame_header, encode_compact_frame: encode_compact_header}
+HEADER_ROOM = mux_wire.MAX_HEADER  # also covers HDR_LEN
+
+
+# Stream classes, chosen when the stream is opened
+RELIABLE    = 0  # lossless FIFO: every frame is sent, however late
+DEADLINE    = 1  # DATA older than max_age is dropped instead of sent (video)
+KEEP_LATEST = 2  # a new DATA frame supersedes the queued one (telemetry); max_age also applies
+
+# Connection-level frames (not tied to a stream) queue here, at the top priority
+CONTROL_STREAM = -1
+
+# Queued.kind
+FRAME   = 0  # DATA: the stream's class applies
+CONTROL = 1  # CLOSE, PRIORITY: always delivered
+OPENING = 2  # the stream's OPEN: always delivered
+
+
+class Queued:
+    # frame is a view into buf when it was built in a pooled buffer (PPP.pump);
+    # charged is the budget class the bytes count against (-1 once released);
+    # data is a DATA frame's payload, sent as RE_DATA instead if its stream has RE by then
+    __slots__ = ("stream_id", "enqueued_at", "frame", "live", "kind", "buf", "charged", "data")
+
+    def __init__(self, stream_id: int, enqueued_at: float, frame, kind: int = FRAME):
+        self.stream_id = stream_id
+        self.enqueued_at = enqueued_at
+        self.frame = frame
+        self.live = True
+        self.kind = kind
+        self.buf: Optional[bytearray] = None
+        self.charged = -1
+        self.data = None
+
 
 class PPP:
     """
     PPP keeps priority queues and decides what to send next over ONE TCP tunnel.
-    Priority 7 = highest, 0 = lowest
+    Priority 7 = highest, 0 = lowest. Each stream has its own FIFO inside its
+    priority level (mux_sched.StreamQueues), so reprioritize() can move a live
+    stream without reordering what it already queued.
+
+    Queued bytes are bounded by a mux_sched.QueueBudget: enqueue() waits while the
+    stream, its class or the whole PPP is at quota. A frame counts until the
+    transport has handed it to the kernel, not just until it was written. pump()
+    receives straight into pooled buffers, reused once the link has flushed them.
+
+    Streams may offer redundancy elimination (mux_re) at open; once the DCS answers,
+    their DATA goes out as RE_DATA, encoded by scheduler_loop as it writes the frame
+    so the link-wide cache moves in wire order.
     """
-    def __init__(self, writer: asyncio.StreamWriter):
+    def __init__(self, writer: asyncio.StreamWriter, encode=encode_frame,
+                 budget: Optional[mux_sched.QueueBudget] = None):
         self.writer = writer
-        self.queues = {p: deque() for p in range(8)}  # 0..7
+        self.encode = encode
+        self.queues = mux_sched.StreamQueues()
+        self.queues.stream(CONTROL_STREAM, 7)
+        # Streams whose OPEN is still queued
+        self.unopened = set()
         self.running = True
 
+        self.budget = budget or mux_sched.QueueBudget()
+        self.pool = mux_sched.BufferPool()
+        self.header = FRAME_HEADERS.get(encode)
+        # Bytes ever written to the link, and (end offset, entry) of frames it may still hold
+        self.written = 0
+        self.in_flight = deque()
+
+        # stream_id -> (kind, max_age); streams not listed are RELIABLE
+        self.stream_class = {}
+        # KEEP_LATEST: stream_id -> its DATA entry still waiting in a queue
+        self.latest = {}
+        self.dropped_expired = 0
+        self.dropped_superseded = 0
+
         # simple "bandwidth shaping": bytes per tick
         # pretend link is constrained; change this number to see effect
         self.bytes_per_tick = 200
+        # Bytes a frame larger than a whole tick borrowed from the ticks after it
+        self.overdraft = 0
+        # priority -> most bytes that class may send per tick; classes not listed share the link
+        self.class_rate = {}
+
+        # Redundancy elimination: the link's caches (from the first answer on),
+        # streams that offered it, and those the DCS accepted
+        self.re: Optional[mux_re.Session] = None
+        self.re_offered = set()
+        self.re_streams = set()
+
+    def open_stream(self, stream_id: int, priority: int, open_frame: bytes, kind: int = RELIABLE, max_age: float = 0.0,
+                    weight: int = mux_sched.DEFAULT_WEIGHT, re: bool = False):
+        """
+        Register the stream's class and queue its OPEN (which is never dropped).
+        max_age is in seconds; 0 means no deadline. re offers redundancy elimination.
+        """
+        if kind != RELIABLE:
+            self.stream_class[stream_id] = (kind, max_age)
+        self.queues.reprioritize(stream_id, priority, weight)
+        self.unopened.add(stream_id)
+        self._push(priority, open_frame, stream_id, OPENING)
+        offer = mux_re.offer() if re else b""
+        if offer:
+            self.re_offered.add(stream_id)
+            self.enqueue_control(self.encode(RE, 7, stream_id, offer), stream_id, priority)
+
+    def re_answered(self, stream_id: int, body: bytes):
+        """The DCS accepted our RE offer: from now on both directions may use it."""
+        kb = mux_re.decode_offer(body)
+        if kb and stream_id in self.re_offered:
+            if self.re is None:
+                self.re = mux_re.Session(kb)
+            self.re_streams.add(stream_id)
+
+    def data_received(self, msg_type: int, stream_id: int, payload: bytes) -> bytes:
+        """
+        The bytes of a DATA or RE_DATA frame from the DCS; raises mux_re.Desync on a bad
+        RE_DATA. Every RE_DATA read must come through here, whatever its stream's state.
+        """
+        if msg_type != RE_DATA:
+            return payload
+        if self.re is None:
+            raise mux_re.Desync("RE_DATA before RE")
+        return self.re.decode(payload)
+
+    def close_stream(self, stream_id: int):
+        self.re_offered.discard(stream_id)
+        self.re_streams.discard(stream_id)
+        self.stream_class.pop(stream_id, None)
+        self.latest.pop(stream_id, None)
+        self.unopened.discard(stream_id)
+        self.queues.finish(stream_id)
+
+    async def enqueue(self, priority: int, frame: bytes, stream_id: int = CONTROL_STREAM):
+        """
+        Queue a DATA frame behind the stream's earlier ones, waiting first while the
+        queue budget has no room for it. priority only places a stream's first frame;
+        after that the stream's current priority (see reprioritize) wins.
+        """
+        if stream_id == CONTROL_STREAM:
+            self.enqueue_control(frame)
+            return
+        await self.budget.reserve(stream_id, self._class_of(stream_id, priority), len(frame))
+        self._push(priority, frame, stream_id, FRAME, charged=True)
 
-    def enqueue(self, priority: int, frame: bytes):
-        priority = max(0, min(7, priority))
-        self.queues[priority].append(frame)
+    async def enqueue_data(self, priority: int, stream_id: int, data: bytes):
+        """enqueue() data as a DATA frame, which goes out as RE_DATA if the stream has RE when it is sent."""
+        frame = self.encode(DATA, priority, stream_id, data)
+        await self.budget.reserve(stream_id, self._class_of(stream_id, priority), len(frame))
+        self._push(priority, frame, stream_id, FRAME, charged=True, data=data)
+
+    def enqueue_control(self, frame: bytes, stream_id: int = CONTROL_STREAM, priority: int = 7):
+        """
+        Queue a frame that is always delivered and never waits: a stream's CLOSE, or
+        (without stream_id) connection-level control. Its bytes still count as used.
+        """
+        self._push(priority, frame, stream_id, CONTROL)
+
+    async def pump(self, stream_id: int, priority: int, sock: socket.socket, chunk: int = 16 * 1024 - HEADER_ROOM):
+        """
+        Send everything read from sock (non-blocking, not otherwise used by the loop)
+        as DATA on stream_id. Bytes are received straight into a pooled buffer behind
+        room for the frame header, so the frame is built where the data landed. While
+        the budget is full nothing is read, so the socket's receive window closes.
+        Each read is also kept to what one tick of the link (and the stream's class
+        rate) can send, so no frame has to wait on borrowed ticks.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            size = min(chunk, self._max_payload(stream_id, priority))
+            buf = self.pool.get(HEADER_ROOM + size)
+            pooled = buf is not None
+            if not pooled:
+                buf = bytearray(HEADER_ROOM + size)  # beyond the pooled sizes
+            n = await loop.sock_recv_into(sock, memoryview(buf)[HEADER_ROOM:HEADER_ROOM + size])
+            if not n:
+                if pooled:
+                    self.pool.put(buf)
+                return
+            if self.header is None:
+                # A custom encoder builds its own frame
+                data = bytes(buf[HEADER_ROOM:HEADER_ROOM + n])
+                if pooled:
+                    self.pool.put(buf)
+                await self.enqueue_data(priority, stream_id, data)
+                continue
+            hdr = self.header(DATA, priority, stream_id, n)
+            start = HEADER_ROOM - len(hdr)
+            buf[start:HEADER_ROOM] = hdr
+            await self.budget.reserve(stream_id, self._class_of(stream_id, priority), len(hdr) + n)
+            view = memoryview(buf)
+            self._push(priority, view[start:HEADER_ROOM + n], stream_id, FRAME, charged=True,
+                       buf=buf if pooled else None, data=view[HEADER_ROOM:HEADER_ROOM + n])
+
+    def _max_payload(self, stream_id: int, priority: int) -> int:
+        """Largest DATA payload whose frame fits one tick of the link and of the stream's class."""
+        room = self.bytes_per_tick
+        rate = self.class_rate.get(self._class_of(stream_id, priority))
+        if rate is not None:
+            room = min(room, rate)
+        return max(1, room - HEADER_ROOM)
+
+    def _class_of(self, stream_id: int, priority: int) -> int:
+        s = self.queues.streams.get(stream_id)
+        return s.priority if s is not None else max(0, min(7, priority))
+
+    def _push(self, priority: int, frame, stream_id: int, kind: int, charged: bool = False,
+              buf: Optional[bytearray] = None, data=None):
+        size = len(frame)
+        entry = Queued(stream_id, time.monotonic(), frame, kind)
+        entry.buf = buf
+        entry.data = data
+        entry.charged = self._class_of(stream_id, priority)
+        if not charged:
+            self.budget.charge(stream_id, entry.charged, size)
+        cls = self.stream_class.get(stream_id)
+        if kind == FRAME and cls and cls[0] == KEEP_LATEST:
+            prev = self.latest.get(stream_id)
+            if prev is not None and prev.live:
+                prev.live = False
+                self.dropped_superseded += 1
+                self._discard(prev)
+            self.latest[stream_id] = entry
+        self.queues.push(stream_id, entry, size, priority)
+
+    def _discard(self, entry: Queued):
+        """Give back the budget and buffer of a frame that was flushed or will not be sent."""
+        if entry.charged >= 0:
+            self.budget.release(entry.stream_id, entry.charged, len(entry.frame))
+            entry.charged = -1
+        if entry.buf is not None:
+            entry.frame.release()
+            entry.data.release()
+            self.pool.put(entry.buf)
+            entry.buf = None
+        entry.data = None
+
+    def reprioritize(self, stream_id: int, priority: int, weight: int = mux_sched.DEFAULT_WEIGHT):
+        """
+        Move a live stream, with everything it has queued, to another priority and
+        weight, and send PRIORITY so the DCS schedules its return frames the same way.
+        """
+        self.queues.reprioritize(stream_id, priority, weight)
+        frame = self.encode(PRIORITY, 7, stream_id, mux_wire.encode_priority(priority, weight))
+        if stream_id in self.unopened:
+            # Must not overtake the OPEN: ride in the stream's own queue, right behind it
+            self.enqueue_control(frame, stream_id, priority)
+        else:
+            self.enqueue_control(frame)
+
+    def _expired(self, entry: Queued, now: float) -> bool:
+        if entry.kind != FRAME:
+            return False
+        cls = self.stream_class.get(entry.stream_id)
+        return bool(cls and cls[1] and now - entry.enqueued_at > cls[1])
 
     async def scheduler_loop(self):
         """
         Each tick, we can send only bytes_per_tick bytes.
-        We always drain higher priority queues first.
+        We always drain higher priority queues first; streams sharing a priority
+        take turns in proportion to their weight.
+        Superseded and expired real-time frames are discarded instead of spending budget.
+        A frame larger than a whole tick (or its class rate) still goes out, as the
+        first of its tick (or of its class in the tick), and the link ticks after it
+        pay it back.
         """
         while self.running:
-            budget = self.bytes_per_tick
+            budget = self.bytes_per_tick - self.overdraft
+            self.overdraft = max(0, self.overdraft - self.bytes_per_tick)
+            now = time.monotonic()
+            spent = {}     # priority -> bytes sent this tick
+            capped = set() # classes that used up their class_rate this tick
+
+            while budget > 0:
+                got = self.queues.pop(capped)
+                if got is None:
+                    break
+                sid, entry, size, prio = got
+                if not entry.live:
+                    continue
+                if self._expired(entry, now):
+                    entry.live = False
+                    self.dropped_expired += 1
+                    self._discard(entry)
+                    continue
 
-            for prio in range(7, -1, -1):  # 7 -> 0
-                while self.queues[prio] and budget > 0:
-                    frame = self.queues[prio][0]
-                    if len(frame) > budget:
-                        # Not enough budget this tick; wait for next tick.
-                        break
+                rate = self.class_rate.get(prio)
+                if rate is not None and spent.get(prio, 0) and spent[prio] + size > rate:
+                    # The class is at its rate; lower classes may still use the tick
+                    self.queues.unpop(sid, entry, size, prio)
+                    capped.add(prio)
+                    continue
+                if size > budget and budget < self.bytes_per_tick:
+                    # Not enough budget this tick; it stays first in line for the next.
+                    self.queues.unpop(sid, entry, size, prio)
+                    break
 
-                    self.queues[prio].popleft()
-                    self.writer.write(frame)
-                    budget -= len(frame)
+                entry.live = False
+                if entry.kind == OPENING:
+                    self.unopened.discard(sid)
+                frame = entry.frame
+                if entry.data is not None and sid in self.re_streams:
+                    # Encoded now, in wire order, as the DCS will decode it
+                    frame = self.encode(RE_DATA, prio, sid, self.re.encode(entry.data))
+                    size = len(frame)
+                self.writer.write(frame)
+                self.written += size
+                if size > budget:
+                    # Larger than a whole tick: sent anyway, the next ticks are short by the rest
+                    self.overdraft = size - budget
+                budget -= size
+                spent[prio] = spent.get(prio, 0) + size
+                # Budget and buffer come back once the transport has flushed it (_reclaim)
+                self.in_flight.append((self.written, entry))
 
             await self.writer.drain()
+            self._reclaim()
 
             # tick interval = how often we schedule sends
             await asyncio.sleep(0.05)
 
+    def _reclaim(self):
+        """
+        Release frames the transport has passed on to the kernel. It sends in order,
+        so everything up to written minus what it still buffers is gone; until then
+        it may hold a reference to the frame's buffer.
+        """
+        flushed = self.written - self.writer.transport.get_write_buffer_size()
+        while self.in_flight and self.in_flight[0][0] <= flushed:
+            self._discard(self.in_flight.popleft()[1])
+
     def set_link_bandwidth(self, bytes_per_tick: int):
         self.bytes_per_tick = max(50, bytes_per_tick)
 
+    def set_class_rate(self, priority: int, bytes_per_tick: int = 0):
+        """Cap one priority class at bytes_per_tick; 0 removes the cap."""
+        if bytes_per_tick:
+            self.class_rate[priority] = bytes_per_tick
+        else:
+            self.class_rate.pop(priority, None)
+
+    def stats(self) -> dict:
+        streams = {}
+        for sid, s in self.queues.streams.items():
+            frames, nbytes = self.queues.depth(sid)
+            cls = self.stream_class.get(sid, (RELIABLE, 0.0))
+            streams[sid] = {"priority": s.priority, "weight": s.weight, "kind": cls[0], "max_age": cls[1],
+                            "queued_frames": frames, "queued": nbytes, "opened": sid not in self.unopened,
+                            "re": sid in self.re_streams}
+        return {"bytes_per_tick": self.bytes_per_tick, "class_rate": self.class_rate,
+                "queued_frames": self.queues.frames, "queued": self.queues.bytes,
+                "dropped_expired": self.dropped_expired, "dropped_superseded": self.dropped_superseded,
+                "memory": dict(self.budget.stats(), in_flight=len(self.in_flight),
+                               unflushed=self.writer.transport.get_write_buffer_size(), pool=self.pool.stats()),
+                "re": mux_re.stats(), "streams": streams}
+
+    def register_admin(self):
+        """Admin socket commands for this tunnel: bandwidth, class rates, priorities, closing streams."""
+        def bandwidth(bytes_per_tick: int) -> dict:
+            self.set_link_bandwidth(int(bytes_per_tick))
+            return {"bytes_per_tick": self.bytes_per_tick}
+
+        def class_rate(priority: int, bytes_per_tick: int = 0) -> dict:
+            self.set_class_rate(int(priority), int(bytes_per_tick))
+            return self.class_rate
+
+        def priority(stream: int, priority: int, weight: int = mux_sched.DEFAULT_WEIGHT) -> dict:
+            stream = int(stream)
+            if stream not in self.queues.streams:
+                raise KeyError(f"no stream {stream}")
+            self.reprioritize(stream, int(priority), int(weight))
+            return self.stats()["streams"][stream]
+
+        def close_stream(stream: int) -> dict:
+            stream = int(stream)
+            if stream not in self.queues.streams:
+                raise KeyError(f"no stream {stream}")
+            self.enqueue_control(self.encode(CLOSE, 7, stream), stream)
+            self.close_stream(stream)
+            return {"closed": stream}
 
-async def main():
-    r, w = await asyncio.open_connection("127.0.0.1", 9000)
-    ppp = PPP(w)
+        admin.command("bandwidth", bandwidth)
+        admin.command("class_rate", class_rate)
+        admin.command("priority", priority)
+        admin.command("close_stream", close_stream)
+        admin.command("streams", lambda: self.stats()["streams"])
+        admin.stats_source("ppp", self.stats)
+
+
+async def main(host: str = "127.0.0.1", port: int = 9000):
+    # One long-lived (optionally TLS) connection carries every stream; host may be a Unix socket path
+    r, w = await tls_link.open_connection(host, port, "mux")
+
+    encode, read = encode_frame, read_frame
+    caps = 0
+    if USE_COMPACT:
+        caps = await mux_wire.client_hello(r, w)
+        tls_link.remember(w)  # resume instead of a full handshake if we have to reconnect
+        print(f"[PPP] HELLO: compact framing, caps=0x{caps:02x}")
+        encode, read = encode_compact_frame, read_compact_frame
+
+    # Each stream starts a trace; the DCS continues it when the OPEN can carry the context
+    stream_spans = {}
+
+    def open_target(stream_id: int) -> bytes:
+        sp = stream_spans[stream_id] = spans.start("mux_ppp.stream", stream=stream_id, target="127.0.0.1:7777")
+        if not caps & mux_wire.CAP_BINARY_ADDR:
+            return b"127.0.0.1:7777"
+        return mux_wire.pack_open("127.0.0.1", 7777, sp.context() if caps & mux_wire.CAP_TRACE else b"")
+
+    ppp = PPP(w, encode)
+    ppp.register_admin()
+    admin.stats_source("spans", spans.stats)
+    admin.stats_source("re", mux_re.stats)
+    spans.start_export("mux_ppp")
+    await admin.start("mux_ppp")
 
     # Start scheduler
     sched_task = asyncio.create_task(ppp.scheduler_loop())
@@ -81,29 +480,41 @@ async def main():
     # Stream 2 = LOW priority (bulk)
     STREAM_HIGH = 1
     STREAM_LOW  = 2
-    target = b"127.0.0.1:7777"
 
-    # OPEN both streams
-    ppp.enqueue(7, encode_frame(OPEN, priority=7, stream_id=STREAM_HIGH, payload=target))
-    ppp.enqueue(1, encode_frame(OPEN, priority=1, stream_id=STREAM_LOW,  payload=target))
+    # OPEN both streams: telemetry only needs its newest reading, bulk must arrive intact
+    ppp.open_stream(STREAM_HIGH, 7, encode(OPEN, priority=7, stream_id=STREAM_HIGH, payload=open_target(STREAM_HIGH)),
+                    kind=KEEP_LATEST, max_age=0.5)
+    # Bulk reports repeat most of their bytes: offer redundancy elimination (SOCKS_PROXY_RE_KB)
+    ppp.open_stream(STREAM_LOW, 1, encode(OPEN, priority=1, stream_id=STREAM_LOW, payload=open_target(STREAM_LOW)),
+                    re=True)
 
     # Enqueue data: High priority sends short messages more frequently.
     async def produce_high():
         i = 0
         while i < 20:
             msg = f"HIGH-{i}\n".encode()
-            ppp.enqueue(7, encode_frame(DATA, priority=7, stream_id=STREAM_HIGH, payload=msg))
+            await ppp.enqueue(7, encode(DATA, priority=7, stream_id=STREAM_HIGH, payload=msg), stream_id=STREAM_HIGH)
             i += 1
             await asyncio.sleep(0.10)
 
     async def produce_low():
         i = 0
+        # Same fields every time, counter last: the leading chunk repeats (frames stay under bytes_per_tick)
+        report = "".join(f"field-{k}={k * 7919 % 1000:03d};" for k in range(6))
         while i < 10:
-            msg = (f"low-bulk-{i} " + ("X" * 80) + "\n").encode()
-            ppp.enqueue(1, encode_frame(DATA, priority=1, stream_id=STREAM_LOW, payload=msg))
+            msg = (report + f" low-bulk-{i}\n").encode()
+            await ppp.enqueue_data(1, STREAM_LOW, msg)
             i += 1
             await asyncio.sleep(0.15)
 
+    # An operator waiting on the bulk transfer promotes it; the telemetry it
+    # overtakes keeps its newest reading, the bulk bytes keep their order
+    async def promote_bulk():
+        await asyncio.sleep(0.8)
+        print("[PPP] bulk stream promoted above telemetry")
+        ppp.reprioritize(STREAM_LOW, 7, weight=64)
+        ppp.reprioritize(STREAM_HIGH, 6)
+
     # Simulate bandwidth changing (like degraded network)
     async def bandwidth_changes():
         # Start "okay"
@@ -121,9 +532,18 @@ async def main():
     async def read_replies():
         try:
             while True:
-                msg_type, prio, sid, payload = await read_frame(r)
-                if msg_type == DATA:
-                    print(f"[PPP] RX stream={sid}: {payload!r}")
+                msg_type, prio, sid, payload = await read(r)
+                if msg_type == DATA or msg_type == RE_DATA:
+                    try:
+                        payload = ppp.data_received(msg_type, sid, payload)
+                    except mux_re.Desync as e:
+                        print(f"[PPP] RE stream={sid}: {e}, closing it")
+                        ppp.enqueue_control(encode(CLOSE, priority=7, stream_id=sid), sid)
+                        continue
+                    print(f"[PPP] RX stream={sid}: {payload[:60]!r}")
+                elif msg_type == RE:
+                    ppp.re_answered(sid, payload)
+                    print(f"[PPP] RE accepted on stream={sid}")
                 elif msg_type == CLOSE:
                     print(f"[PPP] RX CLOSE stream={sid}")
         except asyncio.IncompleteReadError:
@@ -132,14 +552,22 @@ async def main():
     await asyncio.gather(
         produce_high(),
         produce_low(),
+        promote_bulk(),
         bandwidth_changes(),
         read_replies(),
     )
 
     # Close streams
-    ppp.enqueue(7, encode_frame(CLOSE, priority=7, stream_id=STREAM_HIGH))
-    ppp.enqueue(1, encode_frame(CLOSE, priority=1, stream_id=STREAM_LOW))
+    ppp.enqueue_control(encode(CLOSE, priority=7, stream_id=STREAM_HIGH), STREAM_HIGH)
+    ppp.enqueue_control(encode(CLOSE, priority=1, stream_id=STREAM_LOW), STREAM_LOW)
     await asyncio.sleep(0.2)
+    ppp.close_stream(STREAM_HIGH)
+    ppp.close_stream(STREAM_LOW)
+    for sp in stream_spans.values():
+        sp.end()
+    print(f"[PPP] dropped: expired={ppp.dropped_expired} superseded={ppp.dropped_superseded}")
+    re = mux_re.stats()
+    print(f"[PPP] RE: saved {re['bytes_saved']} of {re['bytes_in']} bytes, chunk hit rate {re['hit_rate']}")
 
     ppp.running = False
     sched_task.cancel()
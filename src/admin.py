@@ -0,0 +1,252 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import socket
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import fastopen
+import flow_log
+import instrument
+import tls_link
+
+# -----------------------
+# Admin control socket
+# -----------------------
+# Off unless SOCKS_PROXY_ADMIN_DIR is set. Each server process then listens on
+#   <dir>/<component>-<pid>.sock   (mode tls_link.UNIX_MODE)
+# for JSON lines: one request object per line in, one reply per line out.
+#   {"cmd": "help"}                  commands this process knows
+#   {"cmd": "stats"}                 every registered stats source
+#   {"cmd": "conns"}                 live tunnels / mux streams: bytes, age, priority, queued
+#   {"cmd": "close", "id": 17}       close one of them
+#   {"cmd": "instrument", "on": true}
+# Replies are {"ok": true, "result": ...} or {"ok": false, "error": "..."}.
+# Servers add their own commands (link bandwidth, routes, tracing, ...) with command().
+#
+#   python admin.py <dir>/ppp-1234.sock conns
+#   python admin.py <dir>/ppp-1234.sock override src=198.18.0.1:8000 dst=192.168.1.109:8000
+#
+# track() lists a splice.Tunnel or splice.Feed under "conns" until it ends. It returns
+# None and costs nothing when the socket is off, like flow_log.open_flow.
+
+ADMIN_DIR = os.environ.get("SOCKS_PROXY_ADMIN_DIR", "")
+ENABLED = bool(ADMIN_DIR)
+
+MAX_CONNS_LISTED = 1000   # "conns" default limit
+
+Command = Callable[..., Any]  # keyword arguments from the request; may return an awaitable
+
+
+class Conn:
+    """A live tunnel or mux stream; source is the Tunnel or Feed whose counters it reports."""
+    __slots__ = ("id", "kind", "label", "peer", "started", "source", "closer", "info")
+
+    def __init__(self, kind: str, label: str, peer, source, closer: Callable[[], None],
+                 info: Optional[Callable[[], dict]]):
+        self.id = next(_ids)
+        self.kind = kind
+        self.label = label
+        self.peer = peer
+        self.started = time.monotonic()
+        self.source = source
+        self.closer = closer
+        self.info = info
+
+    def describe(self, now: float) -> dict:
+        src = self.source
+        d = {"id": self.id, "kind": self.kind, "label": self.label, "peer": _peer(self.peer),
+             "age_s": round(now - self.started, 1), "up": src.up, "down": src.down}
+        if self.info is not None:
+            d.update(self.info())
+        return d
+
+
+_ids = itertools.count(1)
+_conns: Dict[int, Conn] = {}
+_commands: Dict[str, Command] = {}
+_stats: Dict[str, Callable[[], Any]] = {}
+_component = ""
+_server: Optional[asyncio.AbstractServer] = None
+
+
+def _peer(peer) -> str:
+    if isinstance(peer, tuple):
+        return f"{peer[0]}:{peer[1]}"
+    return str(peer or "")
+
+
+def track(kind: str, label: str, peer, source, info: Optional[Callable[[], dict]] = None,
+          close: Optional[Callable[[], None]] = None) -> Optional[Conn]:
+    """
+    List source (a splice.Tunnel or splice.Feed) until it ends. info() adds fields to its
+    "conns" entry (priority, queued bytes, ...); close defaults to source.close.
+    """
+    if not ENABLED or source.closed:
+        return None
+    conn = Conn(kind, label, peer, source, close or source.close, info)
+    _conns[conn.id] = conn
+    on_close = source.on_close
+
+    def closed(*args):
+        _conns.pop(conn.id, None)
+        if on_close:
+            on_close(*args)
+
+    source.on_close = closed
+    return conn
+
+
+def command(name: str, fn: Command):
+    """Add (or replace) a command; fn gets the request's other fields as keyword arguments."""
+    _commands[name] = fn
+
+
+def stats_source(name: str, fn: Callable[[], Any]):
+    """Add a section to the "stats" reply."""
+    _stats[name] = fn
+
+
+def endpoint(text: str) -> tuple:
+    """ "host:port" -> (host, port); a path stays a path, for Unix socket members."""
+    if text.startswith("/"):
+        return text, 0
+    host, port = text.rsplit(":", 1)
+    return host.strip("[]"), int(port)
+
+
+# -----------------------
+# Built-in commands
+# -----------------------
+
+def _help() -> List[str]:
+    return sorted(_commands)
+
+
+def _all_stats() -> dict:
+    return dict({"component": _component, "pid": os.getpid(), "conns": len(_conns)},
+                **{name: fn() for name, fn in _stats.items()})
+
+
+def _list_conns(kind: str = "", label: str = "", limit: int = MAX_CONNS_LISTED) -> dict:
+    now = time.monotonic()
+    rows = [c.describe(now) for c in _conns.values()
+            if (not kind or c.kind == kind) and label in c.label]
+    rows.sort(key=lambda r: r["age_s"], reverse=True)
+    return {"total": len(_conns), "listed": min(len(rows), limit), "conns": rows[:limit]}
+
+
+def _close(id: int) -> dict:
+    conn = _conns.get(int(id))
+    if conn is None:
+        raise KeyError(f"no live conn {id}")
+    conn.closer()
+    return {"closed": conn.id, "label": conn.label}
+
+
+def _instrument(on: bool = True) -> dict:
+    instrument.ENABLED = bool(on)
+    if on:
+        instrument.start()
+    return {"enabled": instrument.ENABLED}
+
+
+command("help", _help)
+command("stats", _all_stats)
+command("conns", _list_conns)
+command("close", _close)
+command("instrument", _instrument)
+stats_source("instrument", instrument.snapshot)
+stats_source("tls", tls_link.stats)
+stats_source("tfo", fastopen.stats)
+stats_source("flows", flow_log.stats)
+
+
+# -----------------------
+# Server
+# -----------------------
+
+async def _run(req: dict) -> Any:
+    name = req.pop("cmd", None)
+    fn = _commands.get(name)
+    if fn is None:
+        raise KeyError(f"unknown command {name!r}; try help")
+    result = fn(**req)
+    if asyncio.iscoroutine(result):
+        result = await result
+    return result
+
+
+async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                req = json.loads(line)
+                if not isinstance(req, dict):
+                    raise ValueError("request must be a JSON object")
+                reply = {"ok": True, "result": await _run(req)}
+            except Exception as e:
+                reply = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+            writer.write(json.dumps(reply, default=str).encode() + b"\n")
+            await writer.drain()
+    except (ConnectionError, ValueError):
+        pass  # gone, or a line over the reader limit
+    finally:
+        writer.close()
+
+
+async def start(component: str) -> Optional[str]:
+    """Listen on this process's admin socket; returns its path, or None when off."""
+    global _component, _server
+    if not ENABLED or _server is not None:
+        return None
+    _component = component
+    os.makedirs(ADMIN_DIR, exist_ok=True)
+    path = os.path.join(ADMIN_DIR, f"{component}-{os.getpid()}.sock")
+    _server = await tls_link.start_unix_server(_handle, path)
+    print(f"[admin] control socket on {path}")
+    return path
+
+
+# -----------------------
+# Client
+# -----------------------
+
+def request(path: str, cmd: str, timeout: float = 5.0, **args) -> Any:
+    """One blocking request (for scripts and the CLI); raises RuntimeError with the server's error."""
+    with socket.socket(socket.AF_UNIX) as s:
+        s.settimeout(timeout)
+        s.connect(path)
+        s.sendall(json.dumps(dict(args, cmd=cmd)).encode() + b"\n")
+        buf = b""
+        while not buf.endswith(b"\n"):
+            chunk = s.recv(65536)
+            if not chunk:
+                break
+            buf += chunk
+    reply = json.loads(buf)
+    if not reply["ok"]:
+        raise RuntimeError(reply["error"])
+    return reply["result"]
+
+
+def _arg(text: str):
+    key, _, value = text.partition("=")
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return key, value  # bare strings need no quotes
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Send one command to a server's admin socket")
+    ap.add_argument("socket")
+    ap.add_argument("cmd")
+    ap.add_argument("args", nargs="*", help="key=value; values are JSON when they parse as JSON")
+    args = ap.parse_args()
+    print(json.dumps(request(args.socket, args.cmd, **dict(_arg(a) for a in args.args)), indent=2, default=str))
@@ -0,0 +1,222 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Hashable, List, Optional
+
+# -----------------------
+# Circuit breakers
+# -----------------------
+# One breaker per endpoint (the DCS at the PPP, each failing target at the DCS):
+#
+#   closed     calls go through; outcomes land in a sliding window of 1 s buckets.
+#              Too many failures (FAILURE_RATE of at least MIN_CALLS in WINDOW, or
+#              CONSECUTIVE in a row) trips it open.
+#   open       calls are refused at once with BreakerOpen. After OPEN_FOR (doubling on
+#              every re-trip, up to OPEN_FOR_MAX) the next call moves it to half-open.
+#   half_open  at most HALF_OPEN_PROBES calls at a time are let through as probes;
+#              CLOSE_AFTER successes close it, one failure opens it again.
+#
+#   async with breakers.guard((host, port)):
+#       reader, writer = await asyncio.open_connection(host, port)
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+WINDOW = 10            # seconds of outcomes the failure rate is computed over
+MIN_CALLS = 10         # fewer calls than this in the window never trip on rate
+FAILURE_RATE = 0.5
+CONSECUTIVE = 5        # ... but this many failures in a row always do
+OPEN_FOR = 2.0
+OPEN_FOR_MAX = 60.0
+HALF_OPEN_PROBES = 2
+CLOSE_AFTER = 2
+MAX_BREAKERS = 4096    # per registry; healthy breakers are evicted first
+
+
+class BreakerOpen(ConnectionError):
+    def __init__(self, key, retry_after: float):
+        super().__init__(f"circuit open for {_name(key)} (retry in {retry_after:.1f}s)")
+        self.key = key
+        self.retry_after = retry_after
+
+
+def _name(key) -> str:
+    return f"{key[0]}:{key[1]}" if isinstance(key, tuple) and len(key) == 2 else str(key)
+
+
+class Breaker:
+    __slots__ = ("key", "state", "buckets", "consecutive", "trips", "opened_at", "open_for",
+                 "probes", "probe_ok", "refused", "last_change")
+
+    def __init__(self, key):
+        self.key = key
+        self.state = CLOSED
+        self.buckets: Deque[List[int]] = deque()  # [second, ok, failed]
+        self.consecutive = 0
+        self.trips = 0
+        self.opened_at = 0.0
+        self.open_for = 0.0
+        self.probes = 0
+        self.probe_ok = 0
+        self.refused = 0
+        self.last_change = time.monotonic()
+
+    def allow(self) -> bool:
+        """True if a call may go ahead; in half-open it then holds a probe slot until record()."""
+        if self.state == CLOSED:
+            return True
+        now = time.monotonic()
+        if self.state == OPEN:
+            if now - self.opened_at < self.open_for:
+                self.refused += 1
+                return False
+            self._set(HALF_OPEN, now)
+            self.probe_ok = 0
+        if self.probes >= HALF_OPEN_PROBES:
+            self.refused += 1
+            return False
+        self.probes += 1
+        return True
+
+    def retry_after(self) -> float:
+        if self.state == OPEN:
+            return max(0.0, self.opened_at + self.open_for - time.monotonic())
+        return 0.0
+
+    def record(self, ok: bool):
+        now = time.monotonic()
+        if self.state == HALF_OPEN:
+            self.probes = max(0, self.probes - 1)
+            if not ok:
+                self._trip(now)
+            else:
+                self.probe_ok += 1
+                if self.probe_ok >= CLOSE_AFTER:
+                    self._set(CLOSED, now)
+                    self.buckets.clear()
+                    self.consecutive = 0
+                    self.trips = 0
+                    print(f"[breaker] {_name(self.key)} closed")
+            return
+        if self.state == OPEN:
+            return  # a call that started before the trip
+        sec = int(now)
+        if not self.buckets or self.buckets[-1][0] != sec:
+            self.buckets.append([sec, 0, 0])
+            while self.buckets[0][0] <= sec - WINDOW:
+                self.buckets.popleft()
+        self.buckets[-1][1 if ok else 2] += 1
+        if ok:
+            self.consecutive = 0
+            return
+        self.consecutive += 1
+        if self.consecutive >= CONSECUTIVE:
+            self._trip(now)
+            return
+        calls = failed = 0
+        for _, o, f in self.buckets:
+            calls += o + f
+            failed += f
+        if calls >= MIN_CALLS and failed >= FAILURE_RATE * calls:
+            self._trip(now)
+
+    def release(self):
+        """A probe ended without an outcome (cancelled)."""
+        if self.state == HALF_OPEN:
+            self.probes = max(0, self.probes - 1)
+
+    def _trip(self, now: float):
+        self.trips += 1
+        self.open_for = min(OPEN_FOR_MAX, OPEN_FOR * 2 ** (self.trips - 1))
+        self.opened_at = now
+        self.probes = 0
+        self._set(OPEN, now)
+        print(f"[breaker] {_name(self.key)} open for {self.open_for:.1f}s (trip {self.trips})")
+
+    def _set(self, state: str, now: float):
+        self.state = state
+        self.last_change = now
+
+    def healthy(self) -> bool:
+        return self.state == CLOSED and not self.consecutive and not any(f for _, _, f in self.buckets)
+
+    def stats(self) -> dict:
+        return {"state": self.state, "trips": self.trips, "refused": self.refused,
+                "consecutive_failures": self.consecutive, "retry_after": round(self.retry_after(), 2),
+                "since": round(time.monotonic() - self.last_change, 1)}
+
+
+class _Guard:
+    __slots__ = ("registry", "key", "breaker")
+
+    def __init__(self, registry: "Breakers", key):
+        self.registry = registry
+        self.key = key
+        self.breaker: Optional[Breaker] = None
+
+    async def __aenter__(self):
+        b = self.breaker = self.registry.breakers.get(self.key)
+        if b is not None and not b.allow():
+            raise BreakerOpen(self.key, b.retry_after())
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        b = self.breaker
+        if exc_type is None:
+            if b is not None:
+                b.record(True)
+        elif issubclass(exc_type, asyncio.CancelledError):
+            if b is not None:
+                b.release()
+        elif issubclass(exc_type, Exception) and not issubclass(exc_type, BreakerOpen):
+            # Breakers are only created on a first failure, so healthy endpoints cost nothing
+            (b or self.registry.get(self.key)).record(False)
+        return False
+
+
+class Breakers:
+    """Breakers by endpoint key, created on an endpoint's first failure."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.breakers: "OrderedDict[Hashable, Breaker]" = OrderedDict()
+
+    def guard(self, key) -> _Guard:
+        """async with: raises BreakerOpen while open; any other exception counts as a failure."""
+        return _Guard(self, key)
+
+    def get(self, key) -> Breaker:
+        b = self.breakers.get(key)
+        if b is None:
+            if len(self.breakers) >= MAX_BREAKERS:
+                self._evict()
+            b = self.breakers[key] = Breaker(key)
+        return b
+
+    def refusing(self, key) -> bool:
+        """True while key's breaker is open and still cooling down (no state change, no probe taken)."""
+        b = self.breakers.get(key)
+        return b is not None and b.state == OPEN and b.retry_after() > 0
+
+    def state(self, key) -> str:
+        b = self.breakers.get(key)
+        return b.state if b else CLOSED
+
+    def healthy(self, key) -> bool:
+        """No failure on record for key (most endpoints never get a breaker at all)."""
+        b = self.breakers.get(key)
+        return b is None or b.healthy()
+
+    def failed(self, key):
+        """A failure that only showed after the guarded call returned (a TFO connect refused on first write)."""
+        self.get(key).record(False)
+
+    def _evict(self):
+        # Oldest healthy breaker first; if every breaker is tripped, the oldest one
+        for key, b in self.breakers.items():
+            if b.healthy():
+                del self.breakers[key]
+                return
+        self.breakers.popitem(last=False)
+
+    def stats(self) -> Dict[str, dict]:
+        return {_name(k): b.stats() for k, b in self.breakers.items() if not b.healthy()}
@@ -0,0 +1,140 @@
+import ipaddress
+import socket
+from typing import Dict, Optional, Tuple
+
+SO_MARK = 36  # Linux socket option
+
+# Incoming DSCP/mark on an accepted socket only reflect the client's SYN when
+#   net.ipv4.tcp_reflect_tos=1   (DSCP)
+#   net.ipv4.tcp_fwmark_accept=1 (SO_MARK from iptables MARK/CONNMARK)
+# are set; otherwise they read as 0 and only destination/content rules apply.
+
+
+class TrafficClass:
+    """Priority for mux frames (7 = highest, as in the PPP scheduler) and DSCP for egress shaping."""
+    __slots__ = ("name", "priority", "dscp")
+
+    def __init__(self, name: str, priority: int, dscp: int):
+        self.name = name
+        self.priority = priority
+        self.dscp = dscp
+
+    def __repr__(self) -> str:
+        return f"{self.name}(prio={self.priority}, dscp={self.dscp})"
+
+
+CLASSES: Dict[str, TrafficClass] = {
+    "control":     TrafficClass("control", 7, 48),      # CS6
+    "telemetry":   TrafficClass("telemetry", 6, 46),    # EF
+    "interactive": TrafficClass("interactive", 5, 34),  # AF41
+    "default":     TrafficClass("default", 3, 0),       # best effort
+    "bulk":        TrafficClass("bulk", 1, 8),          # CS1
+}
+DEFAULT_CLASS = CLASSES["default"]
+
+# Incoming DSCP -> class, for producers that already mark their traffic
+DSCP_CLASSES: Dict[int, TrafficClass] = {c.dscp: c for c in CLASSES.values() if c.dscp}
+
+
+class Rule:
+    """
+    A match on any combination of destination network, ports, incoming DSCP, SO_MARK,
+    or (content rules) a prefix of the first bytes of the flow.
+    """
+    __slots__ = ("cls", "net", "ports", "dscp", "mark", "prefix")
+
+    def __init__(self, cls: str, dst: Optional[str] = None, ports: Tuple[int, ...] = (),
+                 dscp: Optional[int] = None, mark: Optional[int] = None, prefix: bytes = b""):
+        self.cls = CLASSES[cls]
+        self.net = ipaddress.ip_network(dst, strict=False) if dst else None
+        self.ports = frozenset(ports)
+        self.dscp = dscp
+        self.mark = mark
+        self.prefix = prefix
+
+    def matches(self, ip, port: int, dscp: int, mark: int) -> bool:
+        if self.net is not None and (ip is None or ip not in self.net):
+            return False
+        if self.ports and port not in self.ports:
+            return False
+        if self.dscp is not None and dscp != self.dscp:
+            return False
+        if self.mark is not None and mark != self.mark:
+            return False
+        return True
+
+
+# First match wins. Mirrors the mangle DSCP rules in NON_LOCAL_TRANSPARENT_PROXY.md section 7.
+RULES = [
+    Rule("interactive", dst="172.23.16.1/32", ports=(7978,)),
+    Rule("bulk", dst="104.154.249.83/32", ports=(8891,)),
+]
+# Checked per flow against its first bytes, before the cached destination lookup
+CONTENT_RULES = [
+    Rule("interactive", prefix=b"\x16\x03"),  # TLS handshake
+]
+
+CACHE_MAX = 4096
+_cache: Dict[Tuple[str, int, int, int], TrafficClass] = {}
+
+
+def socket_marks(sock) -> Tuple[int, int]:
+    """(dscp, mark) of an accepted socket; zeros when unavailable."""
+    dscp = mark = 0
+    if sock is None:
+        return dscp, mark
+    try:
+        if sock.family == socket.AF_INET6:
+            dscp = sock.getsockopt(socket.IPPROTO_IPV6, socket.IPV6_TCLASS) >> 2
+        else:
+            dscp = sock.getsockopt(socket.IPPROTO_IP, socket.IP_TOS) >> 2
+    except OSError:
+        pass
+    try:
+        mark = sock.getsockopt(socket.SOL_SOCKET, SO_MARK)
+    except OSError:
+        pass
+    return dscp, mark
+
+
+def classify(host: str, port: int, sock=None, first_bytes: bytes = b"") -> TrafficClass:
+    """Classify one flow. Destination-based results are cached per (host, port, dscp, mark)."""
+    if first_bytes:
+        for rule in CONTENT_RULES:
+            if first_bytes.startswith(rule.prefix):
+                return rule.cls
+
+    dscp, mark = socket_marks(sock)
+    key = (host, port, dscp, mark)
+    cls = _cache.get(key)
+    if cls is not None:
+        return cls
+
+    try:
+        ip = ipaddress.ip_address(host)
+    except ValueError:
+        ip = None  # hostname: only port/DSCP/mark rules can match
+    for rule in RULES:
+        if rule.matches(ip, port, dscp, mark):
+            cls = rule.cls
+            break
+    else:
+        cls = DSCP_CLASSES.get(dscp, DEFAULT_CLASS)
+
+    if len(_cache) >= CACHE_MAX:
+        _cache.clear()
+    _cache[key] = cls
+    return cls
+
+
+def apply_dscp(sock, dscp: int):
+    """Re-mark an outbound socket so tc/HTB on the egress interface can shape it."""
+    if sock is None:
+        return
+    try:
+        if sock.family == socket.AF_INET6:
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_TCLASS, dscp << 2)
+        else:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_TOS, dscp << 2)
+    except OSError:
+        pass
@@ -0,0 +1,189 @@
+import asyncio
+import itertools
+import random
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# -----------------------
+# DCS pool
+# -----------------------
+# The PPP's choice of DCS for each new tunnel. Members are health-checked in the
+# background (PROBE_INTERVAL) with the same handshake a tunnel starts with; FALL
+# failed checks in a row take a member out of rotation, RISE good ones put it back.
+# A member that is unhealthy or drained gets no new tunnels, but the tunnels it
+# already carries run until they end on their own.
+#
+# Policies:
+#   rr     round-robin
+#   least  fewest active tunnels, handshakes in flight included (ties: round-robin order)
+#   ewma   power of two choices: two random members, the one with the lower
+#          EWMA handshake latency x (active tunnels + 1)
+#
+# Pins send a route to a subset of the pool; the first matching pin wins:
+#   {"interactive": ["10.0.0.2:1081"], "*.example.com": ["10.0.0.3:1081", "/run/dcs.sock"]}
+# keys are classifier traffic class names, host names, or "*.suffix" patterns;
+# members are named "host:port", or by path for a co-located DCS on a Unix socket.
+# If no member of the candidate set is healthy, all of them are tried anyway:
+# the per-member circuit breakers still make a dead DCS fail fast.
+
+POLICIES = ("rr", "least", "ewma")
+PROBE_INTERVAL = 2.0
+PROBE_TIMEOUT = 2.0
+FALL = 2
+RISE = 2
+EWMA_ALPHA = 0.3   # weight of the newest handshake sample
+
+Endpoint = Tuple[str, int]
+ProbeFn = Callable[[str, int], Awaitable[None]]
+
+
+class Member:
+    __slots__ = ("host", "port", "name", "healthy", "draining", "active", "tunnels", "ewma",
+                 "fails", "oks", "last_error", "last_check")
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.name = host if host.startswith("/") else f"{host}:{port}"  # Unix socket: the path
+        self.healthy = True   # until a health check says otherwise
+        self.draining = False
+        self.active = 0       # live tunnels, and flows still handshaking with this member
+        self.tunnels = 0      # tunnels ever handed out
+        self.ewma = 0.0       # handshake seconds; 0 until the first sample
+        self.fails = 0        # consecutive failed health checks
+        self.oks = 0          # consecutive good ones, while unhealthy
+        self.last_error = ""
+        self.last_check = 0.0
+
+    @property
+    def endpoint(self) -> Endpoint:
+        return self.host, self.port
+
+    def observe(self, seconds: float):
+        """Feed a handshake latency sample into the EWMA."""
+        self.ewma = seconds if not self.ewma else self.ewma + EWMA_ALPHA * (seconds - self.ewma)
+
+    def cost(self) -> float:
+        return self.ewma * (self.active + 1)
+
+    def stats(self) -> dict:
+        return {"healthy": self.healthy, "draining": self.draining, "active": self.active,
+                "tunnels": self.tunnels, "ewma_ms": round(self.ewma * 1000, 2),
+                "failed_checks": self.fails, "last_error": self.last_error}
+
+
+class DcsPool:
+    def __init__(self, endpoints: Sequence[Endpoint], policy: str = "ewma",
+                 pins: Optional[Dict[str, Iterable[str]]] = None,
+                 probe: Optional[ProbeFn] = None):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown DCS pool policy {policy!r} (one of {', '.join(POLICIES)})")
+        if not endpoints:
+            raise ValueError("DCS pool needs at least one member")
+        self.members: List[Member] = [Member(h, p) for h, p in endpoints]
+        self.by_name: Dict[str, Member] = {m.name: m for m in self.members}
+        self.policy = policy
+        self.pins: List[Tuple[str, List[Member]]] = []
+        for key, names in (pins or {}).items():
+            subset = []
+            for n in names:
+                if n not in self.by_name:
+                    raise ValueError(f"DCS pin {key!r} names {n!r}, which is not in the pool")
+                subset.append(self.by_name[n])
+            self.pins.append((key, subset))
+        self.probe = probe
+        self._rr = itertools.count()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Start health checks. A single member is never checked: there is nothing to fail over to."""
+        if self.probe is not None and len(self.members) > 1 and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._check_loop())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def endpoints(self) -> List[Endpoint]:
+        return [m.endpoint for m in self.members]
+
+    # -----------------------
+    # Selection
+    # -----------------------
+
+    def candidates(self, cls_name: str = "", host: str = "") -> List[Member]:
+        """The members a route may use: its pin's subset, or the whole pool."""
+        for key, subset in self.pins:
+            if key == cls_name or key == host or (key.startswith("*.") and host.endswith(key[1:])):
+                return subset
+        return self.members
+
+    def pick(self, cls_name: str = "", host: str = "", exclude: Sequence[Member] = ()) -> Optional[Member]:
+        """A member for a new tunnel, or None when every candidate is excluded or drained."""
+        self.start()
+        cands = [m for m in self.candidates(cls_name, host) if m not in exclude and not m.draining]
+        if not cands:
+            return None
+        up = [m for m in cands if m.healthy]
+        cands = up or cands
+        if len(cands) == 1:
+            return cands[0]
+        if self.policy == "ewma":
+            a, b = random.sample(cands, 2)
+            return a if a.cost() <= b.cost() else b
+        start = next(self._rr)
+        if self.policy == "rr":
+            return cands[start % len(cands)]
+        n = len(cands)
+        return min((cands[(start + i) % n] for i in range(n)), key=lambda m: m.active)
+
+    def opened(self, member: Member):
+        member.active += 1
+        member.tunnels += 1
+
+    def closed(self, member: Member):
+        member.active -= 1
+
+    # -----------------------
+    # Draining and health
+    # -----------------------
+
+    def drain(self, name: str, on: bool = True):
+        """Stop (or resume) handing name new tunnels; its live tunnels are left alone."""
+        member = self.by_name[name]
+        member.draining = on
+        print(f"[dcs] {name} {'draining' if on else 'back in rotation'} ({member.active} active)")
+
+    async def _check_loop(self):
+        while True:
+            await asyncio.gather(*(self._check(m) for m in self.members))
+            await asyncio.sleep(PROBE_INTERVAL)
+
+    async def _check(self, member: Member):
+        t0 = time.perf_counter()
+        try:
+            await asyncio.wait_for(self.probe(member.host, member.port), PROBE_TIMEOUT)
+        except Exception as e:
+            member.last_error = str(e) or type(e).__name__
+            member.fails += 1
+            member.oks = 0
+            if member.healthy and member.fails >= FALL:
+                member.healthy = False
+                print(f"[dcs] {member.name} unhealthy after {member.fails} failed checks ({member.last_error}); "
+                      f"draining {member.active} tunnels")
+        else:
+            member.observe(time.perf_counter() - t0)
+            member.fails = 0
+            if not member.healthy:
+                member.oks += 1
+                if member.oks >= RISE:
+                    member.healthy = True
+                    member.oks = 0
+                    print(f"[dcs] {member.name} healthy again")
+        member.last_check = time.monotonic()
+
+    def stats(self) -> dict:
+        return {"policy": self.policy, "members": {m.name: m.stats() for m in self.members},
+                "pins": {key: [m.name for m in subset] for key, subset in self.pins}}
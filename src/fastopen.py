@@ -0,0 +1,171 @@
+import asyncio
+import os
+import socket
+import struct
+from typing import Dict, Optional
+
+import instrument
+
+# -----------------------
+# TCP Fast Open (Linux)
+# -----------------------
+# Off unless SOCKS_PROXY_TFO=1. Then listeners accept data in the SYN (TCP_FASTOPEN)
+# and outbound connects use TCP_FASTOPEN_CONNECT: connect() returns at once and the
+# first write goes out in the SYN, carrying a cookie the server handed out on an
+# earlier connection. Without a cookie (first contact, cookie expired, server or
+# middlebox refusing) the kernel falls back to a plain handshake on its own, with
+# the data sent after it; nothing changes for the caller.
+#
+#   PPP -> DCS     the SOCKS5 greeting (or the TLS ClientHello) rides in the SYN
+#   DCS -> target  the flow's first bytes from the PPP ride in the SYN
+#
+# The DCS -> target connect therefore "succeeds" before the target has answered: a
+# dead target shows up as a refused tunnel rather than a SOCKS5 error reply. So
+# socks5_dcs never uses TFO for pool refills (an idle connection must be real) or
+# for targets whose breaker has seen failures, and it reports a TFO leg refused
+# on its first write to the target's breaker (counted here as "refused").
+#
+# observe() reads TCP_INFO once the handshake is over and counts whether the SYN's
+# data was acked (one RTT saved, added to saved_rtt_us) or why it fell back.
+# The kernel also needs net.ipv4.tcp_fastopen: bit 1 for clients, bit 2 for servers.
+
+ENABLED = os.environ.get("SOCKS_PROXY_TFO", "") not in ("", "0")
+QUEUE = int(os.environ.get("SOCKS_PROXY_TFO_QUEUE", "256"))  # pending TFO SYNs per listener
+
+TCP_FASTOPEN = getattr(socket, "TCP_FASTOPEN", 23)
+TCP_FASTOPEN_CONNECT = getattr(socket, "TCP_FASTOPEN_CONNECT", 30)
+TCP_INFO = getattr(socket, "TCP_INFO", 11)
+SO_MARK = getattr(socket, "SO_MARK", 36)
+TCPI_OPT_SYN_DATA = 0x20
+TCP_SYN_SENT = 2
+# Target legs: look again after each of these delays until the handshake is over;
+# a leg closed before it was judged counts as unobserved
+OBSERVE_DELAYS = (0.005, 0.02, 0.1, 0.5, 2.0)
+
+SYSCTL = "/proc/sys/net/ipv4/tcp_fastopen"
+SYSCTL_CLIENT = 0x1
+SYSCTL_SERVER = 0x2
+
+# tcpi_fastopen_client_fail
+_FAIL_REASONS = {0: "fallback", 1: "no_cookie", 2: "data_not_acked", 3: "syn_retransmitted"}
+
+counters: Dict[str, int] = {"attempts": 0, "unsupported": 0, "listeners": 0, "unobserved": 0, "syn_data_acked": 0,
+                            "saved_rtt_us": 0, "refused": 0, **{r: 0 for r in _FAIL_REASONS.values()}}
+
+
+def sysctl() -> int:
+    try:
+        with open(SYSCTL) as f:
+            return int(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def listen(server: asyncio.AbstractServer):
+    """Let the server's TCP listening sockets accept data in the SYN; no-op when off."""
+    if not ENABLED:
+        return
+    for sock in server.sockets or ():
+        if sock.family not in (socket.AF_INET, socket.AF_INET6):
+            continue
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, TCP_FASTOPEN, QUEUE)
+            counters["listeners"] += 1
+        except OSError as e:
+            counters["unsupported"] += 1
+            print(f"[tfo] listener {sock.getsockname()}: TCP_FASTOPEN unavailable ({e})")
+            return
+    if not sysctl() & SYSCTL_SERVER:
+        print(f"[tfo] {SYSCTL} lacks the server bit (2): SYN data will be ignored")
+
+
+async def connect(host: str, port: int, mark: Optional[int] = None) -> socket.socket:
+    """
+    A connected (or, with a cookie, connect-pending) non-blocking socket for
+    asyncio.open_connection(sock=...). mark sets SO_MARK; a mark that cannot be
+    set is skipped, as in socks5_dcs.open_connection_marked.
+    """
+    loop = asyncio.get_running_loop()
+    addrinfos = await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    if not addrinfos:
+        raise OSError(f"getaddrinfo returned no results for {host}:{port}")
+    family, socktype, proto, _, sockaddr = addrinfos[0]
+    sock = socket.socket(family=family, type=socktype, proto=proto)
+    try:
+        if mark is not None:
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, SO_MARK, int(mark))
+            except OSError:
+                pass
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, TCP_FASTOPEN_CONNECT, 1)
+            counters["attempts"] += 1
+        except OSError:
+            counters["unsupported"] += 1  # old kernel: a plain connect
+        sock.setblocking(False)
+        await loop.sock_connect(sock, sockaddr)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+def used(writer: asyncio.StreamWriter) -> bool:
+    """True when the connection was made by connect() with TFO on."""
+    sock = writer.get_extra_info("socket")
+    if not ENABLED or sock is None or sock.family not in (socket.AF_INET, socket.AF_INET6):
+        return False
+    try:
+        return bool(sock.getsockopt(socket.IPPROTO_TCP, TCP_FASTOPEN_CONNECT))
+    except OSError:
+        return False
+
+
+def observe(writer: asyncio.StreamWriter, prefix: str = "link") -> bool:
+    """
+    Count how a TFO connect went. Call once per connection after the peer's first
+    reply; connections made without connect() are ignored. False: the handshake is
+    not over yet (nothing written, or no SYN-ACK), so look again later.
+    """
+    if not ENABLED:
+        return True
+    sock = writer.get_extra_info("socket")
+    if sock is None or sock.family not in (socket.AF_INET, socket.AF_INET6):
+        return True
+    try:
+        if not sock.getsockopt(socket.IPPROTO_TCP, TCP_FASTOPEN_CONNECT):
+            return True
+        info = sock.getsockopt(socket.IPPROTO_TCP, TCP_INFO, 104)
+    except OSError:
+        counters["unobserved"] += 1  # closed meanwhile
+        return True
+    if len(info) < 72:
+        return True
+    if info[0] == TCP_SYN_SENT:
+        return False
+    if info[5] & TCPI_OPT_SYN_DATA:
+        rtt_us = struct.unpack_from("I", info, 68)[0]
+        counters["syn_data_acked"] += 1
+        counters["saved_rtt_us"] += rtt_us
+        if instrument.ENABLED:
+            instrument.histogram(prefix, "tfo_saved_rtt").record(rtt_us)
+    else:
+        counters[_FAIL_REASONS[(info[7] >> 1) & 0x3]] += 1
+    return True
+
+
+def observe_later(writer: asyncio.StreamWriter, prefix: str = "link", attempt: int = 0):
+    """observe() on a timer, for legs where no reply is awaited (DCS -> target)."""
+    if ENABLED and attempt < len(OBSERVE_DELAYS):
+        asyncio.get_running_loop().call_later(OBSERVE_DELAYS[attempt], _observe_again, writer, prefix, attempt)
+
+
+def _observe_again(writer: asyncio.StreamWriter, prefix: str, attempt: int):
+    if not observe(writer, prefix):
+        observe_later(writer, prefix, attempt + 1)
+
+
+def stats() -> dict:
+    acked = counters["syn_data_acked"]
+    return dict(counters, enabled=ENABLED, sysctl=sysctl(),
+                avg_saved_rtt_us=counters["saved_rtt_us"] // acked if acked else 0)
@@ -0,0 +1,274 @@
+import asyncio
+import atexit
+import csv
+import glob
+import io
+import os
+import struct
+import threading
+import time
+from collections import deque
+from typing import Iterator, List, NamedTuple, Optional
+
+# -----------------------
+# Per-flow accounting records
+# -----------------------
+# IPFIX-style: one record when a tunnel or mux stream ends, plus an interim record
+# every ACTIVE_TIMEOUT seconds for long flows. Byte counts are deltas since the
+# previous record of the same flow, and start/end bound that interval, so summing
+# records over any time window gives the bytes moved in it.
+#
+# Off unless SOCKS_PROXY_FLOW_DIR is set:
+#   SOCKS_PROXY_FLOW_DIR      directory for the record files
+#   SOCKS_PROXY_FLOW_FORMAT   "bin" (default, compact) or "csv"
+#
+# Records are queued in memory and written in batches by a background thread, to
+#   <dir>/flows-<component>-<pid>-<YYYYmmddTHHMMSS>.<bin|csv>
+# rotated by size and age. flow_report.py aggregates them.
+#
+#   flow = flow_log.open_flow(peer, "host:port")   # None when disabled
+#   splice.splice(..., flow=flow)                   # or splice.feed(..., flow=flow)
+
+FLOW_DIR = os.environ.get("SOCKS_PROXY_FLOW_DIR", "")
+FLOW_FORMAT = os.environ.get("SOCKS_PROXY_FLOW_FORMAT", "bin")
+ENABLED = bool(FLOW_DIR)
+
+ACTIVE_TIMEOUT = 60.0        # long flows report at least this often
+SWEEP_INTERVAL = 10.0        # how often live flows are checked against ACTIVE_TIMEOUT
+FLUSH_INTERVAL = 1.0         # writer wakes at least this often
+BATCH_RECORDS = 1024         # ... or as soon as this many records are queued
+MAX_QUEUED = 100_000         # beyond this records are dropped (and counted), not buffered
+ROTATE_BYTES = 16 * 1024 * 1024
+ROTATE_SECONDS = 3600
+ROTATE_KEEP = 48             # files kept per component
+
+# flowEndReason, as in IPFIX (RFC 7011 / IANA)
+REASON_ACTIVE = 2            # interim record of a live flow
+REASON_END = 3
+
+MAGIC = b"FLW1"
+# start_ms, duration_ms, up, down, reason; then component, src, dst as u8-length strings
+_REC = struct.Struct("!QIQQB")
+CSV_FIELDS = ("start", "end", "component", "reason", "src", "dst", "up", "down")
+
+
+class Record(NamedTuple):
+    start: float
+    end: float
+    component: str
+    reason: int
+    src: str
+    dst: str
+    up: int
+    down: int
+
+
+class Flow:
+    """Live flow; source is the Tunnel or Feed whose up/down counters it reports."""
+    __slots__ = ("src", "dst", "source", "reported_at", "up", "down")
+
+    def __init__(self, src: str, dst: str):
+        self.src = src
+        self.dst = dst
+        self.source = None
+        self.reported_at = time.time()
+        self.up = self.down = 0   # already reported
+
+    def report(self, reason: int):
+        src = self.source
+        if src is None:
+            return
+        now = time.time()
+        up, down = src.up, src.down
+        _writer.put((self.reported_at, now, reason, self.src, self.dst, up - self.up, down - self.down))
+        self.reported_at, self.up, self.down = now, up, down
+
+    def close(self):
+        self.report(REASON_END)
+        self.source = None
+        _live.discard(self)
+
+
+_live = set()
+_component = "proxy"
+_sweeper: Optional[asyncio.Task] = None
+
+
+def open_flow(src, dst: str) -> Optional[Flow]:
+    """
+    A flow from src (peername tuple or string) to dst ("host:port"), or None when
+    accounting is off. Hand it to splice.splice()/splice.feed(), which close it.
+    """
+    if not ENABLED:
+        return None
+    if isinstance(src, tuple):
+        src = f"{src[0]}:{src[1]}"
+    flow = Flow(src or "", dst)
+    _live.add(flow)
+    return flow
+
+
+def _encode_bin(component: bytes, rec: tuple) -> bytes:
+    start, end, reason, src, dst, up, down = rec
+    src_b, dst_b = src.encode()[:255], dst.encode()[:255]
+    return b"".join((
+        _REC.pack(int(start * 1000), int((end - start) * 1000), up, down, reason),
+        bytes((len(component),)), component, bytes((len(src_b),)), src_b, bytes((len(dst_b),)), dst_b,
+    ))
+
+
+class _Writer:
+    """Background thread that drains the record queue into rotating files."""
+
+    def __init__(self):
+        self.queue = deque()
+        self.wake = threading.Event()
+        self.lock = threading.Lock()   # one flush at a time (thread vs atexit)
+        self.thread: Optional[threading.Thread] = None
+        self.file = None
+        self.path = ""
+        self.opened_at = 0.0
+        self.size = 0
+        self.counters = {"records": 0, "batches": 0, "bytes": 0, "dropped": 0, "files": 0}
+
+    def put(self, rec: tuple):
+        if len(self.queue) >= MAX_QUEUED:
+            self.counters["dropped"] += 1
+            return
+        self.queue.append(rec)
+        if len(self.queue) >= BATCH_RECORDS:
+            self.wake.set()
+
+    def start(self):
+        if self.thread is None:
+            os.makedirs(FLOW_DIR, exist_ok=True)
+            self.thread = threading.Thread(target=self._run, name="flow-writer", daemon=True)
+            self.thread.start()
+            atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            self.wake.wait(FLUSH_INTERVAL)
+            self.wake.clear()
+            try:
+                self.flush()
+            except OSError as e:
+                print(f"[flow] write failed: {e}", flush=True)
+
+    def flush(self):
+        with self.lock:
+            batch = []
+            q = self.queue
+            while q:
+                batch.append(q.popleft())
+            if not batch:
+                return
+            self._rotate_if_due()
+            if FLOW_FORMAT == "csv":
+                buf = io.StringIO()
+                w = csv.writer(buf)
+                for start, end, reason, src, dst, up, down in batch:
+                    w.writerow((f"{start:.3f}", f"{end:.3f}", _component, reason, src, dst, up, down))
+                data = buf.getvalue().encode()
+            else:
+                comp = _component.encode()
+                data = b"".join(_encode_bin(comp, rec) for rec in batch)
+            self.file.write(data)
+            self.file.flush()
+            self.size += len(data)
+            self.counters["records"] += len(batch)
+            self.counters["batches"] += 1
+            self.counters["bytes"] += len(data)
+
+    def _rotate_if_due(self):
+        if self.file is not None and self.size < ROTATE_BYTES and time.time() - self.opened_at < ROTATE_SECONDS:
+            return
+        if self.file is not None:
+            self.file.close()
+        ext = "csv" if FLOW_FORMAT == "csv" else "bin"
+        stamp = time.strftime("%Y%m%dT%H%M%S")
+        self.path = os.path.join(FLOW_DIR, f"flows-{_component}-{os.getpid()}-{stamp}.{ext}")
+        self.file = open(self.path, "ab")
+        self.opened_at = time.time()
+        self.size = 0
+        header = (",".join(CSV_FIELDS) + "\n").encode() if ext == "csv" else MAGIC
+        self.file.write(header)
+        self.size += len(header)
+        self.counters["files"] += 1
+        # Keep the newest ROTATE_KEEP files of this component
+        old = sorted(glob.glob(os.path.join(FLOW_DIR, f"flows-{_component}-*.{ext}")), key=os.path.getmtime)
+        for path in old[:-ROTATE_KEEP]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+_writer = _Writer()
+
+
+async def _sweep():
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL)
+        due = time.time() - ACTIVE_TIMEOUT
+        for flow in list(_live):
+            if flow.reported_at <= due:
+                flow.report(REASON_ACTIVE)
+
+
+def start(component: str):
+    """Start the writer thread and the active-timeout sweep on the running loop; no-op when disabled."""
+    global _component, _sweeper
+    if not ENABLED or _sweeper is not None:
+        return
+    _component = component
+    _writer.start()
+    _sweeper = asyncio.get_running_loop().create_task(_sweep())
+    print(f"[flow] recording {FLOW_FORMAT} flow records to {FLOW_DIR}")
+
+
+def stats() -> dict:
+    return dict(_writer.counters, live=len(_live), queued=len(_writer.queue), file=_writer.path)
+
+
+# -----------------------
+# Reading
+# -----------------------
+
+def read_file(path: str) -> Iterator[Record]:
+    """Records of one file, binary or CSV (a file still being written may end mid-record)."""
+    with open(path, "rb") as f:
+        head = f.read(len(MAGIC))
+        if head != MAGIC:
+            f.seek(0)
+            for row in csv.DictReader(io.TextIOWrapper(f, encoding="utf-8", newline="")):
+                try:
+                    yield Record(float(row["start"]), float(row["end"]), row["component"], int(row["reason"]),
+                                 row["src"], row["dst"], int(row["up"]), int(row["down"]))
+                except (KeyError, TypeError, ValueError):
+                    return
+            return
+        data = f.read()
+    i, n = 0, len(data)
+    while i + _REC.size <= n:
+        start_ms, dur_ms, up, down, reason = _REC.unpack_from(data, i)
+        i += _REC.size
+        strs: List[str] = []
+        for _ in range(3):
+            if i >= n or i + 1 + data[i] > n:
+                return
+            ln = data[i]
+            strs.append(data[i + 1:i + 1 + ln].decode("utf-8", errors="replace"))
+            i += 1 + ln
+        yield Record(start_ms / 1000, (start_ms + dur_ms) / 1000, strs[0], reason, strs[1], strs[2], up, down)
+
+
+def find_files(paths: List[str]) -> List[str]:
+    """Expand directories to the flow files in them, oldest first."""
+    files = []
+    for p in paths:
+        if os.path.isdir(p):
+            files.extend(glob.glob(os.path.join(p, "flows-*.bin")) + glob.glob(os.path.join(p, "flows-*.csv")))
+        else:
+            files.append(p)
+    return sorted(files, key=os.path.getmtime)
@@ -0,0 +1,99 @@
+import argparse
+import json
+import time
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+import flow_log
+
+# -----------------------
+# Flow record report
+# -----------------------
+# Sums flow_log records by route and time window:
+#   python flow_report.py /var/log/socks_proxy/flows --window 300 --by route
+# A record is placed in the window its interval ends in; interim records
+# (long flows) add bytes but do not count as another flow.
+
+KEYS = {
+    "route": lambda r: f"{r.src.rsplit(':', 1)[0]} -> {r.dst}",
+    "dst": lambda r: r.dst,
+    "src": lambda r: r.src.rsplit(":", 1)[0],
+    "component": lambda r: r.component,
+}
+
+
+def parse_time(text: str) -> float:
+    """Epoch seconds, or local "YYYY-mm-ddTHH:MM[:SS]"."""
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    for fmt in ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d"):
+        try:
+            return time.mktime(time.strptime(text, fmt))
+        except ValueError:
+            continue
+    raise argparse.ArgumentTypeError(f"bad time: {text!r}")
+
+
+def aggregate(files: List[str], by: str, window: float, since: float = 0.0, until: float = 0.0) -> Dict[Tuple[float, str], dict]:
+    key_of = KEYS[by]
+    rows: Dict[Tuple[float, str], dict] = defaultdict(lambda: {"flows": 0, "records": 0, "up": 0, "down": 0, "seconds": 0.0})
+    for path in files:
+        for r in flow_log.read_file(path):
+            if (since and r.end < since) or (until and r.end >= until):
+                continue
+            bucket = r.end - r.end % window if window else 0.0
+            row = rows[(bucket, key_of(r))]
+            row["records"] += 1
+            row["up"] += r.up
+            row["down"] += r.down
+            row["seconds"] += r.end - r.start
+            if r.reason != flow_log.REASON_ACTIVE:
+                row["flows"] += 1
+    return rows
+
+
+def human(n: float) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if n < 1024:
+            return f"{n:.0f}{unit}" if unit == "B" else f"{n:.1f}{unit}"
+        n /= 1024
+    return f"{n:.1f}TiB"
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Aggregate flow_log records by route and time window")
+    ap.add_argument("paths", nargs="+", help="flow files or directories holding them")
+    ap.add_argument("--by", choices=sorted(KEYS), default="route")
+    ap.add_argument("--window", type=float, default=300.0, help="window length in seconds; 0 = one window")
+    ap.add_argument("--since", type=parse_time, default=0.0, help="epoch or YYYY-mm-ddTHH:MM[:SS]")
+    ap.add_argument("--until", type=parse_time, default=0.0)
+    ap.add_argument("--top", type=int, default=20, help="rows per window, by total bytes")
+    ap.add_argument("--json", action="store_true", help="print JSON instead of a table")
+    args = ap.parse_args()
+
+    rows = aggregate(flow_log.find_files(args.paths), args.by, args.window, args.since, args.until)
+    windows: Dict[float, List[Tuple[str, dict]]] = defaultdict(list)
+    for (bucket, key), row in rows.items():
+        windows[bucket].append((key, row))
+    for bucket in windows:
+        windows[bucket].sort(key=lambda kv: kv[1]["up"] + kv[1]["down"], reverse=True)
+        del windows[bucket][args.top:]
+
+    if args.json:
+        print(json.dumps([{"window_start": bucket, args.by: key, **row}
+                          for bucket in sorted(windows) for key, row in windows[bucket]], indent=2))
+        return
+    for bucket in sorted(windows):
+        if args.window:
+            print(f"== {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(bucket))} ({args.window:.0f}s window)")
+        else:
+            print("== all records")
+        print(f"  {args.by:48} {'flows':>7} {'up':>10} {'down':>10} {'flow-s':>9}")
+        for key, row in windows[bucket]:
+            print(f"  {key[:48]:48} {row['flows']:>7} {human(row['up']):>10} {human(row['down']):>10} {row['seconds']:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
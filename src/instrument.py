@@ -0,0 +1,241 @@
+import asyncio
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+from typing import Dict, List, Optional, Tuple
+
+# -----------------------
+# Connection-stage timing and event-loop watchdog
+# -----------------------
+# Off unless SOCKS_PROXY_INSTRUMENT=1 (or enable() is called). When off, timer()
+# hands out a shared no-op object, so a call site costs one attribute lookup.
+#
+#   tm = instrument.timer("ppp")
+#   ...                      # e.g. SO_ORIGINAL_DST lookup
+#   tm.mark("orig_dst")      # time since the previous mark -> histogram "ppp.orig_dst"
+#   tm.done()                # time since timer() -> histogram "ppp.total"
+#
+# snapshot() returns every histogram plus watchdog state; SIGUSR1 prints it.
+
+ENABLED = os.environ.get("SOCKS_PROXY_INSTRUMENT", "0") not in ("", "0")
+
+WATCHDOG_INTERVAL = 0.1   # seconds between loop heartbeats
+SLOW_CALLBACK = 0.25      # loop blocked this long -> log the loop thread's stack
+MAX_STACKS = 20           # slow-callback stacks kept for snapshot()
+
+# Histogram layout: values below 2**SUB_BITS are exact, above that every power of two
+# is split into 2**(SUB_BITS-1) linear buckets (<= 6.25% error with SUB_BITS = 5)
+SUB_BITS = 5
+_SUB = 1 << SUB_BITS
+_HALF = _SUB >> 1
+
+
+class Histogram:
+    """HDR-style log-linear histogram of integer microsecond values."""
+    __slots__ = ("counts", "count", "total", "min", "max")
+
+    def __init__(self):
+        self.counts: List[int] = []
+        self.count = 0
+        self.total = 0
+        self.min = 0
+        self.max = 0
+
+    @staticmethod
+    def _index(v: int) -> int:
+        if v < _SUB:
+            return v
+        shift = v.bit_length() - SUB_BITS
+        return _SUB + (shift - 1) * _HALF + ((v >> shift) - _HALF)
+
+    @staticmethod
+    def _lowest(i: int) -> int:
+        if i < _SUB:
+            return i
+        shift, sub = divmod(i - _SUB, _HALF)
+        return (sub + _HALF) << (shift + 1)
+
+    def record(self, v: int):
+        if v < 0:
+            v = 0
+        i = self._index(v)
+        counts = self.counts
+        if i >= len(counts):
+            counts.extend([0] * (i + 1 - len(counts)))
+        counts[i] += 1
+        if not self.count or v < self.min:
+            self.min = v
+        if v > self.max:
+            self.max = v
+        self.count += 1
+        self.total += v
+
+    def percentile(self, p: float) -> int:
+        if not self.count:
+            return 0
+        want = max(1, int(round(p / 100.0 * self.count)))
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= want:
+                return min(self._lowest(i), self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "min_us": self.min,
+            "mean_us": round(self.total / self.count, 1) if self.count else 0,
+            "p50_us": self.percentile(50),
+            "p99_us": self.percentile(99),
+            "p999_us": self.percentile(99.9),
+            "max_us": self.max,
+        }
+
+
+_histograms: Dict[Tuple[str, str], Histogram] = {}
+
+
+def histogram(prefix: str, stage: str) -> Histogram:
+    h = _histograms.get((prefix, stage))
+    if h is None:
+        h = _histograms[(prefix, stage)] = Histogram()
+    return h
+
+
+class Timer:
+    """Stage timestamps for one connection; each mark() records the time since the previous one."""
+    __slots__ = ("prefix", "t0", "last")
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.t0 = self.last = time.perf_counter()
+
+    def mark(self, stage: str):
+        now = time.perf_counter()
+        histogram(self.prefix, stage).record(int((now - self.last) * 1e6))
+        self.last = now
+
+    def done(self, stage: str = "total"):
+        histogram(self.prefix, stage).record(int((time.perf_counter() - self.t0) * 1e6))
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def mark(self, stage: str):
+        pass
+
+    def done(self, stage: str = "total"):
+        pass
+
+
+NULL_TIMER = _NullTimer()
+
+
+def timer(prefix: str):
+    return Timer(prefix) if ENABLED else NULL_TIMER
+
+
+class Watchdog:
+    """
+    Measures event-loop lag from a heartbeat task. A helper thread watches the
+    heartbeat; when the loop has not come back for SLOW_CALLBACK seconds it logs
+    the loop thread's current stack, i.e. the callback that is hogging the loop.
+    """
+    def __init__(self, interval: float = WATCHDOG_INTERVAL, threshold: float = SLOW_CALLBACK):
+        self.interval = interval
+        self.threshold = threshold
+        self.lag = Histogram()
+        self.beat = time.monotonic()
+        self.stalls = 0
+        self.stacks: List[dict] = []
+        self._loop_thread = threading.get_ident()
+        self._reported_beat = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self._stop = threading.Event()
+
+    def start(self):
+        self._loop_thread = threading.get_ident()
+        self.beat = time.monotonic()
+        self._task = asyncio.get_running_loop().create_task(self._heartbeat())
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+
+    async def _heartbeat(self):
+        while True:
+            t0 = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.lag.record(int((now - t0 - self.interval) * 1e6))
+            self.beat = now
+
+    def _watch(self):
+        while not self._stop.wait(self.interval / 2):
+            beat = self.beat
+            stalled = time.monotonic() - beat
+            if stalled < self.threshold + self.interval or beat == self._reported_beat:
+                continue
+            self._reported_beat = beat  # one report per stall
+            frame = sys._current_frames().get(self._loop_thread)
+            stack = "".join(traceback.format_stack(frame)) if frame else "<no frame>"
+            self.stalls += 1
+            self.stacks.append({"at": time.time(), "stalled_ms": round(stalled * 1e3, 1), "stack": stack})
+            del self.stacks[:-MAX_STACKS]
+            print(f"[watchdog] event loop blocked for {stalled * 1e3:.0f} ms in:\n{stack}", flush=True)
+
+    def stats(self) -> dict:
+        return {"lag": self.lag.summary(), "stalls": self.stalls, "last_stall": self.stacks[-1] if self.stacks else None}
+
+
+watchdog: Optional[Watchdog] = None
+
+
+def enable():
+    global ENABLED
+    ENABLED = True
+
+
+def start():
+    """Start the watchdog and the SIGUSR1 dump on the running loop; no-op when disabled."""
+    global watchdog
+    if not ENABLED or watchdog is not None:
+        return
+    watchdog = Watchdog()
+    watchdog.start()
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, dump)
+    except (NotImplementedError, RuntimeError, ValueError):
+        pass  # not on the main thread, or no signals on this platform
+
+
+def snapshot() -> dict:
+    return {
+        "enabled": ENABLED,
+        "stages": {f"{p}.{s}": h.summary() for (p, s), h in sorted(_histograms.items())},
+        "loop": watchdog.stats() if watchdog else None,
+    }
+
+
+def reset():
+    _histograms.clear()
+    if watchdog:
+        watchdog.lag = Histogram()
+
+
+def dump():
+    snap = snapshot()
+    print(f"[instrument] {'stage':28} {'count':>8} {'p50':>9} {'p99':>9} {'p999':>9} {'max':>9}  (us)")
+    for name, s in snap["stages"].items():
+        print(f"[instrument] {name:28} {s['count']:>8} {s['p50_us']:>9} {s['p99_us']:>9} {s['p999_us']:>9} {s['max_us']:>9}")
+    if snap["loop"]:
+        lag = snap["loop"]["lag"]
+        print(f"[instrument] loop lag p50={lag['p50_us']}us p99={lag['p99_us']}us max={lag['max_us']}us "
+              f"stalls={snap['loop']['stalls']}", flush=True)
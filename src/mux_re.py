@@ -0,0 +1,260 @@
+import hashlib
+import os
+import random
+import struct
+import weakref
+import zlib
+from collections import OrderedDict
+from typing import List, Optional
+
+import mux_wire
+
+# -----------------------
+# Redundancy elimination over the mux link
+# -----------------------
+# Both ends of a mux link keep the same bounded cache of recently sent chunks, so
+# a chunk the link has already carried, on any stream, goes out again as a short
+# reference: a response repeated on a new stream is a hit too.
+#
+# Negotiated per stream (both mux dialects), cached per link:
+#   opener -> RE(version, cache KiB) right behind its OPEN
+#   peer   -> RE(version, agreed KiB), or nothing when it declines or predates RE
+# The first accepted offer creates the link's Session; later offers on the link are
+# answered with its size. From its RE onwards each side may send RE_DATA instead of
+# DATA on that stream; each direction has its own cache pair. Peers that do not
+# know RE ignore the offer, and the stream simply stays plain DATA.
+#
+# Caches stay in step because both ends apply the same inserts, touches and
+# evictions in the same order. So RE_DATA is encoded when the frame is written to
+# the link, after the schedulers have picked the order (never when it is queued;
+# a frame dropped from a queue then never touched the cache), and the receiver
+# decodes every RE_DATA it reads, in read order, even for a stream it has closed.
+# A Desync leaves the decoder out of step for good: every later RE_DATA on the link
+# fails too (those streams are closed) and further offers are declined.
+# A sharded front (mux_shard.py) never forwards offers: each worker sees only part
+# of the link.
+#
+# RE_DATA body: crc32(4) of the decoded bytes, then items, each starting with a varint v:
+#   v & 1 == 0   literal: v >> 1 bytes follow; cached when at least MIN_CHUNK long
+#   v & 1 == 1   reference: chunk number v >> 1 (numbered in cache insertion order)
+# A CRC mismatch, an unknown chunk or more than mux_wire.MAX_FRAME decoded bytes
+# raises Desync; the stream is then closed.
+#
+# Chunks are content-defined (gear rolling hash), so an insert or a different TCP
+# segmentation only changes the chunks around it. The chunker is plain Python
+# (on the order of 10 MB/s per core), so this is for the constrained uplink, not LAN speeds.
+#
+# Off unless SOCKS_PROXY_RE_KB is set: the cache size per link and direction, in KiB.
+
+VERSION = 2  # 1 kept a cache per stream
+CACHE_KB = int(os.environ.get("SOCKS_PROXY_RE_KB", "0"))
+ENABLED = CACHE_KB > 0
+MAX_LINKS = int(os.environ.get("SOCKS_PROXY_RE_LINKS", "256"))  # RE sessions at once, per process
+
+MIN_CHUNK = 48    # at least WINDOW; small enough to isolate the changing fields of short records
+MAX_CHUNK = 4096
+AVG_BITS = 6     # a cut every ~2**AVG_BITS bytes past MIN_CHUNK
+WINDOW = 32      # the 32-bit gear hash only depends on the last 32 bytes
+_CUT_MASK = ((1 << AVG_BITS) - 1) << (32 - AVG_BITS)  # top bits: they see the whole window
+# Fixed seed: both ends must cut at the same places
+_rng = random.Random(0x5EC0DE)
+_GEAR = [_rng.getrandbits(32) for _ in range(256)]
+del _rng
+
+counters = {"offered": 0, "accepted": 0, "declined": 0, "bytes_in": 0, "bytes_out": 0,
+            "chunk_hits": 0, "chunk_misses": 0, "evictions": 0, "decoded_bytes": 0, "desyncs": 0}
+_sessions = weakref.WeakSet()
+
+
+class Desync(ValueError):
+    pass
+
+
+def cut_points(data) -> List[int]:
+    """End offsets of the content-defined chunks of data (the last one is len(data))."""
+    n = len(data)
+    cuts = []
+    start = 0
+    gear, mask = _GEAR, _CUT_MASK
+    while n - start > MIN_CHUNK:
+        # Warm the hash on the window before the first allowed cut, so cuts depend on content only
+        h = 0
+        for b in data[start + MIN_CHUNK - WINDOW:start + MIN_CHUNK]:
+            h = ((h << 1) + gear[b]) & 0xFFFFFFFF
+        end = min(n, start + MAX_CHUNK)
+        pos = start + MIN_CHUNK
+        for b in data[pos:end]:
+            h = ((h << 1) + gear[b]) & 0xFFFFFFFF
+            pos += 1
+            if not h & mask:
+                break
+        cuts.append(pos)
+        start = pos
+    if start < n:
+        cuts.append(n)
+    return cuts
+
+
+class Encoder:
+    """Sending half: digest -> (chunk number, length), in LRU order."""
+    __slots__ = ("budget", "size", "index", "next_id")
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.size = 0
+        self.index: "OrderedDict[bytes, tuple]" = OrderedDict()
+        self.next_id = 0
+
+    def encode(self, data: bytes) -> bytes:
+        out = bytearray(struct.pack("!I", zlib.crc32(data)))
+        view = memoryview(data)
+        start = 0
+        for end in cut_points(data):
+            chunk = view[start:end]
+            start = end
+            if len(chunk) >= MIN_CHUNK:
+                key = hashlib.blake2b(chunk, digest_size=8).digest()
+                hit = self.index.get(key)
+                if hit is not None:
+                    self.index.move_to_end(key)
+                    out += mux_wire.encode_varint(hit[0] << 1 | 1)
+                    counters["chunk_hits"] += 1
+                    continue
+                counters["chunk_misses"] += 1
+                self.index[key] = (self.next_id, len(chunk))
+                self.next_id += 1
+                self.size += len(chunk)
+                while self.size > self.budget:
+                    self.size -= self.index.popitem(last=False)[1][1]
+                    counters["evictions"] += 1
+            out += mux_wire.encode_varint(len(chunk) << 1)
+            out += chunk
+        counters["bytes_in"] += len(data)
+        counters["bytes_out"] += len(out)
+        return bytes(out)
+
+
+class Decoder:
+    """Receiving half: chunk number -> bytes, mirroring the peer's Encoder."""
+    __slots__ = ("budget", "size", "chunks", "next_id", "broken")
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.size = 0
+        self.chunks: "OrderedDict[int, bytes]" = OrderedDict()
+        self.next_id = 0
+        self.broken = False  # a Desync happened: no longer in step with the peer
+
+    def decode(self, body, limit: int = mux_wire.MAX_FRAME) -> bytes:
+        """The bytes of an RE_DATA body; Desync if it is bad or would decode to more than limit."""
+        if self.broken:
+            raise Desync("RE cache out of step")
+        try:
+            return self._decode(body, limit)
+        except Desync:
+            self.broken = True
+            counters["desyncs"] += 1
+            raise
+
+    def _decode(self, body, limit: int) -> bytes:
+        if len(body) < 4:
+            raise Desync("truncated RE_DATA")
+        crc = struct.unpack_from("!I", body)[0]
+        out = bytearray()
+        pos = 4
+        try:
+            while pos < len(body):
+                v, pos = mux_wire.decode_varint(body, pos)
+                if v & 1:
+                    ref = v >> 1
+                    chunk = self.chunks[ref]
+                    self.chunks.move_to_end(ref)
+                else:
+                    chunk = bytes(body[pos:pos + (v >> 1)])
+                    pos += v >> 1
+                    if len(chunk) >= MIN_CHUNK:
+                        self.chunks[self.next_id] = chunk
+                        self.next_id += 1
+                        self.size += len(chunk)
+                        while self.size > self.budget:
+                            self.size -= len(self.chunks.popitem(last=False)[1])
+                # References are small and chunks are not: bound the output, not the body
+                if len(out) + len(chunk) > limit:
+                    raise Desync(f"RE_DATA decodes to more than {limit} bytes")
+                out += chunk
+        except (KeyError, IndexError) as e:
+            raise Desync(f"unknown chunk {e}") from None
+        if pos != len(body) or zlib.crc32(out) != crc:
+            raise Desync("RE_DATA checksum mismatch")
+        counters["decoded_bytes"] += len(out)
+        return bytes(out)
+
+
+class Session:
+    """One link's RE state: an Encoder for what we send, a Decoder for what we receive."""
+    __slots__ = ("kb", "encoder", "decoder", "__weakref__")
+
+    def __init__(self, kb: int):
+        self.kb = kb
+        self.encoder = Encoder(kb * 1024)
+        self.decoder = Decoder(kb * 1024)
+        _sessions.add(self)
+
+    def encode(self, data: bytes) -> bytes:
+        return self.encoder.encode(data)
+
+    def decode(self, body) -> bytes:
+        return self.decoder.decode(body)
+
+    @property
+    def broken(self) -> bool:
+        return self.decoder.broken
+
+
+# -----------------------
+# Negotiation
+# -----------------------
+
+def encode_offer(kb: int) -> bytes:
+    """RE frame body: version(1) cache_kb(varint)."""
+    return bytes((VERSION,)) + mux_wire.encode_varint(kb)
+
+
+def decode_offer(body) -> int:
+    """RE frame body -> cache KiB; 0 when the version is not ours."""
+    if len(body) < 2 or body[0] != VERSION:
+        return 0
+    return mux_wire.decode_varint(body, 1)[0]
+
+
+def offer() -> bytes:
+    """The opener's RE body, or b"" when RE is off here."""
+    if not ENABLED:
+        return b""
+    counters["offered"] += 1
+    return encode_offer(CACHE_KB)
+
+
+def accept(body, session: Optional[Session] = None) -> int:
+    """
+    Peer side of an offer on a link whose Session (if it has one yet) is session:
+    the agreed cache KiB, or 0 to decline (and not reply).
+    """
+    if session is not None:
+        kb = 0 if session.broken or not decode_offer(body) else session.kb
+    else:
+        kb = min(decode_offer(body), CACHE_KB)
+        if len(_sessions) >= MAX_LINKS:
+            kb = 0
+    if not ENABLED or kb <= 0:
+        counters["declined"] += 1
+        return 0
+    counters["accepted"] += 1
+    return kb
+
+
+def stats() -> dict:
+    hits, misses = counters["chunk_hits"], counters["chunk_misses"]
+    return dict(counters, enabled=ENABLED, cache_kb=CACHE_KB, sessions=len(_sessions),
+                bytes_saved=counters["bytes_in"] - counters["bytes_out"],
+                hit_rate=round(hits / (hits + misses), 3) if hits + misses else 0.0)
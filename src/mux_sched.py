@@ -0,0 +1,389 @@
+import asyncio
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+import splice
+
+# -----------------------
+# Mux stream scheduling
+# -----------------------
+# Frames wait in one FIFO per stream, and streams are grouped by priority (7 = highest).
+# A level is served only while every level above it is empty; inside a level the
+# streams share by deficit round robin, in proportion to their weight (1..255).
+#
+# reprioritize() moves a stream to another level and weight together with everything
+# it has queued. Its frames never leave the stream's own FIFO, so they keep their
+# order. Peers carry the change with the PRIORITY control frame (mux_wire.PRIORITY).
+
+LEVELS = 8
+DEFAULT_WEIGHT = 16
+QUANTUM = 256  # bytes a stream may send per round, per unit of weight
+
+
+class _Stream:
+    __slots__ = ("sid", "priority", "weight", "frames", "deficit", "turn", "active", "done")
+
+    def __init__(self, sid: int, priority: int, weight: int):
+        self.sid = sid
+        self.priority = priority
+        self.weight = weight
+        self.frames: Deque[Tuple[Any, int]] = deque()  # (item, size)
+        self.deficit = 0
+        self.turn = False    # its quantum for the current round was already added
+        self.active = False  # in its level's round-robin
+        self.done = False    # forget it once drained
+
+
+def _clamp(priority: int, weight: int) -> Tuple[int, int]:
+    return max(0, min(LEVELS - 1, priority)), max(1, min(255, weight))
+
+
+class StreamQueues:
+    """Per-stream FIFOs scheduled by priority level, then weighted round robin."""
+    __slots__ = ("levels", "streams", "frames", "bytes")
+
+    def __init__(self):
+        self.levels: List[Deque[_Stream]] = [deque() for _ in range(LEVELS)]
+        self.streams: Dict[int, _Stream] = {}
+        self.frames = 0
+        self.bytes = 0
+
+    def stream(self, sid: int, priority: int = 0, weight: int = DEFAULT_WEIGHT) -> _Stream:
+        """The stream's record, created with this priority/weight if it is new."""
+        s = self.streams.get(sid)
+        if s is None:
+            s = self.streams[sid] = _Stream(sid, *_clamp(priority, weight))
+        s.done = False
+        return s
+
+    def push(self, sid: int, item, size: int, priority: int = 0):
+        """Queue item at the back of its stream; priority only applies to a stream not seen before."""
+        s = self.streams.get(sid) or self.stream(sid, priority)
+        s.frames.append((item, size))
+        self.frames += 1
+        self.bytes += size
+        if not s.active:
+            s.active = True
+            self.levels[s.priority].append(s)
+
+    def pop(self, skip=()) -> Optional[Tuple[int, Any, int, int]]:
+        """
+        (sid, item, size, priority) of the next frame to send, or None when nothing is
+        queued. Priority levels in skip are passed over (e.g. a class over its rate).
+        """
+        for priority in range(LEVELS - 1, -1, -1):
+            if priority in skip:
+                continue
+            level = self.levels[priority]
+            while level:
+                s = level[0]
+                if not s.turn:
+                    s.deficit += s.weight * QUANTUM
+                    s.turn = True
+                item, size = s.frames[0]
+                if size <= s.deficit:
+                    s.frames.popleft()
+                    s.deficit -= size
+                    self.frames -= 1
+                    self.bytes -= size
+                    if not s.frames:
+                        self._idle(s, level)
+                    return s.sid, item, size, priority
+                # Out of credit for this round: next stream
+                s.turn = False
+                level.rotate(-1)
+        return None
+
+    def unpop(self, sid: int, item, size: int, priority: int = 0):
+        """Put back a frame pop() returned (e.g. it did not fit the send budget)."""
+        s = self.stream(sid, priority)
+        s.frames.appendleft((item, size))
+        s.deficit += size
+        s.turn = True
+        self.frames += 1
+        self.bytes += size
+        if not s.active:
+            s.active = True
+            self.levels[s.priority].appendleft(s)
+
+    def _idle(self, s: _Stream, level: Deque[_Stream]):
+        level.popleft()
+        s.active = s.turn = False
+        s.deficit = 0
+        if s.done:
+            del self.streams[s.sid]
+
+    def reprioritize(self, sid: int, priority: int, weight: int = DEFAULT_WEIGHT):
+        s = self.stream(sid, priority, weight)
+        priority, weight = _clamp(priority, weight)
+        if s.active and priority != s.priority:
+            self.levels[s.priority].remove(s)
+            self.levels[priority].append(s)
+            s.turn = False
+        s.priority, s.weight = priority, weight
+
+    def depth(self, sid: int) -> Tuple[int, int]:
+        """(frames, bytes) the stream has queued."""
+        s = self.streams.get(sid)
+        if s is None:
+            return 0, 0
+        return len(s.frames), sum(size for _, size in s.frames)
+
+    def finish(self, sid: int):
+        """The stream will queue nothing more: forget it once its queued frames are out."""
+        s = self.streams.get(sid)
+        if s is None:
+            return
+        if s.frames:
+            s.done = True
+        else:
+            del self.streams[sid]
+
+    def clear(self):
+        for level in self.levels:
+            level.clear()
+        self.streams.clear()
+        self.frames = self.bytes = 0
+
+
+class PriorityGate(splice.Gate):
+    """
+    splice.Gate for a mux return path. Frames go straight to the upstream writer while
+    it keeps up; once its buffer passes splice.FEED_HIGH_WATER they queue in
+    StreamQueues and go out by stream priority as it drains. A stream's feed is
+    paused at a share of the high-water mark that grows with its priority, so when
+    the upstream backs up the low classes stop reading first.
+    A frame may also be queued unbuilt (send_later) and built as it is written.
+    """
+    __slots__ = ("queues", "feeds", "sids")
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        super().__init__(writer)
+        self.queues = StreamQueues()
+        self.feeds: Dict[int, splice.Feed] = {}
+        self.sids: Dict[splice.Feed, int] = {}
+
+    def open(self, sid: int, priority: int, weight: int = DEFAULT_WEIGHT):
+        self.queues.stream(sid, priority, weight)
+
+    def bind(self, sid: int, feed: splice.Feed):
+        """The target feed that produces sid's frames."""
+        self.feeds[sid] = feed
+        self.sids[feed] = sid
+
+    def send(self, sid: int, frame: bytes):
+        transport = self.writer.transport
+        if not self.queues.frames and transport.get_write_buffer_size() <= splice.FEED_HIGH_WATER:
+            transport.write(frame)
+            return
+        self.queues.push(sid, frame, len(frame))
+        if self.waiter is None:
+            self.waiter = asyncio.ensure_future(self._release())
+
+    def send_later(self, sid: int, build: Callable[[], bytes], size: int):
+        """
+        send() a frame that build() makes when it is written, so what build() does
+        happens in wire order (mux_re encoding). size stands in for its length in the queue.
+        """
+        transport = self.writer.transport
+        if not self.queues.frames and transport.get_write_buffer_size() <= splice.FEED_HIGH_WATER:
+            transport.write(build())
+            return
+        self.queues.push(sid, build, size)
+        if self.waiter is None:
+            self.waiter = asyncio.ensure_future(self._release())
+
+    def describe(self, sid: int) -> dict:
+        """Scheduling state of one stream, for the admin "conns" listing."""
+        s = self.queues.streams.get(sid)
+        frames, nbytes = self.queues.depth(sid)
+        return {"stream": sid, "priority": s.priority if s else None, "weight": s.weight if s else None,
+                "queued_frames": frames, "queued": nbytes}
+
+    def close(self, sid: int):
+        self.queues.finish(sid)
+        feed = self.feeds.pop(sid, None)
+        if feed is not None:
+            self.sids.pop(feed, None)
+
+    def check(self, feed: splice.Feed):
+        limit = splice.FEED_HIGH_WATER * (self._priority(feed) + 1) // LEVELS
+        if self.queues.bytes + self.writer.transport.get_write_buffer_size() <= limit:
+            return
+        feed.transport.pause_reading()
+        self.paused.append(feed)
+        if self.waiter is None:
+            self.waiter = asyncio.ensure_future(self._release())
+
+    async def _release(self):
+        try:
+            while True:
+                await self.writer.drain()
+                if self._flush():
+                    continue
+                if not self._resume_top():
+                    break
+                # One loop pass to register the resumed readers, one for their data to
+                # arrive, before the next class down gets its turn
+                await asyncio.sleep(0)
+                await asyncio.sleep(0)
+        except Exception:
+            self.queues.clear()
+        finally:
+            paused, self.paused, self.waiter = self.paused, [], None
+            for feed in paused:
+                if not feed.transport.is_closing():
+                    feed.transport.resume_reading()
+
+    def _priority(self, feed: splice.Feed) -> int:
+        s = self.queues.streams.get(self.sids.get(feed))
+        return s.priority if s else LEVELS - 1
+
+    def _resume_top(self) -> bool:
+        """Resume the paused feeds of the highest priority class; False if none were paused."""
+        if not self.paused:
+            return False
+        top = max(self._priority(f) for f in self.paused)
+        keep = []
+        for feed in self.paused:
+            if self._priority(feed) != top:
+                keep.append(feed)
+            elif not feed.transport.is_closing():
+                feed.transport.resume_reading()
+        self.paused = keep
+        return True
+
+    def _flush(self) -> bool:
+        """Write queued frames, highest priority first, until the buffer is full again. True if some remain."""
+        transport = self.writer.transport
+        while self.queues.frames:
+            if transport.is_closing():
+                self.queues.clear()
+                return False
+            if transport.get_write_buffer_size() > splice.FEED_HIGH_WATER:
+                return True
+            frame = self.queues.pop()[1]
+            transport.write(frame() if callable(frame) else frame)
+        return False
+
+
+# -----------------------
+# Queue memory
+# -----------------------
+# QueueBudget bounds what a producer may have queued: in total, per priority class
+# and per stream. reserve() waits while any of the three is full, so a producer
+# that awaits it (and stops reading its source meanwhile) is held back instead of
+# growing the queue. Each level always admits one frame when it holds nothing,
+# so a frame larger than a quota still goes through.
+#
+# BufferPool keeps frame buffers in power-of-two size classes for reuse: a producer
+# reads straight into one (PPP.pump) and it comes back once the link has flushed it.
+
+QUEUE_BUDGET = 4 * 1024 * 1024
+CLASS_QUOTA = QUEUE_BUDGET // 2    # default for every class
+STREAM_QUOTA = 256 * 1024
+
+POOL_MIN_SHIFT = 8                 # 256-byte buffers ...
+POOL_MAX_SHIFT = 16                # ... up to 64 KiB; larger frames are not pooled
+POOL_MAX_FREE = QUEUE_BUDGET // 2  # free bytes kept for reuse
+
+
+class QueueBudget:
+    __slots__ = ("total", "class_quota", "stream_quota", "used", "by_class", "by_stream",
+                 "waiters", "waits", "peak")
+
+    def __init__(self, total: int = QUEUE_BUDGET, class_quota: Optional[Dict[int, int]] = None,
+                 stream_quota: int = STREAM_QUOTA):
+        self.total = total
+        self.class_quota = {p: CLASS_QUOTA for p in range(LEVELS)}
+        self.class_quota.update(class_quota or {})
+        self.stream_quota = stream_quota
+        self.used = 0
+        self.by_class = [0] * LEVELS
+        self.by_stream: Dict[int, int] = {}
+        self.waiters: List[asyncio.Future] = []
+        self.waits = 0   # reserve() calls that had to wait
+        self.peak = 0
+
+    def fits(self, sid: int, priority: int, n: int) -> bool:
+        s = self.by_stream.get(sid, 0)
+        c = self.by_class[priority]
+        return ((not s or s + n <= self.stream_quota)
+                and (not c or c + n <= self.class_quota[priority])
+                and (not self.used or self.used + n <= self.total))
+
+    def charge(self, sid: int, priority: int, n: int):
+        """Account n bytes without waiting (control frames, and reserve() itself)."""
+        self.used += n
+        self.by_class[priority] += n
+        self.by_stream[sid] = self.by_stream.get(sid, 0) + n
+        if self.used > self.peak:
+            self.peak = self.used
+
+    async def reserve(self, sid: int, priority: int, n: int):
+        """Wait until n more bytes fit the stream's, its class's and the total quota, then charge them."""
+        if not self.fits(sid, priority, n):
+            self.waits += 1
+            loop = asyncio.get_running_loop()
+            while not self.fits(sid, priority, n):
+                fut = loop.create_future()
+                self.waiters.append(fut)
+                try:
+                    await fut
+                except asyncio.CancelledError:
+                    if fut in self.waiters:
+                        self.waiters.remove(fut)
+                    raise
+        self.charge(sid, priority, n)
+
+    def release(self, sid: int, priority: int, n: int):
+        self.used -= n
+        self.by_class[priority] -= n
+        left = self.by_stream.get(sid, 0) - n
+        if left > 0:
+            self.by_stream[sid] = left
+        else:
+            self.by_stream.pop(sid, None)
+        if self.waiters:
+            # Everyone re-checks; the ones that still do not fit wait again
+            waiters, self.waiters = self.waiters, []
+            for fut in waiters:
+                if not fut.done():
+                    fut.set_result(None)
+
+    def stats(self) -> dict:
+        return {"used": self.used, "total": self.total, "peak": self.peak, "waits": self.waits,
+                "waiting": len(self.waiters), "streams": len(self.by_stream),
+                "by_class": {p: n for p, n in enumerate(self.by_class) if n}}
+
+
+class BufferPool:
+    __slots__ = ("free", "free_bytes", "hits", "misses")
+
+    def __init__(self):
+        self.free: List[List[bytearray]] = [[] for _ in range(POOL_MAX_SHIFT + 1)]
+        self.free_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, n: int) -> Optional[bytearray]:
+        """A buffer of at least n bytes, or None when n is larger than the biggest pooled size."""
+        shift = max(POOL_MIN_SHIFT, (n - 1).bit_length())
+        if shift > POOL_MAX_SHIFT:
+            return None
+        bucket = self.free[shift]
+        if bucket:
+            self.hits += 1
+            self.free_bytes -= 1 << shift
+            return bucket.pop()
+        self.misses += 1
+        return bytearray(1 << shift)
+
+    def put(self, buf: bytearray):
+        if self.free_bytes + len(buf) > POOL_MAX_FREE:
+            return  # let it go; the pool only smooths steady-state churn
+        self.free[len(buf).bit_length() - 1].append(buf)
+        self.free_bytes += len(buf)
+
+    def stats(self) -> dict:
+        return {"free_bytes": self.free_bytes, "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,195 @@
+import asyncio
+import itertools
+import multiprocessing
+import os
+import socket
+from typing import Dict, List, Set
+
+import flow_log
+import mux_wire
+import ppp_mux_server as pms
+import tls_link
+from ppp_mux_server import ATYP_NONE, MSG_CLOSE, MSG_OPEN, MSG_PAUSE, MSG_RE, MSG_RESUME
+
+# -----------------------
+# Sharded mux server
+# -----------------------
+# The front process accepts PPP mux connections and only decodes frames. Each
+# stream is owned by one worker process, picked by hashing (connection, stream_id);
+# the worker holds the target socket and does all target I/O.
+#
+# Front <-> worker links are socketpairs speaking the compact mux protocol, so a
+# worker is just ppp_mux_server.handle_mux_connection on its end of the link.
+# Stream ids on a link carry the front's connection id in the high bits:
+#   link_sid = conn_id << SID_BITS | stream_id
+# Return frames from every worker are written to the PPP connection by the front,
+# in arrival order; frames of one stream always come from one worker, so they stay ordered.
+# The front never waits on a PPP connection while reading a worker link: once a
+# connection has more than CONN_HIGH_WATER bytes queued, its streams are PAUSEd in
+# the workers (their target reads stop) and RESUMEd when it has drained.
+# RE offers are not forwarded: its cache is link-wide, and a worker only sees its
+# own streams of the link. Unanswered, the PPP keeps sending plain DATA.
+
+SID_BITS = 32
+SID_MASK = (1 << SID_BITS) - 1
+CONN_HIGH_WATER = 256 * 1024
+
+
+def worker_main(sock: socket.socket):
+    """Worker process entry point: serve the front over one socketpair end."""
+    asyncio.run(_serve_link(sock))
+
+
+async def _serve_link(sock: socket.socket):
+    pms.target_pool.start()
+    flow_log.start("mux")
+    reader, writer = await asyncio.open_connection(sock=sock)
+    await pms.handle_mux_connection(reader, writer)
+
+
+class _Conn:
+    """One PPP mux connection as seen by the front."""
+    __slots__ = ("writer", "encode", "sids", "held")
+
+    def __init__(self, writer: asyncio.StreamWriter, encode):
+        self.writer = writer
+        self.encode = encode
+        self.sids: Set[int] = set()
+        self.held = False  # streams PAUSEd until the writer drains
+
+
+class ShardedFront:
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.links: List[asyncio.StreamWriter] = []
+        self.procs: List[multiprocessing.Process] = []
+        self.conns: Dict[int, _Conn] = {}
+        self._conn_ids = itertools.count(1)
+
+    async def start(self):
+        # spawn, not fork: the front already has a running event loop
+        ctx = multiprocessing.get_context("spawn")
+        for i in range(self.workers):
+            front_end, worker_end = socket.socketpair()
+            proc = ctx.Process(target=worker_main, args=(worker_end,), name=f"mux-worker-{i}", daemon=True)
+            proc.start()
+            worker_end.close()
+            self.procs.append(proc)
+            reader, writer = await asyncio.open_connection(sock=front_end)
+            await mux_wire.client_hello(reader, writer)
+            self.links.append(writer)
+            asyncio.create_task(self._from_worker(i, reader))
+        print(f"[shard] {self.workers} workers: {[p.pid for p in self.procs]}")
+
+    def link_for(self, conn_id: int, stream_id: int) -> asyncio.StreamWriter:
+        return self.links[hash((conn_id, stream_id)) % len(self.links)]
+
+    async def _from_worker(self, index: int, reader: asyncio.StreamReader):
+        try:
+            while True:
+                frame = await pms.read_compact_frame(reader)
+                conn = self.conns.get(frame.stream_id >> SID_BITS)
+                if conn is None:
+                    continue  # PPP connection already gone
+                sid = frame.stream_id & SID_MASK
+                if frame.msg_type == MSG_CLOSE:
+                    conn.sids.discard(sid)
+                conn.writer.write(conn.encode(frame.msg_type, flags=0, atyp=ATYP_NONE, stream_id=sid, payload=frame.payload))
+                if not conn.held and conn.writer.transport.get_write_buffer_size() > CONN_HIGH_WATER:
+                    conn.held = True
+                    asyncio.create_task(self._hold(frame.stream_id >> SID_BITS, conn))
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            print(f"[shard] worker {index} link lost: {e!r}")
+
+    def _signal(self, conn_id: int, sid: int, msg_type: int):
+        self.link_for(conn_id, sid).write(pms.encode_compact_frame(msg_type, 0, ATYP_NONE, conn_id << SID_BITS | sid))
+
+    async def _hold(self, conn_id: int, conn: _Conn):
+        """Pause one backed-up PPP connection's streams in the workers until it drains."""
+        for sid in conn.sids:
+            self._signal(conn_id, sid, MSG_PAUSE)
+        try:
+            await conn.writer.drain()
+        except Exception:
+            return  # connection gone; handle() closes its streams
+        conn.held = False
+        if self.conns.get(conn_id) is conn:
+            for sid in conn.sids:
+                self._signal(conn_id, sid, MSG_RESUME)
+
+    async def handle(self, mux_reader: asyncio.StreamReader, mux_writer: asyncio.StreamWriter):
+        peer = mux_writer.get_extra_info("peername")
+        conn_id = next(self._conn_ids)
+        base = conn_id << SID_BITS
+        print(f"[shard] connected: {peer} as conn {conn_id}")
+        conn = None
+        try:
+            caps, prefix = await mux_wire.accept_hello(mux_reader, mux_writer)
+            if caps >= 0:
+                read, encode = pms.read_compact_frame, pms.encode_compact_frame
+            else:
+                read, encode = pms.read_frame, pms.encode_frame
+            conn = self.conns[conn_id] = _Conn(mux_writer, encode)
+
+            while True:
+                if prefix:
+                    frame = await pms.read_frame(mux_reader, prefix)
+                    prefix = b""
+                else:
+                    frame = await read(mux_reader)
+                if frame.stream_id > SID_MASK:
+                    raise ValueError(f"stream id out of range: {frame.stream_id}")
+
+                if frame.msg_type == MSG_RE:
+                    continue
+                if frame.msg_type == MSG_OPEN:
+                    conn.sids.add(frame.stream_id)
+                elif frame.msg_type == MSG_CLOSE:
+                    conn.sids.discard(frame.stream_id)
+                link = self.link_for(conn_id, frame.stream_id)
+                link.write(pms.encode_compact_frame(frame.msg_type, frame.flags, frame.atyp, base | frame.stream_id,
+                                                    meta=frame.meta, payload=frame.payload))
+                if frame.msg_type == MSG_OPEN and conn.held:
+                    self._signal(conn_id, frame.stream_id, MSG_PAUSE)
+                await link.drain()
+
+        except asyncio.IncompleteReadError:
+            print(f"[shard] disconnected: {peer}")
+        except (ValueError, mux_wire.HelloError) as e:
+            print(f"[shard] protocol error from {peer}: {e}")
+        finally:
+            # Workers release the targets of every stream this connection left open
+            self.conns.pop(conn_id, None)
+            for sid in conn.sids if conn else ():
+                self.link_for(conn_id, sid).write(
+                    pms.encode_compact_frame(MSG_CLOSE, 0, ATYP_NONE, base | sid, payload=b"ppp_gone"))
+            try:
+                mux_writer.close()
+                await mux_writer.wait_closed()
+            except Exception:
+                pass
+
+    def stop(self):
+        for p in self.procs:
+            p.terminate()
+
+
+async def main(host="0.0.0.0", port=9000, workers=0):
+    """workers=0 runs one worker per core."""
+    front = ShardedFront(workers or os.cpu_count() or 1)
+    await front.start()
+    server = await asyncio.start_server(front.handle, host, port, ssl=tls_link.server_context())
+    addrs = ", ".join(str(s.getsockname()) for s in server.sockets or [])
+    print(f"PPP mux server (sharded x{front.workers}) listening on {addrs}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        front.stop()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main(workers=int(os.environ.get("MUX_WORKERS", "0"))))
+    except KeyboardInterrupt:
+        pass
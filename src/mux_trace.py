@@ -0,0 +1,218 @@
+import argparse
+import itertools
+import os
+import struct
+import time
+from collections import Counter
+from typing import Iterator, NamedTuple, Optional
+
+import mux_wire
+
+# -----------------------
+# Mux frame traces
+# -----------------------
+# Off unless SOCKS_PROXY_MUX_TRACE_DIR is set. Each mux connection then gets an
+# append-only trace of every frame it reads (RX) and writes (TX):
+#   <dir>/mux-<component>-<pid>-<conn>.mxt
+# SOCKS_PROXY_MUX_TRACE_PAYLOAD=1 also keeps DATA bodies; otherwise only their length.
+# BENCH/mux_replay.py plays a trace back against a mux server or client.
+#
+# File: magic "MXT1" version(1) flags(1) wall_start(f64) component(u8 len) peer(u8 len)
+# Record:
+#   dt_us(varint)    time since the previous record
+#   head(1)          bit 7 = TX, bit 6 = priority follows, bit 5 = body follows, low nibble = type
+#   [priority(1)]
+#   stream_id(varint) length(varint)   body length, also when the body is not kept
+#   [body(length)]
+# OPEN records always keep their target in mux_wire.pack_addr layout, whatever the
+# dialect of the connection, so a trace replays against either mux server.
+
+TRACE_DIR = os.environ.get("SOCKS_PROXY_MUX_TRACE_DIR", "")
+TRACE_PAYLOAD = os.environ.get("SOCKS_PROXY_MUX_TRACE_PAYLOAD", "0") not in ("", "0")
+ENABLED = bool(TRACE_DIR)
+
+# Records are built in memory and reach the file in chunks of this size
+TRACE_BUFFER = 256 * 1024
+
+MAGIC = b"MXT1"
+VERSION = 1
+FLAG_PAYLOAD = 0x01
+_HDR = struct.Struct("!4sBBd")
+
+RX, TX = 0, 1
+_TX_BIT, _PRIO_BIT, _BODY_BIT = 0x80, 0x40, 0x20
+
+# Message types shared by both mux dialects
+OPEN, DATA, CLOSE, PRIORITY, RE, RE_DATA, PAUSE, RESUME = 1, 2, 3, 4, 5, 6, 7, 8
+NAMES = {OPEN: "open", DATA: "data", CLOSE: "close", PRIORITY: "priority", RE: "re", RE_DATA: "re_data",
+         PAUSE: "pause", RESUME: "resume"}
+
+_conn_ids = itertools.count(1)
+
+
+class Recorder:
+    """Appends the frames of one mux connection to a trace file."""
+    __slots__ = ("file", "payload", "last", "frames")
+
+    def __init__(self, path: str, component: str, peer: str, payload: bool):
+        self.file = open(path, "ab", buffering=TRACE_BUFFER)
+        self.payload = payload
+        self.last = time.monotonic()
+        self.frames = 0
+        comp_b, peer_b = component.encode()[:255], peer.encode()[:255]
+        self.file.write(_HDR.pack(MAGIC, VERSION, FLAG_PAYLOAD if payload else 0, time.time())
+                        + bytes((len(comp_b),)) + comp_b + bytes((len(peer_b),)) + peer_b)
+
+    def _record(self, direction: int, msg_type: int, stream_id: int, priority: int, body: bytes, keep: bool):
+        now = time.monotonic()
+        dt, self.last = int((now - self.last) * 1e6), now
+        head = (msg_type & 0x0F) | (_TX_BIT if direction == TX else 0)
+        if priority >= 0:
+            head |= _PRIO_BIT
+        if keep and body:
+            head |= _BODY_BIT
+        parts = [mux_wire.encode_varint(dt), bytes((head, priority & 0xFF)) if priority >= 0 else bytes((head,)),
+                 mux_wire.encode_varint(stream_id), mux_wire.encode_varint(len(body))]
+        if head & _BODY_BIT:
+            parts.append(body)
+        self.file.write(b"".join(parts))
+        self.frames += 1
+
+    def rx(self, msg_type: int, stream_id: int, priority: int = -1, body: bytes = b""):
+        self._record(RX, msg_type, stream_id, priority, body, self.payload)
+
+    def tx(self, msg_type: int, stream_id: int, priority: int = -1, body: bytes = b""):
+        self._record(TX, msg_type, stream_id, priority, body, self.payload)
+
+    def open(self, direction: int, stream_id: int, host: str, port: int, priority: int = -1):
+        """An OPEN with its target, kept regardless of the payload setting."""
+        self._record(direction, OPEN, stream_id, priority, mux_wire.pack_addr(host, port), True)
+
+    def close(self):
+        try:
+            self.file.close()
+        except OSError:
+            pass
+
+
+def enable(trace_dir: str = "", payload: Optional[bool] = None) -> dict:
+    """Turn tracing on for mux connections opened from now on (e.g. from the admin socket)."""
+    global TRACE_DIR, TRACE_PAYLOAD, ENABLED
+    TRACE_DIR = trace_dir or TRACE_DIR
+    if not TRACE_DIR:
+        raise ValueError("no trace directory: pass one or set SOCKS_PROXY_MUX_TRACE_DIR")
+    if payload is not None:
+        TRACE_PAYLOAD = bool(payload)
+    ENABLED = True
+    return {"enabled": ENABLED, "dir": TRACE_DIR, "payload": TRACE_PAYLOAD}
+
+
+def disable() -> dict:
+    """Stop tracing new mux connections; ones already recording keep going until they end."""
+    global ENABLED
+    ENABLED = False
+    return {"enabled": ENABLED, "dir": TRACE_DIR, "payload": TRACE_PAYLOAD}
+
+
+def configure(on: bool = True, dir: str = "", payload: Optional[bool] = None) -> dict:
+    """enable()/disable() in one call, as the admin "trace" command."""
+    return enable(dir, payload) if on else disable()
+
+
+def recorder(component: str, peer) -> Optional[Recorder]:
+    """A Recorder for a new mux connection, or None when tracing is off."""
+    if not ENABLED:
+        return None
+    if isinstance(peer, tuple):
+        peer = f"{peer[0]}:{peer[1]}"
+    os.makedirs(TRACE_DIR, exist_ok=True)
+    path = os.path.join(TRACE_DIR, f"mux-{component}-{os.getpid()}-{next(_conn_ids)}.mxt")
+    print(f"[trace] recording mux frames to {path}")
+    return Recorder(path, component, peer or "", TRACE_PAYLOAD)
+
+
+# -----------------------
+# Reading
+# -----------------------
+
+class Header(NamedTuple):
+    version: int
+    payload: bool
+    wall_start: float
+    component: str
+    peer: str
+
+
+class TraceFrame(NamedTuple):
+    t: float             # seconds since the connection was accepted
+    direction: int       # RX / TX, as seen by the recording server
+    msg_type: int
+    priority: int        # -1 when absent
+    stream_id: int
+    length: int
+    body: Optional[bytes]  # None when the body was not kept
+
+
+def read_trace(path: str):
+    """(Header, iterator of TraceFrame). A trace cut short mid-record simply ends there."""
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) < _HDR.size or data[:4] != MAGIC:
+        raise ValueError(f"{path}: not a mux trace")
+    _, version, flags, wall = _HDR.unpack_from(data)
+    pos = _HDR.size
+    comp = data[pos + 1:pos + 1 + data[pos]].decode(errors="replace")
+    pos += 1 + data[pos]
+    peer = data[pos + 1:pos + 1 + data[pos]].decode(errors="replace")
+    pos += 1 + data[pos]
+    return Header(version, bool(flags & FLAG_PAYLOAD), wall, comp, peer), _frames(data, pos)
+
+
+def _frames(data: bytes, pos: int) -> Iterator[TraceFrame]:
+    n, t_us = len(data), 0
+    try:
+        while pos < n:
+            dt, pos = mux_wire.decode_varint(data, pos)
+            head = data[pos]
+            pos += 1
+            priority = -1
+            if head & _PRIO_BIT:
+                priority = data[pos]
+                pos += 1
+            sid, pos = mux_wire.decode_varint(data, pos)
+            length, pos = mux_wire.decode_varint(data, pos)
+            body = None
+            if head & _BODY_BIT:
+                if pos + length > n:
+                    return
+                body = data[pos:pos + length]
+                pos += length
+            t_us += dt
+            yield TraceFrame(t_us / 1e6, TX if head & _TX_BIT else RX, head & 0x0F, priority, sid, length, body)
+    except (IndexError, ValueError):
+        return
+
+
+def summary(path: str) -> dict:
+    header, frames = read_trace(path)
+    kinds, nbytes, streams = Counter(), Counter(), set()
+    last = 0.0
+    for fr in frames:
+        key = f"{'tx' if fr.direction == TX else 'rx'}_{NAMES.get(fr.msg_type, fr.msg_type)}"
+        kinds[key] += 1
+        if fr.msg_type in (DATA, RE_DATA):
+            nbytes["tx" if fr.direction == TX else "rx"] += fr.length
+        streams.add(fr.stream_id)
+        last = fr.t
+    return {"component": header.component, "peer": header.peer, "payload": header.payload,
+            "started": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(header.wall_start)),
+            "seconds": round(last, 3), "streams": len(streams), "frames": dict(kinds),
+            "data_bytes": dict(nbytes)}
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Summarise mux trace files")
+    ap.add_argument("traces", nargs="+")
+    args = ap.parse_args()
+    for p in args.traces:
+        print(p, summary(p))
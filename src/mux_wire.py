@@ -0,0 +1,259 @@
+import asyncio
+import heapq
+import socket
+import struct
+from typing import Tuple
+
+import socks5_commands as sc
+import spans
+
+# -----------------------
+# Compact mux wire format
+# -----------------------
+# HELLO (client -> server, once per connection, then echoed back by the server
+# with the chosen version and the intersection of both capability sets):
+#   magic "PMUX"(4) version(1) caps(varint)
+#
+# Frames after a successful HELLO:
+#   type_flags(1)   low nibble = message type, high nibble = flags
+#   [priority(1)]   only present when FLAG_PRIO is set
+#   stream_id(varint) length(varint) body(length)
+#
+# Peers that do not start with HELLO are served with their legacy header.
+#
+# PRIORITY (both dialects): body priority(1) weight(1) moves a live stream to
+# another scheduling class; peers that do not know the type ignore it.
+#
+# RE (both dialects): per-stream redundancy-elimination offer and answer (the
+# cache itself is per link); RE_DATA is DATA whose body is RE-encoded. See mux_re.py.
+#
+# PAUSE / RESUME (empty body) only run on sharded front <-> worker links
+# (mux_shard.py): the front holds a stream's target reads while the PPP
+# connection it belongs to is backed up.
+#
+# With CAP_TRACE (and CAP_BINARY_ADDR) an OPEN may carry the opener's trace context
+# (spans.Span.context()) right after the address, so the far end's spans join its trace.
+
+HELLO_MAGIC = b"PMUX"
+PROTO_VERSION = 2
+MIN_VERSION = 2
+
+# Capabilities
+CAP_BINARY_ADDR = 0x01  # OPEN body is atyp + addr + port (SOCKS5 layout)
+CAP_PRIORITY    = 0x02  # frames may carry a priority byte
+CAP_TRACE       = 0x04  # binary OPEN may end with a trace context
+
+LOCAL_CAPS = CAP_BINARY_ADDR | CAP_PRIORITY | CAP_TRACE
+
+# Frame flags (4 bits)
+FLAG_PRIO = 0x1
+
+MAX_FRAME = 16 * 1024 * 1024
+MAX_HEADER = 2 + 10 + 10  # type_flags, priority, two 64-bit varints
+
+# Frames shared by both mux dialects (OPEN/DATA/CLOSE are 1..3)
+PRIORITY = 4
+RE = 5
+RE_DATA = 6
+PAUSE = 7
+RESUME = 8
+
+
+class HelloError(Exception):
+    pass
+
+
+def encode_varint(n: int) -> bytes:
+    out = bytearray()
+    while n > 0x7F:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def decode_varint(buf, pos: int = 0) -> Tuple[int, int]:
+    """Decode a varint from buf at pos. Returns (value, new_pos)."""
+    value = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        value |= (b & 0x7F) << shift
+        if not b & 0x80:
+            return value, pos
+        shift += 7
+        if shift > 63:
+            raise ValueError("varint too long")
+
+
+async def read_varint(reader: asyncio.StreamReader) -> int:
+    value = 0
+    shift = 0
+    while True:
+        b = (await reader.readexactly(1))[0]
+        value |= (b & 0x7F) << shift
+        if not b & 0x80:
+            return value
+        shift += 7
+        if shift > 63:
+            raise ValueError("varint too long")
+
+
+def encode_header(msg_type: int, stream_id: int, length: int, flags: int = 0, priority: int = -1) -> bytes:
+    """Just the header of a frame whose body is length bytes (at most MAX_HEADER)."""
+    if priority >= 0:
+        flags |= FLAG_PRIO
+        hdr = bytes(((flags & 0x0F) << 4 | (msg_type & 0x0F), priority & 0xFF))
+    else:
+        hdr = bytes(((flags & 0x0F) << 4 | (msg_type & 0x0F),))
+    return hdr + encode_varint(stream_id) + encode_varint(length)
+
+
+def encode_frame(msg_type: int, stream_id: int, body: bytes = b"", flags: int = 0, priority: int = -1) -> bytes:
+    return encode_header(msg_type, stream_id, len(body), flags, priority) + body
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Tuple[int, int, int, int, bytes]:
+    """
+    Read one compact frame.
+    Returns (msg_type, flags, priority, stream_id, body); priority is -1 when absent.
+    """
+    tf = (await reader.readexactly(1))[0]
+    msg_type, flags = tf & 0x0F, tf >> 4
+    priority = (await reader.readexactly(1))[0] if flags & FLAG_PRIO else -1
+    stream_id = await read_varint(reader)
+    length = await read_varint(reader)
+    if length > MAX_FRAME:
+        raise ValueError(f"Frame too large: {length}")
+    body = await reader.readexactly(length) if length else b""
+    return msg_type, flags, priority, stream_id, body
+
+
+class StreamIds:
+    """
+    Stream id allocator for the side that opens streams.
+    Freed ids are reused lowest-first, so ids (and their varints) stay small however
+    many streams come and go. Release an id only once both directions have sent CLOSE.
+    """
+    __slots__ = ("_free", "_next")
+
+    def __init__(self, first: int = 1):
+        self._free = []
+        self._next = first
+
+    def alloc(self) -> int:
+        if self._free:
+            return heapq.heappop(self._free)
+        sid = self._next
+        self._next += 1
+        return sid
+
+    def release(self, stream_id: int):
+        heapq.heappush(self._free, stream_id)
+
+
+def pack_addr(host: str, port: int) -> bytes:
+    """Binary OPEN addressing: atyp(1) + addr + port(2), same layout as SOCKS5."""
+    try:
+        return bytes((sc.ATYP_IPV4,)) + socket.inet_pton(socket.AF_INET, host) + struct.pack("!H", port)
+    except OSError:
+        pass
+    try:
+        return bytes((sc.ATYP_IPV6,)) + socket.inet_pton(socket.AF_INET6, host) + struct.pack("!H", port)
+    except OSError:
+        pass
+    hb = host.encode("utf-8")
+    if len(hb) > 255:
+        raise ValueError("Domain too long")
+    return bytes((sc.ATYP_DOMAIN, len(hb))) + hb + struct.pack("!H", port)
+
+
+def unpack_addr(buf, pos: int = 0) -> Tuple[str, int, int]:
+    """Inverse of pack_addr. Returns (host, port, new_pos)."""
+    atyp = buf[pos]
+    pos += 1
+    if atyp == sc.ATYP_IPV4:
+        host = socket.inet_ntop(socket.AF_INET, bytes(buf[pos:pos + 4]))
+        pos += 4
+    elif atyp == sc.ATYP_IPV6:
+        host = socket.inet_ntop(socket.AF_INET6, bytes(buf[pos:pos + 16]))
+        pos += 16
+    elif atyp == sc.ATYP_DOMAIN:
+        ln = buf[pos]
+        host = bytes(buf[pos + 1:pos + 1 + ln]).decode("utf-8", errors="replace")
+        pos += 1 + ln
+    else:
+        raise ValueError(f"Unsupported atyp: {atyp}")
+    if pos + 2 > len(buf):
+        raise ValueError("Truncated address")
+    port = struct.unpack_from("!H", buf, pos)[0]
+    return host, port, pos + 2
+
+
+def pack_open(host: str, port: int, context: bytes = b"") -> bytes:
+    """Binary OPEN body: pack_addr, then the trace context when CAP_TRACE was negotiated."""
+    return pack_addr(host, port) + context
+
+
+def unpack_open(buf) -> Tuple[str, int, bytes]:
+    """Inverse of pack_open. Returns (host, port, context); context is b"" when absent."""
+    host, port, pos = unpack_addr(buf)
+    if len(buf) - pos not in (0, spans.CONTEXT_LEN):
+        raise ValueError("Bad OPEN trace context length")
+    return host, port, bytes(buf[pos:])
+
+
+def encode_priority(priority: int, weight: int) -> bytes:
+    return bytes((max(0, min(7, priority)), max(1, min(255, weight))))
+
+
+def decode_priority(body) -> Tuple[int, int]:
+    """PRIORITY body -> (priority 0..7, weight 1..255)."""
+    if len(body) < 2:
+        raise ValueError("Truncated PRIORITY frame")
+    return min(7, body[0]), max(1, body[1])
+
+
+def encode_hello(version: int, caps: int) -> bytes:
+    return HELLO_MAGIC + bytes((version,)) + encode_varint(caps)
+
+
+async def accept_hello(reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                       local_caps: int = LOCAL_CAPS) -> Tuple[int, bytes]:
+    """
+    Server side of the handshake.
+    Returns (caps, b"") when the peer sent HELLO, or (-1, prefix) for a legacy peer,
+    where prefix holds the bytes already consumed from its first frame header.
+    """
+    prefix = await reader.readexactly(len(HELLO_MAGIC))
+    if prefix != HELLO_MAGIC:
+        return -1, prefix
+
+    version = (await reader.readexactly(1))[0]
+    caps = await read_varint(reader)
+    chosen = min(version, PROTO_VERSION)
+    if chosen < MIN_VERSION:
+        writer.write(encode_hello(0, 0))
+        await writer.drain()
+        raise HelloError(f"Unsupported peer version: {version}")
+
+    caps &= local_caps
+    writer.write(encode_hello(chosen, caps))
+    await writer.drain()
+    return caps, b""
+
+
+async def client_hello(reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                       local_caps: int = LOCAL_CAPS) -> int:
+    """Client side of the handshake. Returns the negotiated caps."""
+    writer.write(encode_hello(PROTO_VERSION, local_caps))
+    await writer.drain()
+    magic = await reader.readexactly(len(HELLO_MAGIC))
+    if magic != HELLO_MAGIC:
+        raise HelloError(f"Bad HELLO reply: {magic!r}")
+    version = (await reader.readexactly(1))[0]
+    caps = await read_varint(reader)
+    if version < MIN_VERSION:
+        raise HelloError(f"Server refused version {PROTO_VERSION}")
+    return caps
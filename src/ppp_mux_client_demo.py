@@ -2,6 +2,9 @@ import asyncio
 import struct
 import socket
 
+import mux_wire
+import tls_link
+
 MAGIC = b"PPP1"
 VERSION = 1
 
@@ -18,6 +21,9 @@ HDR_LEN = struct.calcsize(HDR_FMT)
 
 BUFFER = 64 * 1024
 
+# Negotiate the compact header with HELLO; set False to talk PPP1 to an old server
+USE_COMPACT = True
+
 
 def encode_frame(msg_type: int, flags: int, atyp: int, stream_id: int, meta: bytes = b"", payload: bytes = b"") -> bytes:
     hdr = struct.pack(HDR_FMT, MAGIC, VERSION, msg_type, flags, atyp, stream_id, len(meta), len(payload))
@@ -36,6 +42,16 @@ async def read_frame(reader: asyncio.StreamReader):
     return msg_type, flags, atyp, stream_id, meta, payload
 
 
+def encode_compact_frame(msg_type: int, flags: int, atyp: int, stream_id: int, meta: bytes = b"", payload: bytes = b"") -> bytes:
+    body = bytes((atyp,)) + meta + payload if meta else payload
+    return mux_wire.encode_frame(msg_type, stream_id, body, flags=flags)
+
+
+async def read_compact_frame(reader: asyncio.StreamReader):
+    msg_type, flags, _, stream_id, body = await mux_wire.read_frame(reader)
+    return msg_type, flags, ATYP_NONE, stream_id, b"", body
+
+
 def open_meta_domain(host: str, port: int) -> tuple[int, bytes]:
     hb = host.encode("utf-8")
     meta = bytes([len(hb)]) + hb + struct.pack("!H", port)
@@ -43,7 +59,14 @@ def open_meta_domain(host: str, port: int) -> tuple[int, bytes]:
 
 
 async def main():
-    r, w = await asyncio.open_connection("127.0.0.1", 9000)
+    r, w = await tls_link.open_connection("127.0.0.1", 9000, "mux")
+
+    encode, read = encode_frame, read_frame
+    if USE_COMPACT:
+        caps = await mux_wire.client_hello(r, w)
+        tls_link.remember(w)
+        print(f"[HELLO] compact framing, caps=0x{caps:02x}")
+        encode, read = encode_compact_frame, read_compact_frame
 
     # Open two independent streams over the SAME TCP connection
     sid1 = 1
@@ -52,19 +75,19 @@ async def main():
     atyp1, meta1 = open_meta_domain("example.com", 80)
     atyp2, meta2 = open_meta_domain("httpbin.org", 80)
 
-    w.write(encode_frame(MSG_OPEN, 0, atyp1, sid1, meta=meta1))
-    w.write(encode_frame(MSG_OPEN, 0, atyp2, sid2, meta=meta2))
+    w.write(encode(MSG_OPEN, 0, atyp1, sid1, meta=meta1))
+    w.write(encode(MSG_OPEN, 0, atyp2, sid2, meta=meta2))
     await w.drain()
 
     # Send HTTP GETs on both streams
-    w.write(encode_frame(MSG_DATA, 0, ATYP_NONE, sid1, payload=b"GET / HTTP/1.1\r\nHost: example.com\r\n\r\n"))
-    w.write(encode_frame(MSG_DATA, 0, ATYP_NONE, sid2, payload=b"GET /ip HTTP/1.1\r\nHost: httpbin.org\r\n\r\n"))
+    w.write(encode(MSG_DATA, 0, ATYP_NONE, sid1, payload=b"GET / HTTP/1.1\r\nHost: example.com\r\n\r\n"))
+    w.write(encode(MSG_DATA, 0, ATYP_NONE, sid2, payload=b"GET /ip HTTP/1.1\r\nHost: httpbin.org\r\n\r\n"))
     await w.drain()
 
     # Read responses (interleaved)
     # In a real PPP you'd dispatch by stream_id to per-stream buffers/handlers
     for _ in range(10):
-        msg_type, flags, atyp, stream_id, meta, payload = await read_frame(r)
+        msg_type, flags, atyp, stream_id, meta, payload = await read(r)
         if msg_type == MSG_DATA:
             print(f"\n--- DATA stream={stream_id} ---\n{payload[:500]!r}\n")
         elif msg_type == MSG_OPEN:
@@ -74,8 +97,8 @@ async def main():
             break
 
     # Close both streams
-    w.write(encode_frame(MSG_CLOSE, 0, ATYP_NONE, sid1))
-    w.write(encode_frame(MSG_CLOSE, 0, ATYP_NONE, sid2))
+    w.write(encode(MSG_CLOSE, 0, ATYP_NONE, sid1))
+    w.write(encode(MSG_CLOSE, 0, ATYP_NONE, sid2))
     await w.drain()
 
     w.close()
@@ -1,9 +1,21 @@
 import asyncio
+import os
 import struct
 import socket
 from dataclasses import dataclass
 from typing import Dict, Optional, Tuple
 
+import admin
+import fastopen
+import flow_log
+import mux_re
+import mux_trace
+import mux_wire
+import spans
+import splice
+import tls_link
+from target_pool import TargetPool
+
 MAGIC = b"PPP1"
 VERSION = 1
 
@@ -11,17 +23,32 @@ VERSION = 1
 MSG_OPEN  = 1
 MSG_DATA  = 2
 MSG_CLOSE = 3
+MSG_RE = mux_wire.RE
+MSG_RE_DATA = mux_wire.RE_DATA
+MSG_PAUSE = mux_wire.PAUSE
+MSG_RESUME = mux_wire.RESUME
 
 # Address types (match SOCKS-ish values)
 ATYP_NONE   = 0
 ATYP_IPV4   = 1
 ATYP_DOMAIN = 3
+ATYP_IPV6   = 4
 
 # Fixed header: magic(4) ver(1) type(1) flags(1) atyp(1) stream_id(4) meta_len(2) payload_len(2)
 HDR_FMT = "!4sBBBBIHH"
 HDR_LEN = struct.calcsize(HDR_FMT)
 
-BUFFER = 64 * 1024
+# Early DATA held per stream while its target connect is still in flight
+MAX_PENDING_BYTES = 256 * 1024
+# Target connects in flight at once (across all mux connections)
+MAX_CONCURRENT_CONNECTS = 64
+connect_slots = asyncio.Semaphore(MAX_CONCURRENT_CONNECTS)
+# Co-located PPP: also accept on this Unix socket
+UNIX_PATH = os.environ.get("SOCKS_PROXY_MUX_UNIX", "")
+
+# Pre-warmed target connections: (host, port) -> (min_idle, max_idle); others are learned
+POOL_ROUTES: Dict[Tuple[str, int], Tuple[int, int]] = {}
+target_pool = TargetPool(asyncio.open_connection, routes=POOL_ROUTES)
 
 
 @dataclass
@@ -38,8 +65,8 @@ async def read_exact(reader: asyncio.StreamReader, n: int) -> bytes:
     return await reader.readexactly(n)
 
 
-async def read_frame(reader: asyncio.StreamReader) -> Frame:
-    hdr = await read_exact(reader, HDR_LEN)
+async def read_frame(reader: asyncio.StreamReader, prefix: bytes = b"") -> Frame:
+    hdr = prefix + await read_exact(reader, HDR_LEN - len(prefix))
     magic, ver, msg_type, flags, atyp, stream_id, meta_len, payload_len = struct.unpack(HDR_FMT, hdr)
 
     if magic != MAGIC:
@@ -60,10 +87,36 @@ def encode_frame(msg_type: int, flags: int, atyp: int, stream_id: int, meta: byt
     return hdr + meta + payload
 
 
+async def read_compact_frame(reader: asyncio.StreamReader) -> Frame:
+    """
+    Read a compact frame and map it onto Frame.
+    A compact OPEN body is atyp(1) + meta, so it splits into the legacy fields.
+    """
+    msg_type, flags, _, stream_id, body = await mux_wire.read_frame(reader)
+    if msg_type == MSG_OPEN and body:
+        return Frame(msg_type=msg_type, flags=flags, atyp=body[0], stream_id=stream_id, meta=body[1:], payload=b"")
+    return Frame(msg_type=msg_type, flags=flags, atyp=ATYP_NONE, stream_id=stream_id, meta=b"", payload=body)
+
+
+def encode_compact_frame(msg_type: int, flags: int, atyp: int, stream_id: int, meta: bytes = b"", payload: bytes = b"") -> bytes:
+    """Same signature as encode_frame, compact header on the wire."""
+    body = bytes((atyp,)) + meta + payload if meta else payload
+    return mux_wire.encode_frame(msg_type, stream_id, body, flags=flags)
+
+
+def traced_encode(encode, trace: mux_trace.Recorder):
+    """encode_frame/encode_compact_frame that also records each frame as TX."""
+    def encode_traced(msg_type: int, flags: int, atyp: int, stream_id: int, meta: bytes = b"", payload: bytes = b"") -> bytes:
+        trace.tx(msg_type, stream_id, -1, payload)
+        return encode(msg_type, flags, atyp, stream_id, meta, payload)
+    return encode_traced
+
+
 def parse_open_meta(atyp: int, meta: bytes) -> Tuple[str, int]:
     """
     OPEN meta encodes destination.
     IPV4: 4 bytes ip + 2 bytes port
+    IPV6: 16 bytes ip + 2 bytes port
     DOMAIN: 1 byte len + domain + 2 bytes port
     """
     if atyp == ATYP_IPV4:
@@ -73,6 +126,13 @@ def parse_open_meta(atyp: int, meta: bytes) -> Tuple[str, int]:
         port = struct.unpack("!H", meta[4:6])[0]
         return host, port
 
+    if atyp == ATYP_IPV6:
+        if len(meta) != 18:
+            raise ValueError("Bad IPV6 meta length")
+        host = socket.inet_ntop(socket.AF_INET6, meta[0:16])
+        port = struct.unpack("!H", meta[16:18])[0]
+        return host, port
+
     if atyp == ATYP_DOMAIN:
         if len(meta) < 1 + 2:
             raise ValueError("Bad DOMAIN meta length")
@@ -89,33 +149,19 @@ def parse_open_meta(atyp: int, meta: bytes) -> Tuple[str, int]:
 class StreamState:
     """
     Represents one muxed stream_id -> one outbound TCP connection to a target.
+    Until the connect finishes, target is None and DATA collects in pending.
+    Once connected the stream runs on protocol callbacks and holds no task.
     """
-    def __init__(self, target_writer: asyncio.StreamWriter, target_reader: asyncio.StreamReader):
-        self.target_writer = target_writer
-        self.target_reader = target_reader
-        self.closed = False
+    __slots__ = ("target", "pending", "task", "closed", "span", "re", "held")
 
-
-async def target_to_mux(stream_id: int, state: StreamState, mux_writer: asyncio.StreamWriter):
-    """
-    Read from target socket, send DATA frames back upstream.
-    """
-    try:
-        while True:
-            data = await state.target_reader.read(BUFFER)
-            if not data:
-                break
-            mux_writer.write(encode_frame(MSG_DATA, flags=0, atyp=ATYP_NONE, stream_id=stream_id, payload=data))
-            await mux_writer.drain()
-    except Exception:
-        pass
-    finally:
-        # Tell upstream we're done
-        try:
-            mux_writer.write(encode_frame(MSG_CLOSE, flags=0, atyp=ATYP_NONE, stream_id=stream_id, payload=b"eof"))
-            await mux_writer.drain()
-        except Exception:
-            pass
+    def __init__(self, span: spans.Span):
+        self.target: Optional[splice.Feed] = None
+        self.pending = bytearray()
+        self.task: Optional[asyncio.Task] = None
+        self.closed = False
+        self.span = span
+        self.re = False  # its RE offer was accepted: data to the PPP may go out as RE_DATA
+        self.held = False  # PAUSEd by a sharded front (mux_shard.py)
 
 
 async def handle_mux_connection(mux_reader: asyncio.StreamReader, mux_writer: asyncio.StreamWriter):
@@ -123,7 +169,63 @@ async def handle_mux_connection(mux_reader: asyncio.StreamReader, mux_writer: as
     print(f"[mux] connected: {peer}")
 
     streams: Dict[int, StreamState] = {}
-    back_tasks: Dict[int, asyncio.Task] = {}
+    gate = splice.Gate(mux_writer)
+    trace = mux_trace.recorder("mux", peer)
+    # The link's RE caches, from the first accepted offer on (shared by its RE streams)
+    re_link: Optional[mux_re.Session] = None
+
+    async def run_stream(stream_id: int, state: StreamState, host: str, port: int):
+        try:
+            async with connect_slots:
+                tr, tw = await target_pool.acquire(host, port)
+        except Exception as e:
+            if streams.get(stream_id) is state:
+                streams.pop(stream_id, None)
+            state.closed = True
+            # Send CLOSE with error reason
+            msg = f"open_failed:{type(e).__name__}".encode()
+            try:
+                mux_writer.write(encode(MSG_CLOSE, flags=0, atyp=ATYP_NONE, stream_id=stream_id, payload=msg))
+                await mux_writer.drain()
+            except Exception:
+                pass
+            state.span.end(error=str(e))
+            return
+        if state.closed:
+            # CLOSE arrived while we were connecting
+            tw.close()
+            return
+        state.span.mark("target_connect")
+
+        def on_data(data: bytes):
+            if state.re:
+                # Written as soon as it is encoded, so the link-wide cache moves in wire order
+                mux_writer.write(encode(MSG_RE_DATA, flags=0, atyp=ATYP_NONE, stream_id=stream_id,
+                                        payload=re_link.encode(data)))
+            else:
+                mux_writer.write(encode(MSG_DATA, flags=0, atyp=ATYP_NONE, stream_id=stream_id, payload=data))
+
+        def on_close():
+            # Tell upstream we're done
+            if not mux_writer.is_closing():
+                mux_writer.write(encode(MSG_CLOSE, flags=0, atyp=ATYP_NONE, stream_id=stream_id, payload=b"eof"))
+            state.span.end(up=feed.up, down=feed.down)
+
+        # Ack OPEN (optional). Here we reuse OPEN with empty meta/payload as "OK"
+        mux_writer.write(encode(MSG_OPEN, flags=0, atyp=ATYP_NONE, stream_id=stream_id))
+        print(f"[mux] OPEN stream={stream_id} -> {host}:{port} trace={state.span.tag}")
+
+        # Flush early DATA in the same step that publishes the target, so ordering holds;
+        # from here the stream runs on callbacks and this task ends
+        state.target = feed = splice.feed(tr, tw, gate, on_data, on_close, flow_log.open_flow(peer, splice.label(host, port)))
+        admin.track("stream", splice.label(host, port), peer, state.target,
+                    lambda: {"stream": stream_id, "queued": mux_writer.transport.get_write_buffer_size()})
+        state.task = None
+        if state.held:
+            feed.hold()
+        if state.pending:
+            state.target.write(bytes(state.pending))
+        state.pending = bytearray()
 
     async def close_stream(stream_id: int, reason: bytes = b""):
         state = streams.get(stream_id)
@@ -132,51 +234,88 @@ async def handle_mux_connection(mux_reader: asyncio.StreamReader, mux_writer: as
         if state.closed:
             return
         state.closed = True
-        try:
-            state.target_writer.close()
-            await state.target_writer.wait_closed()
-        except Exception:
-            pass
-        task = back_tasks.pop(stream_id, None)
-        if task:
-            task.cancel()
+        if state.target is None:
+            # Still connecting: abandon the connect attempt
+            state.task.cancel()
+            streams.pop(stream_id, None)
+            state.span.end(error="closed while connecting")
+            return
+        state.target.close()
         streams.pop(stream_id, None)
 
     try:
+        # Peers that open with HELLO get the compact header; anything else is PPP1
+        caps, prefix = await mux_wire.accept_hello(mux_reader, mux_writer)
+        if caps >= 0:
+            print(f"[mux] HELLO from {peer}: compact framing, caps=0x{caps:02x}")
+            read, encode = read_compact_frame, encode_compact_frame
+        else:
+            read, encode = read_frame, encode_frame
+        # A traced OPEN ends with the opener's span context (mux_wire.pack_open)
+        traced = caps >= 0 and caps & mux_wire.CAP_TRACE
+        if trace:
+            encode = traced_encode(encode, trace)
+
         while True:
-            frame = await read_frame(mux_reader)
+            if prefix:
+                # First legacy frame: its magic was consumed while probing for HELLO
+                frame = await read_frame(mux_reader, prefix)
+                prefix = b""
+            else:
+                frame = await read(mux_reader)
+            if trace and frame.msg_type != MSG_OPEN:
+                trace.rx(frame.msg_type, frame.stream_id, -1, frame.payload)
 
             if frame.msg_type == MSG_OPEN:
-                # OPEN: create outbound connection to target based on meta
+                # OPEN: connect to the target in the background so other streams keep flowing
                 try:
-                    host, port = parse_open_meta(frame.atyp, frame.meta)
-                    tr, tw = await asyncio.open_connection(host, port)
-                    state = StreamState(target_writer=tw, target_reader=tr)
-                    streams[frame.stream_id] = state
-
-                    # Ack OPEN (optional). Here we reuse OPEN with empty meta/payload as "OK"
-                    mux_writer.write(encode_frame(MSG_OPEN, flags=0, atyp=ATYP_NONE, stream_id=frame.stream_id))
-                    await mux_writer.drain()
-
-                    # Start target->mux pump
-                    back_tasks[frame.stream_id] = asyncio.create_task(target_to_mux(frame.stream_id, state, mux_writer))
-                    print(f"[mux] OPEN stream={frame.stream_id} -> {host}:{port}")
-
+                    if traced:
+                        host, port, context = mux_wire.unpack_open(bytes((frame.atyp,)) + frame.meta)
+                    else:
+                        (host, port), context = parse_open_meta(frame.atyp, frame.meta), b""
+                    if trace:
+                        trace.open(mux_trace.RX, frame.stream_id, host, port)
                 except Exception as e:
-                    # Send CLOSE with error reason
                     msg = f"open_failed:{type(e).__name__}".encode()
-                    mux_writer.write(encode_frame(MSG_CLOSE, flags=0, atyp=ATYP_NONE, stream_id=frame.stream_id, payload=msg))
+                    mux_writer.write(encode(MSG_CLOSE, flags=0, atyp=ATYP_NONE, stream_id=frame.stream_id, payload=msg))
                     await mux_writer.drain()
+                    continue
+                state = StreamState(spans.start("mux.stream", context, stream=frame.stream_id, target=f"{host}:{port}"))
+                streams[frame.stream_id] = state
+                state.task = asyncio.create_task(run_stream(frame.stream_id, state, host, port))
 
-            elif frame.msg_type == MSG_DATA:
+            elif frame.msg_type == MSG_DATA or frame.msg_type == MSG_RE_DATA:
                 # DATA: forward payload to the target for that stream_id
                 state = streams.get(frame.stream_id)
+                payload = frame.payload
+                if frame.msg_type == MSG_RE_DATA:
+                    # Decoded even for a stream that is gone, to keep the link cache in step
+                    try:
+                        if re_link is None:
+                            raise mux_re.Desync("RE_DATA before RE")
+                        payload = re_link.decode(payload)
+                    except mux_re.Desync as e:
+                        print(f"[mux] RE stream={frame.stream_id}: {e}")
+                        if state and not state.closed:
+                            await close_stream(frame.stream_id, reason=b"re_desync")
+                            mux_writer.write(encode(MSG_CLOSE, flags=0, atyp=ATYP_NONE, stream_id=frame.stream_id, payload=b"re_desync"))
+                            await mux_writer.drain()
+                        continue
                 if not state or state.closed:
                     # Stream not open; ignore or close upstream stream
                     continue
+                if state.target is None:
+                    # Still connecting: hold the bytes until the target is up
+                    if len(state.pending) + len(payload) > MAX_PENDING_BYTES:
+                        await close_stream(frame.stream_id, reason=b"pending_overflow")
+                        mux_writer.write(encode(MSG_CLOSE, flags=0, atyp=ATYP_NONE, stream_id=frame.stream_id, payload=b"pending_overflow"))
+                        await mux_writer.drain()
+                    else:
+                        state.pending += payload
+                    continue
                 try:
-                    state.target_writer.write(frame.payload)
-                    await state.target_writer.drain()
+                    state.target.write(payload)
+                    await state.target.drain()
                 except Exception:
                     await close_stream(frame.stream_id, reason=b"write_failed")
 
@@ -184,16 +323,46 @@ async def handle_mux_connection(mux_reader: asyncio.StreamReader, mux_writer: as
                 # CLOSE: shutdown that stream
                 await close_stream(frame.stream_id, reason=frame.payload)
 
+            elif frame.msg_type == MSG_RE:
+                # Redundancy elimination offer: answer with the agreed cache size, or stay silent
+                state = streams.get(frame.stream_id)
+                if state and not state.closed and not state.re:
+                    kb = mux_re.accept(frame.payload, re_link)
+                    if kb:
+                        if re_link is None:
+                            re_link = mux_re.Session(kb)
+                            print(f"[mux] RE on link {peer}: {kb} KiB cache")
+                        state.re = True
+                        mux_writer.write(encode(MSG_RE, flags=0, atyp=ATYP_NONE, stream_id=frame.stream_id,
+                                                payload=mux_re.encode_offer(kb)))
+                        print(f"[mux] RE stream={frame.stream_id}")
+
+            elif frame.msg_type == MSG_PAUSE or frame.msg_type == MSG_RESUME:
+                # Sharded front: its PPP connection for this stream is backed up, or drained again
+                state = streams.get(frame.stream_id)
+                if state and not state.closed:
+                    state.held = frame.msg_type == MSG_PAUSE
+                    if state.target is None:
+                        pass  # applied once the target is up
+                    elif state.held:
+                        state.target.hold()
+                    else:
+                        state.target.release()
+
             else:
                 # Unknown message; ignore or terminate
                 pass
 
     except asyncio.IncompleteReadError:
         print(f"[mux] disconnected: {peer}")
+    except (ValueError, mux_wire.HelloError) as e:
+        print(f"[mux] protocol error from {peer}: {e}")
     finally:
         # Cleanup all streams
         for sid in list(streams.keys()):
             await close_stream(sid)
+        if trace:
+            trace.close()
         try:
             mux_writer.close()
             await mux_writer.wait_closed()
@@ -201,12 +370,31 @@ async def handle_mux_connection(mux_reader: asyncio.StreamReader, mux_writer: as
             pass
 
 
-async def main(host="0.0.0.0", port=9000):
-    server = await asyncio.start_server(handle_mux_connection, host, port)
+admin.command("trace", mux_trace.configure)
+admin.stats_source("target_pool", target_pool.stats)
+admin.stats_source("spans", spans.stats)
+admin.stats_source("re", mux_re.stats)
+
+
+async def main(host="0.0.0.0", port=9000, unix_path=""):
+    unix_path = unix_path or UNIX_PATH
+    server = await asyncio.start_server(handle_mux_connection, host, port, ssl=tls_link.server_context())
+    fastopen.listen(server)
+    unix_server = None
+    if unix_path:
+        unix_server = await tls_link.start_unix_server(handle_mux_connection, unix_path, tls_link.server_context())
+        print(f"PPP mux server also listening on {unix_path}")
+    target_pool.start()
+    flow_log.start("mux")
+    spans.start_export("mux")
+    await admin.start("mux")
     addrs = ", ".join(str(s.getsockname()) for s in server.sockets or [])
     print(f"PPP mux server listening on {addrs}")
-    async with server:
-        await server.serve_forever()
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        tls_link.close_unix_server(unix_server, unix_path)
 
 
 if __name__ == "__main__":
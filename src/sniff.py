@@ -0,0 +1,289 @@
+import asyncio
+import ipaddress
+from typing import Optional
+
+# -----------------------
+# Ingress protocol sniffing
+# -----------------------
+# Peeks at the first bytes of a flow, with a bounded read, to learn where it is going:
+#   TLS ClientHello   -> SNI host name            (bytes replayed to the target)
+#   HTTP/1 request    -> Host header              (bytes replayed to the target)
+#   HTTP CONNECT      -> request target           (request consumed, we answer it)
+#   "HOST:PORT\n"     -> the direct-ingress header (line consumed)
+#   SOCKS5 greeting   -> nothing yet: data is the greeting, the caller runs the handshake
+#
+# The parser is an incremental state machine over one bytearray: every read appends,
+# and each state resumes from the offset where it stopped instead of rescanning.
+# Nothing is decoded except the host name itself.
+
+# One full TLS record (5-byte header + 16 KiB) covers any ClientHello we can parse
+SNIFF_MAX = 5 + 16384
+HEADER_LINE_MAX = 262  # 255-byte name + ":65535\n"
+
+KIND_TLS = "tls"
+KIND_HTTP = "http"
+KIND_CONNECT = "connect"
+KIND_HEADER = "header"
+KIND_SOCKS5 = "socks5"
+KIND_UNKNOWN = "unknown"
+
+CONNECT_OK = b"HTTP/1.1 200 Connection established\r\n\r\n"
+CONNECT_FAILED = b"HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+
+_METHODS = (b"GET", b"POST", b"HEAD", b"PUT", b"DELETE", b"OPTIONS", b"PATCH", b"TRACE", b"CONNECT")
+_METHOD_MAX = 8  # len(b"CONNECT ")
+
+# Parser states
+_DETECT, _TLS, _HTTP, _LINE = range(4)
+
+_TLS_HANDSHAKE = 0x16
+_SOCKS5 = 0x05
+_CLIENT_HELLO = 0x01
+_EXT_SERVER_NAME = 0x0000
+_SNI_HOST_NAME = 0x00
+
+# Names that only mean something on the local host or network
+_LOCAL_SUFFIXES = (".localhost", ".local", ".internal", ".home.arpa")
+
+
+class Sniffed:
+    """
+    What the first bytes said. data is what must still reach the target (the peeked
+    bytes, minus a consumed CONNECT request or routing header); raw is every peeked
+    byte, unchanged, for a flow that was not addressed to us; host is None when
+    nothing named the destination.
+    """
+    __slots__ = ("kind", "host", "port", "data", "raw")
+
+    def __init__(self, kind: str, host: Optional[str], port: int, data: bytes):
+        self.kind = kind
+        self.host = host
+        self.port = port
+        self.data = data
+        self.raw = data
+
+    def __repr__(self) -> str:
+        return f"Sniffed({self.kind}, {self.host}:{self.port}, {len(self.data)} bytes)"
+
+
+class Sniffer:
+    """Feed bytes with push(); it returns a Sniffed once it has decided, else None (want more)."""
+    __slots__ = ("buf", "state", "need", "scan", "method_len")
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.state = _DETECT
+        self.need = 1        # _TLS: bytes of the whole record
+        self.scan = 0        # _HTTP/_LINE: where the terminator search resumes
+        self.method_len = 0
+
+    def push(self, data: bytes) -> Optional[Sniffed]:
+        self.buf += data
+        result = self._step()
+        if result is not None:
+            result.raw = bytes(self.buf)
+        return result
+
+    def finish(self) -> Sniffed:
+        """No more bytes are coming (EOF, limit or timeout): settle for what we have."""
+        return self._unknown()
+
+    def _step(self) -> Optional[Sniffed]:
+        buf = self.buf
+        if self.state == _DETECT:
+            if not buf:
+                return None
+            if buf[0] == _TLS_HANDSHAKE:
+                if len(buf) < 5:
+                    return None
+                if buf[1] != 0x03:
+                    return self._unknown()
+                self.state = _TLS
+                self.need = 5 + (buf[3] << 8 | buf[4])
+            elif buf[0] == _SOCKS5:
+                # VER NMETHODS METHODS...; the client now waits for our method reply
+                if len(buf) < 2 or len(buf) < 2 + buf[1]:
+                    return None
+                return Sniffed(KIND_SOCKS5, None, 0, bytes(buf))
+            else:
+                sp = buf.find(b" ", 0, _METHOD_MAX)
+                if sp < 0:
+                    if len(buf) < _METHOD_MAX and buf.isupper() and buf.isalpha():
+                        return None  # could still be a method
+                    self.state = _LINE
+                elif bytes(buf[:sp]) in _METHODS:
+                    self.state = _HTTP
+                    self.method_len = sp
+                else:
+                    self.state = _LINE
+
+        if self.state == _TLS:
+            if len(buf) < self.need:
+                return None
+            return self._tls()
+
+        if self.state == _HTTP:
+            end = buf.find(b"\r\n\r\n", self.scan)
+            if end < 0:
+                self.scan = max(0, len(buf) - 3)
+                return None
+            return self._http(end + 4)
+
+        # _LINE
+        nl = buf.find(b"\n", self.scan, HEADER_LINE_MAX)
+        if nl < 0:
+            if len(buf) >= HEADER_LINE_MAX:
+                return self._unknown()
+            self.scan = len(buf)
+            return None
+        host, port = _split_host_port(bytes(buf[:nl]).rstrip(b"\r"), -1)
+        if host is None or port < 0:
+            return self._unknown()
+        return Sniffed(KIND_HEADER, host, port, bytes(buf[nl + 1:]))
+
+    def _unknown(self) -> Sniffed:
+        return Sniffed(KIND_UNKNOWN, None, 0, bytes(self.buf))
+
+    def _tls(self) -> Sniffed:
+        """Walk the ClientHello in place for the server_name extension (RFC 8446 4.1.2, RFC 6066 3)."""
+        b = self.buf
+        data = bytes(b)
+        end = self.need
+        # handshake header: type(1) length(3); ClientHello: version(2) random(32)
+        if end < 5 + 4 + 2 + 32 + 1 or b[5] != _CLIENT_HELLO:
+            return Sniffed(KIND_TLS, None, 443, data)
+        # A ClientHello split over several records is parsed as far as the first one goes
+        i = 9 + 2 + 32
+        i += 1 + b[i]                                  # session_id
+        if i + 2 > end:
+            return Sniffed(KIND_TLS, None, 443, data)
+        i += 2 + (b[i] << 8 | b[i + 1])                # cipher_suites
+        if i + 1 > end:
+            return Sniffed(KIND_TLS, None, 443, data)
+        i += 1 + b[i]                                  # compression_methods
+        if i + 2 > end:
+            return Sniffed(KIND_TLS, None, 443, data)
+        ext_end = min(end, i + 2 + (b[i] << 8 | b[i + 1]))
+        i += 2
+        while i + 4 <= ext_end:
+            etype = b[i] << 8 | b[i + 1]
+            elen = b[i + 2] << 8 | b[i + 3]
+            i += 4
+            if etype == _EXT_SERVER_NAME:
+                # server_name_list length(2), then name_type(1) length(2) name
+                j, stop = i + 2, min(ext_end, i + elen)
+                while j + 3 <= stop:
+                    ntype, nlen = b[j], b[j + 1] << 8 | b[j + 2]
+                    j += 3
+                    if ntype == _SNI_HOST_NAME and j + nlen <= stop:
+                        host = _host(data[j:j + nlen])
+                        return Sniffed(KIND_TLS, host, 443, data)
+                    j += nlen
+                break
+            i += elen
+        return Sniffed(KIND_TLS, None, 443, data)
+
+    def _http(self, head_end: int) -> Sniffed:
+        b = self.buf
+        line_end = b.find(b"\r\n")
+        sp = self.method_len
+        target_end = b.find(b" ", sp + 1, line_end)
+        if target_end < 0:
+            return self._unknown()
+        if b[:sp] == b"CONNECT":
+            # authority-form "host:port"; the request itself is ours to answer
+            host, port = _split_host_port(bytes(b[sp + 1:target_end]), -1)
+            if host is None or port < 0:
+                return self._unknown()
+            return Sniffed(KIND_CONNECT, host, port, bytes(b[head_end:]))
+
+        data = bytes(b)
+        # Host header; only lines that start with h/H of the right length are looked at
+        i = line_end + 2
+        while i < head_end - 2:
+            nl = b.find(b"\r\n", i, head_end)
+            if b[i] in b"hH" and nl - i > 5 and b[i:i + 5].lower() == b"host:":
+                host, port = _split_host_port(data[i + 5:nl].strip(), 80)
+                if host is not None:
+                    return Sniffed(KIND_HTTP, host, port, data)
+                break
+            i = nl + 2
+        # absolute-form request target (a client that thinks we are its HTTP proxy)
+        target = data[sp + 1:target_end]
+        if target[:7].lower() == b"http://":
+            authority = target[7:].split(b"/", 1)[0]
+            host, port = _split_host_port(authority, 80)
+            if host is not None:
+                return Sniffed(KIND_HTTP, host, port, data)
+        return Sniffed(KIND_HTTP, None, 80, data)
+
+
+def routable_name(host: str) -> bool:
+    """
+    True when a sniffed name may stand in for the captured address: a dotted host
+    name, not an IP literal (that would just be a client-chosen address) and not a
+    local-only name such as localhost.
+    """
+    try:
+        ipaddress.ip_address(host.strip("[]"))
+        return False
+    except ValueError:
+        pass
+    name = host.rstrip(".").lower()
+    return "." in name and not name.endswith(_LOCAL_SUFFIXES)
+
+
+def _host(raw: bytes) -> Optional[str]:
+    if not raw or len(raw) > 255:
+        return None
+    try:
+        return raw.decode("ascii").lower()
+    except UnicodeDecodeError:
+        return None
+
+
+def _split_host_port(raw: bytes, default_port: int):
+    """b"name:443" / b"[v6]:443" / b"name" -> (host, port); (None, 0) if malformed."""
+    if raw.startswith(b"["):
+        close = raw.find(b"]")
+        if close < 0:
+            return None, 0
+        host_b, rest = raw[1:close], raw[close + 1:]
+    else:
+        colon = raw.rfind(b":")
+        host_b, rest = (raw[:colon], raw[colon:]) if colon >= 0 else (raw, b"")
+    port = default_port
+    if rest:
+        if rest[:1] != b":" or not rest[1:].isdigit():
+            return None, 0
+        port = int(rest[1:])
+        if port > 65535:
+            return None, 0
+    if b" " in host_b:
+        return None, 0
+    return _host(host_b), port
+
+
+async def sniff(reader: asyncio.StreamReader, timeout: Optional[float] = None) -> Sniffed:
+    """
+    Read at most SNIFF_MAX bytes until the first bytes identify the flow. With a timeout,
+    a client that waits for the server to speak first ends up KIND_UNKNOWN instead of hanging.
+    """
+    sniffer = Sniffer()
+    loop = asyncio.get_running_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+    while len(sniffer.buf) < SNIFF_MAX:
+        try:
+            if deadline is None:
+                data = await reader.read(SNIFF_MAX - len(sniffer.buf))
+            else:
+                data = await asyncio.wait_for(reader.read(SNIFF_MAX - len(sniffer.buf)),
+                                              max(0.0, deadline - loop.time()))
+        except asyncio.TimeoutError:
+            break
+        if not data:
+            break
+        result = sniffer.push(data)
+        if result is not None:
+            return result
+    return sniffer.finish()
@@ -12,4 +12,18 @@ ATYP_IPV6 = 0x04
 REP_SUCCEEDED = 0x00
 REP_GENERAL_FAILURE = 0x01
 REP_COMMAND_NOT_SUPPORTED = 0x07
-REP_ADDR_TYPE_NOT_SUPPORTED = 0x08
\ No newline at end of file
+REP_ADDR_TYPE_NOT_SUPPORTED = 0x08
+REP_HOST_UNREACHABLE = 0x04
+REP_CONNECTION_REFUSED = 0x05
+
+# Methods
+METHOD_NO_AUTH = 0x00
+METHOD_NO_ACCEPTABLE = 0xFF
+# Private method (RFC 1928 X'80'-X'FE'): PPP<->DCS flow metadata sub-negotiation
+METHOD_PPP_META = 0x88
+
+# Flow metadata TLV types (see socks5_meta.py)
+META_PRIORITY = 0x01
+META_DSCP = 0x02
+META_TRACE = 0x03     # trace context: trace id(16) span id(8) flags(1), see spans.py
+META_ORIG_DST = 0x04  # captured destination IP (4 or 16 bytes) of a flow routed by name
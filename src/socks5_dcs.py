@@ -1,15 +1,36 @@
 import asyncio
 from pickle import TRUE
+import ipaddress
 import struct
 import socket
 import json
 import os
 import time
 import socks5_commands as sc
+import admin
+import breaker
+import socks5_meta
+import classifier
+import fastopen
+import flow_log
+import spans
+import instrument
+import splice
+import tls_link
+import udp_relay
+from target_pool import TargetPool
 
 BUFFER = 65536
 SO_MARK = 36  # Linux socket option; requires CAP_NET_ADMIN to set
 _DEBUG = False
+# Co-located PPP: also accept on this Unix socket (same protocol, no TCP loopback hop)
+UNIX_PATH = os.environ.get("SOCKS_PROXY_DCS_UNIX", "")
+
+# Pre-warmed target connections for hot backends: (host, port) -> (min_idle, max_idle).
+# Destinations not listed here are learned from connect frequency.
+POOL_ROUTES = {
+    ("192.168.1.109", 8000): (2, 8),  # CCS, see socks5_ppp.DST_OVERRIDE
+}
 
 # region agent log
 def agent_log(hypothesis_id: str, location: str, message: str, data: dict, run_id: str = "pre-fix") -> None:
@@ -65,29 +86,19 @@ def pack_reply(rep:int, bind_host:str = '0.0.0.0', bind_port:int=0)->bytes:
         addr_part = socket.inet_pton(socket.AF_INET, '0.0.0.0')
     return struct.pack('!BBBB', sc.SOCKS_VERSION, rep, 0x00, atyp) + addr_part + struct.pack('!H', bind_port)
 
-async def pipe(reader:asyncio.StreamReader, writer:asyncio.StreamWriter, direction: str = ""):
-    try:
-        total_bytes = 0
-        while True:
-            data = await reader.read(BUFFER)
-            if not data:
-                print(f'DCS: WARN:no data:break {direction}')
-                break
-            writer.write(data)
-            await writer.drain()
-            total_bytes += len(data)
-            print(f'DCS: DATA: {direction} {len(data)} bytes (total: {total_bytes})')
-    except Exception as e:
-        print(f'DCS: ERR:pipe:{direction}:{str(e)}')
-    finally:
-        print(f'DCS: INFO: Pipe closed {direction}, total bytes transferred: {total_bytes}')
-        await close_writer(writer)
+def tunnel_closed(label:str, up:int, down:int, seconds:float, trace:str=''):
+    print(f'DCS: INFO: tunnel {label} closed after {seconds:.1f}s, up={up} down={down} bytes{f" trace={trace}" if trace else ""}')
 
-async def open_connection_marked(host: str, port: int, mark: int) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+async def open_connection_marked(host: str, port: int, mark: int,
+                                 fast_open: bool = True) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
     """
     Open an outbound TCP connection with SO_MARK set so iptables can bypass NAT redirection.
     If setting the mark fails (no privileges), falls back to a normal open_connection.
+    fast_open=False waits for the real handshake even when TFO is on.
     """
+    if fastopen.ENABLED and fast_open:
+        # The PPP's first bytes for this flow go out in the SYN when we hold a cookie
+        return await asyncio.open_connection(sock=await fastopen.connect(host, port, mark))
     loop = asyncio.get_running_loop()
     try:
         addrinfos = await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
@@ -116,6 +127,62 @@ async def open_connection_marked(host: str, port: int, mark: int) -> tuple[async
     except Exception:
         return await asyncio.open_connection(host, port)
 
+async def connect_target(host: str, port: int, fast_open: bool = True) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    # Default matches scripts/redirect_tcp_ppproxy.sh BYPASS_MARK
+    bypass_mark = int(os.environ.get("SOCKS_PROXY_BYPASS_MARK", "1"), 0)
+    # A TFO connect returns before the target answers, so the breaker would never see it fail:
+    # once a target has failures on record, connect to it the slow way until it is healthy again
+    fast_open = fast_open and target_pool.breakers.healthy((host, port))
+    reader, writer = await open_connection_marked(host, port, bypass_mark, fast_open)
+    fastopen.observe_later(writer, "dcs")
+    return reader, writer
+
+async def fill_target(host: str, port: int) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    # Pool refills sit idle until used: they must really have reached the target
+    return await connect_target(host, port, fast_open=False)
+
+target_pool = TargetPool(connect_target, routes=POOL_ROUTES, fill_connect=fill_target)
+
+async def resolve_named_flow(name: str, port: int, captured: bytes) -> str:
+    """
+    Where to connect for a flow the PPP routed by name; captured is the address it
+    intercepted (META_ORIG_DST). The client chose the name, so it is only followed
+    when it resolves to that address or only to public ones; otherwise (our own
+    loopback, internal services) the flow goes to the captured address. Returns an
+    IP literal, so the connect cannot see a different DNS answer than the check did.
+    """
+    ip = socket.inet_ntop(socket.AF_INET6 if len(captured) == 16 else socket.AF_INET, captured)
+    try:
+        addrinfos = await asyncio.get_running_loop().getaddrinfo(name, port, type=socket.SOCK_STREAM)
+    except OSError as e:
+        print(f'DCS: {name} does not resolve ({e}), using captured {ip}')
+        return ip
+    addrs = [ai[4][0] for ai in addrinfos]
+    if ip in addrs:
+        return ip
+    if addrs and all(ipaddress.ip_address(a).is_global for a in addrs):
+        return addrs[0]
+    print(f'DCS: {name} resolves to {addrs}, not {ip} and not public: using captured {ip}')
+    return ip
+
+async def relay_udp(reader:asyncio.StreamReader, writer:asyncio.StreamWriter, client_port:int):
+    """Serve a UDP ASSOCIATE for as long as its TCP control connection stays open"""
+    client_ip = writer.get_extra_info('peername')[0]
+    bind_host = writer.get_extra_info('sockname')[0]
+    try:
+        assoc = await udp_relay.open_association(bind_host, client_ip, client_port)
+    except Exception as e:
+        writer.write(pack_reply(sc.REP_GENERAL_FAILURE))
+        await writer.drain()
+        print(f'DCS: ERR:UDP associate:{str(e)}')
+        return
+    bhost, bport = assoc.sockname
+    writer.write(pack_reply(sc.REP_SUCCEEDED, bind_host=bhost, bind_port=bport))
+    await writer.drain()
+    print(f'DCS: UDP associate for {client_ip} relaying on {bhost}:{bport}')
+    await assoc.serve(reader)
+    print(f'DCS: UDP associate for {client_ip} closed: {assoc.stats()}')
+
 async def handle_client(reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
     """SOCKS5 server that routes to final targets"""
     addr = writer.get_extra_info('peername')
@@ -123,6 +190,9 @@ async def handle_client(reader:asyncio.StreamReader, writer:asyncio.StreamWriter
     if _DEBUG:
         agent_log("H9", "socks5_dcs.py:handle_client", "SOCKS5 client connected", {"peer": addr})
     
+    spliced = False
+    tm = instrument.timer("dcs")
+    sp = spans.start("dcs.flow", peer=addr)
     try:
         # SOCKS5 handshake
         ver = (await read_extract(reader, 1))[0]
@@ -134,14 +204,21 @@ async def handle_client(reader:asyncio.StreamReader, writer:asyncio.StreamWriter
         nmethods = (await read_extract(reader, 1))[0]
         methods = await read_extract(reader, nmethods)
         
-        if 0x00 not in methods:
+        meta = {}
+        if sc.METHOD_PPP_META in methods:
+            # Our PPP: flow metadata (priority class, DSCP) follows the method reply
+            writer.write(struct.pack('!BB', sc.SOCKS_VERSION, sc.METHOD_PPP_META))
+            await writer.drain()
+            meta = await socks5_meta.read_meta(reader)
+            sp.join(meta.get(sc.META_TRACE))  # continue the PPP's trace
+        elif 0x00 not in methods:
             await close_writer(writer)
             print(f'DCS: ERR:0x00 auth')
             return
-        
-        # Send auth reply
-        writer.write(struct.pack('!BB', sc.SOCKS_VERSION, 0x00))
-        await writer.drain()
+        else:
+            # Send auth reply
+            writer.write(struct.pack('!BB', sc.SOCKS_VERSION, 0x00))
+            await writer.drain()
         
         # Read connect request
         ver, cmd, rsv, atyp = struct.unpack('!BBBB', await read_extract(reader, 4))
@@ -150,7 +227,7 @@ async def handle_client(reader:asyncio.StreamReader, writer:asyncio.StreamWriter
             print(f'DCS: ERR:connect request')
             return
         
-        if cmd != sc.CMD_CONNECT:
+        if cmd not in (sc.CMD_CONNECT, sc.CMD_UDP_ASSOCIATE):
             writer.write(pack_reply(sc.REP_COMMAND_NOT_SUPPORTED))
             await writer.drain()
             await close_writer(writer)
@@ -166,23 +243,40 @@ async def handle_client(reader:asyncio.StreamReader, writer:asyncio.StreamWriter
             await close_writer(writer)
             print(f'DCS: ERR:Value Error:{str(ve)}')
             return
+
+        tm.mark("handshake")
+        sp.mark("handshake")
+        sp.set(target=f"{dst_host}:{dst_port}")
+
+        if cmd == sc.CMD_UDP_ASSOCIATE:
+            # DST.ADDR/DST.PORT name the client's UDP source; only its port is useful to us
+            await relay_udp(reader, writer, dst_port)
+            return
         
-        print(f'DCS: Connecting to final target {dst_host}:{dst_port}')
+        print(f'DCS: Connecting to final target {dst_host}:{dst_port} trace={sp.tag}')
         
         # Connect to final target
         try:
-            # Default matches scripts/redirect_tcp_ppproxy.sh BYPASS_MARK
-            bypass_mark = int(os.environ.get("SOCKS_PROXY_BYPASS_MARK", "1"), 0)
-            target_reader, target_writer = await open_connection_marked(dst_host, dst_port, bypass_mark)
+            connect_host = dst_host
+            captured = meta.get(sc.META_ORIG_DST)
+            if captured and atyp == sc.ATYP_DOMAIN and len(captured) in (4, 16):
+                connect_host = await resolve_named_flow(dst_host, dst_port, captured)
+                sp.set(connect=connect_host)
+            target_reader, target_writer = await target_pool.acquire(connect_host, dst_port)
+            tm.mark("target_connect")
+            sp.mark("target_connect")
             if _DEBUG:
                 agent_log("H10", "socks5_dcs.py:handle_client", "connected final target", {
                     "dst_host": dst_host, "dst_port": dst_port
                 })
         except Exception as e:
-            writer.write(pack_reply(sc.REP_GENERAL_FAILURE))
+            # An open breaker means the target has been failing: say so rather than "general failure"
+            rep = sc.REP_HOST_UNREACHABLE if isinstance(e, breaker.BreakerOpen) else sc.REP_GENERAL_FAILURE
+            writer.write(pack_reply(rep))
             await writer.drain()
             await close_writer(writer)
-            print(f'DCS: ERR:Target connection:{str(e)}')
+            print(f'DCS: ERR:Target connection:{str(e)} trace={sp.tag}')
+            sp.end(error=str(e))
             if _DEBUG:
                 agent_log("H11", "socks5_dcs.py:handle_client", "final target connect failed", {
                     "dst_host": dst_host, "dst_port": dst_port, "error": str(e)
@@ -191,34 +285,100 @@ async def handle_client(reader:asyncio.StreamReader, writer:asyncio.StreamWriter
         
         # Send success reply
         sock = target_writer.get_extra_info('socket')
+        dscp = meta.get(sc.META_DSCP)
+        if dscp:
+            # Carry the PPP's classification onto the egress socket for tc/HTB shaping
+            classifier.apply_dscp(sock, dscp[0])
+            print(f'DCS: {dst_host}:{dst_port} egress DSCP {dscp[0]}')
         bhost, bport = sock.getsockname()[0], sock.getsockname()[1]
         writer.write(pack_reply(sc.REP_SUCCEEDED, bind_host=bhost, bind_port=bport))
         await writer.drain()
+        tm.mark("reply")
+        sp.mark("reply")
         print(f'DCS: Connected to {dst_host}:{dst_port}, tunneling...')
         
-        # Tunnel data both ways
-        t1 = asyncio.create_task(pipe(reader, target_writer, f"SOCKS5->{dst_host}:{dst_port}"))
-        t2 = asyncio.create_task(pipe(target_reader, writer, f"{dst_host}:{dst_port}->SOCKS5"))
-        
-        done, pending = await asyncio.wait({t1, t2}, return_when=asyncio.FIRST_COMPLETED)
-        for p in pending:
-            p.cancel()
+        # Tunnel data both ways on protocol callbacks; this handler task ends here
+        label = splice.label(dst_host, dst_port)
+        prio = meta.get(sc.META_PRIORITY)
+        sp.set(priority=prio[0] if prio else None, dscp=dscp[0] if dscp else None)
+
+        tfo = fastopen.used(target_writer)
+
+        def refused():
+            # A TFO connect "succeeded" without reaching the target; the first write found out
+            if tfo and isinstance(tunnel.b.exc, ConnectionRefusedError):
+                fastopen.counters["refused"] += 1
+                target_pool.breakers.failed((connect_host, dst_port))
+                print(f'DCS: ERR:Target connection:{connect_host}:{dst_port} refused after TFO connect trace={sp.tag}')
+
+        tunnel = None
+
+        def closed(label, up, down, seconds):
+            sp.end(up=up, down=down)
+            tunnel_closed(label, up, down, seconds, sp.tag)
+            if tunnel is not None:
+                refused()
+
+        tunnel = splice.splice(reader, writer, target_reader, target_writer, label, closed, flow_log.open_flow(addr, label))
+        if tunnel.closed:
+            refused()  # gone before the handover: closed() ran before tunnel was bound
+        admin.track("tunnel", label, addr, tunnel, lambda: {
+            "priority": prio[0] if prio else None, "dscp": dscp[0] if dscp else None, "queued": tunnel.buffered(),
+            "trace": sp.tag})
+        spliced = True
+        tm.done()
             
     except asyncio.IncompleteReadError:
         pass
     except Exception as e:
-        print(f'DCS: Error: {e}')
+        print(f'DCS: Error: {e} trace={sp.tag}')
+        sp.end(error=str(e))
     finally:
-        await close_writer(writer)
+        if not spliced:
+            sp.end(refused=True)  # handshake rejected; after an error this is a no-op
+            await close_writer(writer)
+
+# -----------------------
+# Admin commands (see admin.py)
+# -----------------------
+
+def admin_debug(on: bool = True) -> dict:
+    global _DEBUG
+    _DEBUG = bool(on)
+    return {"debug": _DEBUG}
 
-async def main(host="0.0.0.0", port=1081):
-    server = await asyncio.start_server(handle_client, host, port)
+def admin_routes() -> dict:
+    return {"target_pool": target_pool.stats()["routes"],
+            "configured": {f"{h}:{p}": {"min": mn, "max": mx} for (h, p), (mn, mx) in POOL_ROUTES.items()}}
+
+admin.command("debug", admin_debug)
+admin.command("routes", admin_routes)
+admin.stats_source("target_pool", target_pool.stats)
+admin.stats_source("spans", spans.stats)
+
+async def main(host="0.0.0.0", port=1081, unix_path=""):
+    unix_path = unix_path or UNIX_PATH
+    server = await asyncio.start_server(handle_client, host, port, ssl=tls_link.server_context())
+    fastopen.listen(server)
+    unix_server = None
+    if unix_path:
+        # Co-located PPP: same protocol without the TCP loopback hop
+        unix_server = await tls_link.start_unix_server(handle_client, unix_path, tls_link.server_context())
+        print(f"DCS SOCKS5 server also listening on {unix_path}")
+    target_pool.start()
+    instrument.start()
+    flow_log.start("dcs")
+    spans.start_export("dcs")
+    await admin.start("dcs")
     addrs = ", ".join(str(s.getsockname()) for s in server.sockets or [])
     print(f"DCS SOCKS5 server listening on {addrs}")
     if _DEBUG:
         agent_log("H0", "socks5_dcs.py:main", "DCS listening", {"addrs": addrs})
-    async with server:
-        await server.serve_forever()
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        tls_link.close_unix_server(unix_server, unix_path)
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,31 @@
+import asyncio
+import struct
+from typing import Dict
+
+# PPP<->DCS flow metadata, sent as the sub-negotiation of METHOD_PPP_META:
+#   total_len(2) then TLVs of type(1) len(1) value(len)
+# A DCS that doesn't know the method simply picks METHOD_NO_AUTH and never sees it.
+
+MAX_META_LEN = 1024
+
+
+def encode_meta(items: Dict[int, bytes]) -> bytes:
+    body = b"".join(struct.pack("!BB", t, len(v)) + v for t, v in items.items())
+    return struct.pack("!H", len(body)) + body
+
+
+def decode_meta(body: bytes) -> Dict[int, bytes]:
+    items = {}
+    pos = 0
+    while pos + 2 <= len(body):
+        t, ln = body[pos], body[pos + 1]
+        items[t] = body[pos + 2:pos + 2 + ln]
+        pos += 2 + ln
+    return items
+
+
+async def read_meta(reader: asyncio.StreamReader) -> Dict[int, bytes]:
+    ln = struct.unpack("!H", await reader.readexactly(2))[0]
+    if ln > MAX_META_LEN:
+        raise ValueError(f"Flow metadata too long: {ln}")
+    return decode_meta(await reader.readexactly(ln))
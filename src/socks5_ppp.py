@@ -4,23 +4,49 @@ import socket
 import json
 import os
 import time
-from typing import Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 import socks5_commands as sc
+import admin
+import breaker
+import dcs_pool
+import fastopen
+import socks5_meta
+import classifier
+import flow_log
+import spans
+import instrument
+import sniff
+import splice
+import tls_link
 import common_paths
 
 BUFFER = 65536
 
 INGRESS_BIND_HOST = '0.0.0.0'
 INGRESS_PORT = 6767
+# Co-located producers: also accept on this Unix socket (HOST:PORT header, SOCKS5, CONNECT, ...)
+INGRESS_UNIX_PATH = ""
 
 DCS_HOST = '192.168.32.128'
-DCS_PORT = 1081  # DCS SOCKS5 server port
+DCS_PORT = 1081  # DCS SOCKS5 server port; a DCS_HOST starting with "/" is a Unix socket path
+DCS_CONNECT_TIMEOUT = 5.0  # TCP + TLS + method negotiation; beyond this the DCS counts as down
+# Several DCS boxes: list them all here; empty means DCS_HOST:DCS_PORT alone. See dcs_pool.
+DCS_POOL: List[Tuple[str, int]] = []
+DCS_POLICY = "ewma"  # rr | least | ewma
+DCS_PINS: Dict[str, List[str]] = {}  # traffic class, host or "*.suffix" -> ["host:port", ...]
+DCS_ATTEMPTS = 2  # members tried per flow before it fails (instant breaker refusals don't count)
 _DEBUG = True
 
 DST_OVERRIDE = {
     ("198.18.0.1", 8000): ("192.168.1.109", 8000),  # dummy -> real CCS
 }
 
+# Transparent flows: route by the host name the client asked for (TLS SNI / HTTP Host),
+# so the DCS resolves it and picks its own nearest endpoint. Clients that wait for the
+# server to speak first (SSH, SMTP, ...) are routed by IP after SNIFF_TIMEOUT.
+ROUTE_BY_NAME = True
+SNIFF_TIMEOUT = 0.3
+
 # Linux IPv4 original destination socket option
 SO_ORIGINAL_DST = 80
 
@@ -79,23 +105,90 @@ def pack_reply(rep:int, bind_host:str = '0.0.0.0', bind_port:int=0)->bytes:
         addr_part = socket.inet_pton(socket.AF_INET, '0.0.0.0')
     return struct.pack('!BBBB', sc.SOCKS_VERSION, rep, 0x00, atyp) + addr_part + struct.pack('!H', bind_port)
 
-async def socks5_connect_to_dcs(target_host: str, target_port: int):
-    """Connect to DCS via SOCKS5 and request connection to final target"""
-    # Connect to DCS SOCKS5 server
-    reader, writer = await asyncio.open_connection(DCS_HOST, DCS_PORT)
-    
-    # SOCKS5 handshake
-    writer.write(struct.pack('!BB', sc.SOCKS_VERSION, 1))  # VER, NMETHODS
-    writer.write(b'\x00')  # No auth
-    await writer.drain()
-    
-    # Receive auth reply
-    response = await reader.readexactly(2)
-    if response[0] != sc.SOCKS_VERSION or response[1] != 0x00:
+dcs_breakers = breaker.Breakers("dcs")
+_dcs: Optional[dcs_pool.DcsPool] = None
+
+def dcs() -> dcs_pool.DcsPool:
+    """The DCS pool, built from the settings above on first use."""
+    global _dcs
+    if _dcs is None:
+        _dcs = dcs_pool.DcsPool(DCS_POOL or [(DCS_HOST, DCS_PORT)], DCS_POLICY, DCS_PINS, _probe_dcs)
+    return _dcs
+
+async def _probe_dcs(host: str, port: int):
+    # Health check: the start of a real tunnel, up to the method reply
+    _, writer = await _dcs_handshake(host, port, None)
+    writer.close()
+
+async def _dcs_handshake(host: str, port: int, meta: Optional[dict]):
+    reader, writer = await tls_link.open_connection(host, port, "ppp")
+    try:
+        # SOCKS5 handshake
+        if meta:
+            writer.write(struct.pack('!BBBB', sc.SOCKS_VERSION, 2, sc.METHOD_PPP_META, sc.METHOD_NO_AUTH))
+        else:
+            writer.write(struct.pack('!BB', sc.SOCKS_VERSION, 1))  # VER, NMETHODS
+            writer.write(b'\x00')  # No auth
+        await writer.drain()
+
+        # Receive auth reply
+        response = await reader.readexactly(2)
+        fastopen.observe(writer, "ppp")
+    except BaseException:
+        writer.close()
+        raise
+    if response[0] != sc.SOCKS_VERSION or response[1] not in (sc.METHOD_NO_AUTH, sc.METHOD_PPP_META):
         writer.close()
         await writer.wait_closed()
         raise Exception("SOCKS5 auth failed")
+    if response[1] == sc.METHOD_PPP_META:
+        writer.write(socks5_meta.encode_meta(meta))
+    return reader, writer
+
+async def socks5_connect_to_dcs(target_host: str, target_port: int, meta: Optional[dict] = None, cls_name: str = ""):
+    """Connect to a DCS from the pool via SOCKS5 and request connection to final target.
+    meta (TLV type -> bytes) is offered through METHOD_PPP_META; older DCSs pick no-auth and skip it.
+    Returns (reader, writer, pool member). The member counts the flow as active from
+    the pick on, so least/ewma see handshakes in flight; the caller must pool.closed()
+    it once the tunnel ends (or fails before it is spliced)."""
+    # Connect to DCS SOCKS5 server (TLS with session resumption when configured).
+    # Everything up to the method reply says whether the DCS itself is up, so that part
+    # runs under the member's breaker (open: BreakerOpen at once) and a failure there
+    # moves on to another member; the target request below is never retried.
+    pool = dcs()
+    tried: List[dcs_pool.Member] = []
+    attempts = 0
+    while True:
+        member = pool.pick(cls_name, target_host, tried)
+        if member is None:
+            raise ConnectionError(f"no DCS available for {target_host}:{target_port}")
+        pool.opened(member)
+        try:
+            async with dcs_breakers.guard(member.endpoint):
+                t0 = time.perf_counter()
+                reader, writer = await asyncio.wait_for(
+                    _dcs_handshake(member.host, member.port, meta), DCS_CONNECT_TIMEOUT)
+            member.observe(time.perf_counter() - t0)
+            break
+        except BaseException as e:
+            pool.closed(member)
+            if not isinstance(e, Exception):
+                raise  # cancelled
+            tried.append(member)
+            if not isinstance(e, breaker.BreakerOpen):
+                attempts += 1
+            if attempts >= DCS_ATTEMPTS:
+                raise
+            print(f'PPP: DCS {member.name} failed ({e}), trying another')
     
+    try:
+        await _request_target(reader, writer, target_host, target_port)
+    except BaseException:
+        pool.closed(member)
+        raise
+    return reader, writer, member
+
+async def _request_target(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, target_host: str, target_port: int):
     # Send connect request to final target
     try:
         socket.inet_aton(target_host)
@@ -128,49 +221,29 @@ async def socks5_connect_to_dcs(target_host: str, target_port: int):
     elif atyp == 0x04:  # IPv6
         await reader.readexactly(16)
     await reader.readexactly(2)  # Port
-    
-    return reader, writer
+    tls_link.remember(writer)
 
-async def read_target_info(reader: asyncio.StreamReader) -> tuple[str, int, bytes]:
-    """Read target info from first packet: format "HOST:PORT\n" or binary format"""
-    # Try to read first packet (peek)
-    data = await reader.read(BUFFER)
-    if not data:
-        raise Exception("No data received")
-    
-    # Try to parse as text format "host:port\n"
+async def socks5_ingress(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, greeting: bytes) -> Tuple[str, int]:
+    """A producer speaking SOCKS5 to the direct ingress: no-auth, then CONNECT. The reply waits for the DCS."""
+    nmethods = greeting[1]
+    if sc.METHOD_NO_AUTH not in greeting[2:2 + nmethods]:
+        writer.write(bytes((sc.SOCKS_VERSION, sc.METHOD_NO_ACCEPTABLE)))
+        raise ValueError("SOCKS5 client offers no acceptable method")
+    if len(greeting) > 2 + nmethods:
+        raise ValueError("SOCKS5 request sent before the method reply")
+    writer.write(bytes((sc.SOCKS_VERSION, sc.METHOD_NO_AUTH)))
+    ver, cmd, _, atyp = await reader.readexactly(4)
+    if ver != sc.SOCKS_VERSION or cmd != sc.CMD_CONNECT:
+        writer.write(pack_reply(sc.REP_COMMAND_NOT_SUPPORTED))
+        raise ValueError(f"SOCKS5 ingress supports CONNECT only (cmd {cmd})")
     try:
-        text = data.decode('utf-8', errors='ignore')
-        if ':' in text and '\n' in text:
-            parts = text.split('\n')[0].split(':')
-            host = parts[0]
-            port = int(parts[1])
-            # Return remaining data
-            remaining = data[len(f"{host}:{port}\n".encode('utf-8')):]
-            return host, port, remaining
-    except:
-        pass
-    
-    # No header found; fail fast instead of guessing a local default
-    raise ValueError("No routing header 'HOST:PORT\\n' found in first packet for direct-ingress connection")
+        return await read_socks_addr(reader, atyp)
+    except ValueError:
+        writer.write(pack_reply(sc.REP_ADDR_TYPE_NOT_SUPPORTED))
+        raise
 
-async def pipe(reader:asyncio.StreamReader, writer:asyncio.StreamWriter, direction: str = ""):
-    try:
-        total_bytes = 0
-        while True:
-            data = await reader.read(BUFFER)
-            if not data:
-                print(f'WARN:no data:break {direction}')
-                break
-            writer.write(data)
-            await writer.drain()
-            total_bytes += len(data)
-            print(f'DATA: {direction} {len(data)} bytes (total: {total_bytes})')
-    except Exception as e:
-        print(f'ERR:pipe:{direction}:{str(e)}')
-    finally:
-        print(f'INFO: Pipe closed {direction}, total bytes transferred: {total_bytes}')
-        await close_writer(writer)
+def tunnel_closed(label:str, up:int, down:int, seconds:float, trace:str=''):
+    print(f'INFO: tunnel {label} closed after {seconds:.1f}s, up={up} down={down} bytes{f" trace={trace}" if trace else ""}')
 
 def get_original_dst(writer: asyncio.StreamWriter) -> Optional[tuple[str, int]]:
     """
@@ -199,14 +272,27 @@ async def handle_client(reader:asyncio.StreamReader, writer:asyncio.StreamWriter
     """Accept regular TCP connection, forward through SOCKS5 to DCS"""
     addr = writer.get_extra_info('peername')
     local_addr = writer.get_extra_info('sockname')
-    local_port = local_addr[1] if local_addr else None
+    local_port = local_addr[1] if isinstance(local_addr, tuple) else None
+    if not addr:
+        addr = f"unix:{local_addr}"  # Unix ingress: peers are unnamed
     
-    print(f'PPP: New regular TCP client connected from {addr} on port {local_port}')
+    # The flow's trace starts here; the DCS continues it from META_TRACE (see spans.py)
+    sp = spans.start("ppp.flow", peer=addr, ingress_port=local_port)
+    print(f'PPP: New regular TCP client connected from {addr} on port {local_port} trace={sp.tag}')
     if _DEBUG:
         agent_log("H1", "socks5_ppp.py:handle_client", "client connected", {"peer": addr, "local_port": local_port})
     
+    spliced = False
+    member = None  # DCS pool member, counted active until the tunnel (or this handler) releases it
+    if all(dcs_breakers.refusing(ep) for ep in dcs().endpoints()):
+        # Every DCS is down: drop the client now rather than sniff and queue it behind a dead link
+        writer.close()
+        sp.end(error="no DCS available")
+        return
+    tm = instrument.timer("ppp")
     try:
         first_data = b''
+        overridden = False
         # Prefer original destination if traffic arrived via NAT REDIRECT
         orig = get_original_dst(writer)
         if orig:
@@ -218,7 +304,10 @@ async def handle_client(reader:asyncio.StreamReader, writer:asyncio.StreamWriter
             if (new_ip, new_port) != (orig_ip, orig_port):
                 print(f"PPP: DST_OVERRIDE {orig_ip}:{orig_port} -> {new_ip}:{new_port}")
                 orig = (new_ip, new_port)
+                overridden = True
 
+        tm.mark("orig_dst")
+        sp.mark("orig_dst")
         if _DEBUG:
             agent_log("H2", "socks5_ppp.py:handle_client", "after SO_ORIGINAL_DST", {"orig": orig})
 
@@ -228,24 +317,51 @@ async def handle_client(reader:asyncio.StreamReader, writer:asyncio.StreamWriter
             if (orig[1] == INGRESS_PORT and orig[0] in ('127.0.0.1', '0.0.0.0', '::1')):
                 print(f'PPP: SO_ORIGINAL_DST is ingress ({orig[0]}:{orig[1]}), will parse target from packet')
                 orig = None
+        sniffed = None
         if orig:
             target_host, target_port = orig
             print(f'PPP: Using SO_ORIGINAL_DST -> {target_host}:{target_port}')
+            if ROUTE_BY_NAME and not overridden:  # an override is an explicit address, keep it
+                sniffed = await sniff.sniff(reader, SNIFF_TIMEOUT)
+                # Captured, not addressed to us: whatever the bytes look like, they all go to the target
+                first_data = sniffed.raw
+                tm.mark("sniff")
+                sp.mark("sniff", kind=sniffed.kind)
         else:
-            print('PPP: No SO_ORIGINAL_DST, parsing first packet')
+            print('PPP: No SO_ORIGINAL_DST, sniffing first bytes')
             if _DEBUG:
-                agent_log("H3", "socks5_ppp.py:handle_client", "parsing header", {})
-            target_host, target_port, first_data = await read_target_info(reader)
+                agent_log("H3", "socks5_ppp.py:handle_client", "sniffing", {})
+            sniffed = await sniff.sniff(reader)
+            tm.mark("sniff")
+            sp.mark("sniff", kind=sniffed.kind)
+            if sniffed.kind == sniff.KIND_SOCKS5:
+                sniffed.host, sniffed.port = await socks5_ingress(reader, writer, sniffed.data)
+                sniffed.data = b''
+            if sniffed.host is None:
+                raise ValueError(f"No routing information in first bytes for direct-ingress connection ({sniffed.kind})")
+            target_host, target_port = sniffed.host, sniffed.port
+            first_data = sniffed.data
         parsed_from_packet = orig is None
+        # Classify on the address we captured; the sniffed name only changes where the DCS connects
+        class_host = target_host
+        if orig and sniffed and sniffed.host and sniffed.kind in (sniff.KIND_TLS, sniff.KIND_HTTP):
+            if sniff.routable_name(sniffed.host):
+                print(f'PPP: {sniffed.kind} names {sniffed.host}, routing by name instead of {target_host}')
+                target_host = sniffed.host
+            else:
+                print(f'PPP: {sniffed.kind} names {sniffed.host}, not a routable name, keeping {target_host}')
         if _DEBUG:
             agent_log("H4", "socks5_ppp.py:handle_client", "target decided", {
-                "target_host": target_host, "target_port": target_port, "parsed_from_packet": parsed_from_packet
+                "target_host": target_host, "target_port": target_port, "parsed_from_packet": parsed_from_packet,
+                "sniffed": sniffed.kind if sniffed else None
             })
         
         # Loop guard: allow loopback only if target was explicitly provided via first packet parsing.
-        if ((target_host in ('127.0.0.1', '::1') and not parsed_from_packet) or
+        # A flow routed by name is checked under both the name and the captured address.
+        hosts = {target_host, class_host}
+        if ((hosts & {'127.0.0.1', '::1', 'localhost'} and not parsed_from_packet) or
             target_port == INGRESS_PORT or
-            (target_host == DCS_HOST and target_port == DCS_PORT)):
+            any((h, target_port) in dcs().endpoints() for h in hosts)):
             print(f'PPP: Loop guard triggered, refusing to proxy to {target_host}:{target_port}')
             if _DEBUG:
                 agent_log("H5", "socks5_ppp.py:handle_client", "loop guard triggered", {
@@ -253,46 +369,158 @@ async def handle_client(reader:asyncio.StreamReader, writer:asyncio.StreamWriter
                 })
             return
         
+        # Classify once per flow (cached per destination); the DCS re-marks its egress with the DSCP
+        tclass = classifier.classify(class_host, target_port, writer.get_extra_info('socket'), first_data)
+        meta = {sc.META_PRIORITY: bytes((tclass.priority,)), sc.META_DSCP: bytes((tclass.dscp,)),
+                sc.META_TRACE: sp.context()}
+        if target_host != class_host:
+            # Routed by name: the DCS only follows the name where it agrees with what we captured
+            meta[sc.META_ORIG_DST] = socket.inet_pton(socket.AF_INET6 if ':' in class_host else socket.AF_INET, class_host)
+        print(f'PPP: {target_host}:{target_port} classified as {tclass}')
+        tm.mark("classify")
+        sp.mark("classify", **{"class": tclass.name})
+        sp.set(target=f"{target_host}:{target_port}", priority=tclass.priority)
+
         # Connect to DCS via SOCKS5
         if _DEBUG:
             agent_log("H6", "socks5_ppp.py:handle_client", "connecting DCS", {
-                "dcs_host": DCS_HOST, "dcs_port": DCS_PORT, "target_host": target_host, "target_port": target_port
+                "dcs_policy": dcs().policy, "target_host": target_host, "target_port": target_port
             })
-        dcs_reader, dcs_writer = await socks5_connect_to_dcs(target_host, target_port)
-        print(f'PPP: Connected to DCS, tunnel established to {target_host}:{target_port}')
+        try:
+            dcs_reader, dcs_writer, member = await socks5_connect_to_dcs(target_host, target_port, meta, tclass.name)
+        except Exception as e:
+            # Only a client that spoke to us as a proxy (direct ingress) gets an answer from us
+            if parsed_from_packet and sniffed.kind == sniff.KIND_CONNECT:
+                writer.write(sniff.CONNECT_FAILED)
+            elif parsed_from_packet and sniffed.kind == sniff.KIND_SOCKS5:
+                unreachable = isinstance(e, breaker.BreakerOpen)
+                writer.write(pack_reply(sc.REP_HOST_UNREACHABLE if unreachable else sc.REP_GENERAL_FAILURE))
+            raise
+        classifier.apply_dscp(dcs_writer.get_extra_info('socket'), tclass.dscp)
+        tm.mark("dcs_connect")
+        sp.mark("dcs_connect", dcs=member.name)
+        print(f'PPP: Connected to DCS {member.name}, tunnel established to {target_host}:{target_port} trace={sp.tag}')
         if _DEBUG:
             agent_log("H7", "socks5_ppp.py:handle_client", "connected DCS", {
                 "target_host": target_host, "target_port": target_port
             })
         
+        if parsed_from_packet and sniffed.kind == sniff.KIND_CONNECT:
+            # HTTP proxy client: the DCS leg is up, so the tunnel is ready from its point of view
+            writer.write(sniff.CONNECT_OK)
+        elif parsed_from_packet and sniffed.kind == sniff.KIND_SOCKS5:
+            writer.write(pack_reply(sc.REP_SUCCEEDED))
+
         # Send first data packet if any
         if first_data:
             dcs_writer.write(first_data)
             await dcs_writer.drain()
         
-        # Tunnel data both ways
-        t1 = asyncio.create_task(pipe(reader, dcs_writer, f"client->DCS->{target_host}:{target_port}"))
-        t2 = asyncio.create_task(pipe(dcs_reader, writer, f"DCS->{target_host}:{target_port}->client"))
-        
-        done, pending = await asyncio.wait({t1, t2}, return_when=asyncio.FIRST_COMPLETED)
-        for p in pending:
-            p.cancel()
+        # Tunnel data both ways on protocol callbacks; this handler task ends here
+        label = splice.label(target_host, target_port)
+        pool = dcs()
+
+        def closed(label, up, down, seconds):
+            pool.closed(member)
+            sp.end(up=up, down=down)
+            tunnel_closed(label, up, down, seconds, sp.tag)
+
+        tunnel = splice.splice(reader, writer, dcs_reader, dcs_writer, label, closed, flow_log.open_flow(addr, label))
+        spliced = True  # from here closed() releases the member
+        admin.track("tunnel", label, addr, tunnel, lambda: {
+            "class": tclass.name, "priority": tclass.priority, "dcs": member.name, "queued": tunnel.buffered(),
+            "trace": sp.tag})
+        tunnel.a.rx += len(first_data)  # sent above, ahead of the splice; count it as upstream bytes
+        tm.done()
             
     except Exception as e:
-        print(f'PPP: Error: {e}')
+        print(f'PPP: Error: {e} trace={sp.tag}')
+        sp.end(error=str(e))
         agent_log("H8", "socks5_ppp.py:handle_client", "exception", {"error": str(e)})
     finally:
-        await close_writer(writer)
+        if not spliced:
+            if member is not None:
+                dcs().closed(member)
+                dcs_writer.close()
+            sp.end(refused=True)  # loop guard; after an error this is a no-op
+            await close_writer(writer)
+
+# -----------------------
+# Admin commands (see admin.py)
+# -----------------------
+
+def admin_debug(on: bool = True) -> dict:
+    global _DEBUG
+    _DEBUG = bool(on)
+    return {"debug": _DEBUG}
+
+def admin_override(src: str, dst: Optional[str] = None) -> dict:
+    """Add or replace a DST_OVERRIDE entry; without dst, remove it. Applies to new flows."""
+    key = admin.endpoint(src)
+    if dst:
+        DST_OVERRIDE[key] = admin.endpoint(dst)
+    else:
+        DST_OVERRIDE.pop(key, None)
+    return admin_routes()["overrides"]
+
+async def admin_dcs(members: List[str], policy: str = "") -> dict:
+    """
+    Replace the DCS pool. New flows use the new members at once; tunnels already
+    running on the old pool are not touched.
+    """
+    global _dcs
+    pins = {k: v for k, v in DCS_PINS.items() if all(n in members for n in v)}
+    pool = dcs_pool.DcsPool([admin.endpoint(m) for m in members], policy or DCS_POLICY, pins, _probe_dcs)
+    old, _dcs = _dcs, pool
+    pool.start()
+    if old is not None:
+        await old.close()
+    return pool.stats()
+
+def admin_drain(name: str, on: bool = True) -> dict:
+    dcs().drain(name, on)
+    return dcs().stats()["members"][name]
+
+def admin_routes() -> dict:
+    return {
+        "overrides": {f"{h}:{p}": f"{nh}:{np}" for (h, p), (nh, np) in DST_OVERRIDE.items()},
+        "route_by_name": ROUTE_BY_NAME,
+        "dcs": dcs().stats(),
+        "class_rules": [{"class": r.cls.name, "dst": str(r.net) if r.net else None, "ports": sorted(r.ports),
+                         "dscp": r.dscp, "mark": r.mark} for r in classifier.RULES],
+    }
+
+admin.command("debug", admin_debug)
+admin.command("override", admin_override)
+admin.command("dcs", admin_dcs)
+admin.command("drain", admin_drain)
+admin.command("routes", admin_routes)
+admin.stats_source("dcs", lambda: dcs().stats())
+admin.stats_source("dcs_breakers", dcs_breakers.stats)
+admin.stats_source("spans", spans.stats)
 
 async def main(): 
     server = await asyncio.start_server(handle_client, INGRESS_BIND_HOST, INGRESS_PORT)
+    fastopen.listen(server)
     addrs = ", ".join(str(s.getsockname()) for s in server.sockets or [])
     print(f"PPP Proxy listening on {addrs} (single ingress) via DCS")
+    unix_server = None
+    if INGRESS_UNIX_PATH:
+        unix_server = await tls_link.start_unix_server(handle_client, INGRESS_UNIX_PATH)
+        print(f"PPP Proxy also listening on {INGRESS_UNIX_PATH}")
+    instrument.start()
+    flow_log.start("ppp")
+    dcs().start()
+    spans.start_export("ppp")
+    await admin.start("ppp")
     if _DEBUG:
         agent_log("H0", "socks5_ppp.py:main", "PPP listening", {"addrs": addrs})
 
-    async with server:
-        await server.serve_forever()
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        tls_link.close_unix_server(unix_server, INGRESS_UNIX_PATH)
     
     # Keep all servers running concurrently
     async def run_server(server):
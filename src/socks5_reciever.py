@@ -3,6 +3,7 @@ import struct
 import socket
 from typing import Optional, Tuple, final
 import socks5_commands as sc
+import udp_relay
 from socks5_dataclass import SocksAddress
 
 BUFFER = 65536
@@ -65,6 +66,25 @@ async def pipe(reader:asyncio.StreamReader, writer:asyncio.StreamWriter, directi
         await close_writer(writer)
 
 
+async def relay_udp(reader:asyncio.StreamReader, writer:asyncio.StreamWriter, client_port:int):
+    """Serve a UDP ASSOCIATE for as long as its TCP control connection stays open"""
+    client_ip = writer.get_extra_info('peername')[0]
+    bind_host = writer.get_extra_info('sockname')[0]
+    try:
+        assoc = await udp_relay.open_association(bind_host, client_ip, client_port)
+    except Exception as e:
+        writer.write(pack_reply(sc.REP_GENERAL_FAILURE))
+        await writer.drain()
+        print(f'ERR:UDP associate:{str(e)}')
+        return
+    bhost, bport = assoc.sockname
+    writer.write(pack_reply(sc.REP_SUCCEEDED, bind_host=bhost, bind_port=bport))
+    await writer.drain()
+    print(f'UDP associate for {client_ip} relaying on {bhost}:{bport}')
+    await assoc.serve(reader)
+    print(f'UDP associate for {client_ip} closed: {assoc.stats()}')
+
+
 async def handle_client(reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
     print('INFO: New client connected')
     try:
@@ -97,7 +117,7 @@ async def handle_client(reader:asyncio.StreamReader, writer:asyncio.StreamWriter
             print(f'ERR:connect request')
             return
 
-        if cmd != sc.CMD_CONNECT:
+        if cmd not in (sc.CMD_CONNECT, sc.CMD_UDP_ASSOCIATE):
             writer.write(pack_reply(sc.REP_COMMAND_NOT_SUPPORTED))
             await writer.drain()
             await close_writer(writer)
@@ -113,6 +133,11 @@ async def handle_client(reader:asyncio.StreamReader, writer:asyncio.StreamWriter
             print(f'ERR:Value Error:{str(ve)}')
             return
 
+        if cmd == sc.CMD_UDP_ASSOCIATE:
+            # DST.ADDR/DST.PORT name the client's UDP source; only its port is useful to us
+            await relay_udp(reader, writer, dst_port)
+            return
+
         # 3) target connection
         # --------------------
         try:
@@ -0,0 +1,274 @@
+import argparse
+import atexit
+import glob
+import json
+import os
+import random
+import socket
+import threading
+import time
+from collections import deque
+from typing import Iterator, List, Optional
+
+# -----------------------
+# Flow trace IDs and timing spans
+# -----------------------
+# Every flow gets a 128-bit trace ID at ingress (socks5_ppp, or the mux PPP at OPEN).
+# It travels to the DCS as a trace context, so both hops log and record under one ID:
+#   trace_id(16) parent_span_id(8) flags(1)   (the W3C traceparent fields, binary)
+# in the METHOD_PPP_META TLV META_TRACE, or after the target in a mux OPEN once
+# HELLO has negotiated mux_wire.CAP_TRACE. Log lines carry Span.tag, the first 16
+# hex digits of the trace ID.
+#
+# IDs are always on. Span recording is off unless SOCKS_PROXY_SPAN_DIR is set:
+# finished spans then go into an in-memory buffer, and a background thread writes
+# them in batches as OTLP/JSON (one ExportTraceServiceRequest per line, as the
+# OpenTelemetry Collector file exporter does) to
+#   <dir>/spans-<component>-<pid>-<YYYYmmddTHHMMSS>.jsonl
+# Any OTLP consumer can load these; `python spans.py <files> --trace <id>` prints one
+# flow's timeline across all the machines whose files are given. Times are wall clock,
+# so cross-machine timelines are only as good as the hosts' clock sync.
+#
+#   sp = spans.start("ppp.flow", peer=addr)
+#   sp.mark("sniff")            # child span "ppp.flow.sniff" from the previous mark to now
+#   meta[META_TRACE] = sp.context()
+#   sp.end(up=..., down=...)    # the flow span itself
+
+SPAN_DIR = os.environ.get("SOCKS_PROXY_SPAN_DIR", "")
+ENABLED = bool(SPAN_DIR)
+
+CONTEXT_LEN = 25
+FLAG_SAMPLED = 0x01
+
+FLUSH_INTERVAL = 1.0      # writer wakes at least this often
+BATCH_SPANS = 512         # ... or as soon as this many spans are buffered
+MAX_QUEUED = 50_000       # beyond this spans are dropped (and counted), not buffered
+ROTATE_BYTES = 32 * 1024 * 1024
+ROTATE_KEEP = 24          # files kept per component
+
+# OTLP SpanKind
+KIND_INTERNAL = 1
+KIND_SERVER = 2
+
+_rand = random.Random()
+
+
+def _new_id(nbytes: int) -> bytes:
+    return _rand.getrandbits(nbytes * 8).to_bytes(nbytes, "big")
+
+
+class Span:
+    """One flow (or mux stream) on one hop; mark() adds consecutive child spans for its stages."""
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "start_ns", "mark_ns", "attrs", "ended")
+
+    def __init__(self, name: str, parent: Optional[bytes] = None, **attrs):
+        self.name = name
+        self.span_id = _new_id(8)
+        self.trace_id = self.parent_id = b""
+        self.join(parent)
+        self.start_ns = self.mark_ns = time.time_ns()
+        self.attrs = attrs
+        self.ended = False
+
+    def join(self, parent: Optional[bytes]):
+        """Continue the trace of an upstream hop's context(); a missing or bad one starts a new trace."""
+        if parent and len(parent) >= CONTEXT_LEN - 1:
+            self.trace_id, self.parent_id = bytes(parent[:16]), bytes(parent[16:24])
+        elif not self.trace_id:
+            self.trace_id = _new_id(16)
+
+    def context(self) -> bytes:
+        return self.trace_id + self.span_id + bytes((FLAG_SAMPLED,))
+
+    @property
+    def tag(self) -> str:
+        return self.trace_id[:8].hex()
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def mark(self, stage: str, **attrs):
+        now = time.time_ns()
+        if ENABLED:
+            _writer.put((self.trace_id, _new_id(8), self.span_id, f"{self.name}.{stage}",
+                         KIND_INTERNAL, self.mark_ns, now, attrs))
+        self.mark_ns = now
+
+    def end(self, **attrs):
+        if self.ended:
+            return
+        self.ended = True
+        if ENABLED:
+            self.attrs.update(attrs)
+            _writer.put((self.trace_id, self.span_id, self.parent_id, self.name,
+                         KIND_SERVER, self.start_ns, time.time_ns(), self.attrs))
+
+
+def start(name: str, parent: Optional[bytes] = None, **attrs) -> Span:
+    return Span(name, parent, **attrs)
+
+
+# -----------------------
+# Export
+# -----------------------
+
+def _value(v) -> dict:
+    if isinstance(v, bool):
+        return {"boolValue": v}
+    if isinstance(v, int):
+        return {"intValue": str(v)}
+    if isinstance(v, float):
+        return {"doubleValue": v}
+    if isinstance(v, tuple):
+        v = f"{v[0]}:{v[1]}"
+    return {"stringValue": str(v)}
+
+
+def _otlp_span(rec: tuple) -> dict:
+    trace_id, span_id, parent_id, name, kind, start_ns, end_ns, attrs = rec
+    return {"traceId": trace_id.hex(), "spanId": span_id.hex(), "parentSpanId": parent_id.hex(),
+            "name": name, "kind": kind, "startTimeUnixNano": str(start_ns), "endTimeUnixNano": str(end_ns),
+            "attributes": [{"key": k, "value": _value(v)} for k, v in attrs.items() if v is not None]}
+
+
+def _resource(component: str) -> dict:
+    return {"attributes": [{"key": "service.name", "value": {"stringValue": f"socks_proxy.{component}"}},
+                           {"key": "host.name", "value": {"stringValue": socket.gethostname()}},
+                           {"key": "process.pid", "value": {"intValue": str(os.getpid())}}]}
+
+
+class _Writer:
+    """Background thread that drains the span buffer into rotating JSON-lines files."""
+
+    def __init__(self):
+        self.queue = deque()
+        self.wake = threading.Event()
+        self.lock = threading.Lock()   # one flush at a time (thread vs atexit)
+        self.component = ""
+        self.thread: Optional[threading.Thread] = None
+        self.file = None
+        self.path = ""
+        self.size = 0
+        self.resource: dict = {}
+        self.counters = {"spans": 0, "batches": 0, "dropped": 0, "files": 0}
+
+    def put(self, rec: tuple):
+        if len(self.queue) >= MAX_QUEUED:
+            self.counters["dropped"] += 1
+            return
+        self.queue.append(rec)
+        if len(self.queue) >= BATCH_SPANS:
+            self.wake.set()
+
+    def start(self, component: str):
+        if self.thread is None:
+            os.makedirs(SPAN_DIR, exist_ok=True)
+            self.component = component
+            self.resource = _resource(component)
+            self.thread = threading.Thread(target=self._run, name="span-writer", daemon=True)
+            self.thread.start()
+            atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            self.wake.wait(FLUSH_INTERVAL)
+            self.wake.clear()
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            batch = []
+            while self.queue:
+                batch.append(self.queue.popleft())
+            if not batch:
+                return
+            line = json.dumps({"resourceSpans": [{"resource": self.resource, "scopeSpans": [
+                {"scope": {"name": "socks_proxy"}, "spans": [_otlp_span(r) for r in batch]}]}]},
+                separators=(",", ":")).encode() + b"\n"
+            self._rotate_if_due()
+            self.file.write(line)
+            self.file.flush()
+            self.size += len(line)
+            self.counters["spans"] += len(batch)
+            self.counters["batches"] += 1
+
+    def _rotate_if_due(self):
+        component = self.component
+        if self.file is not None and self.size < ROTATE_BYTES:
+            return
+        if self.file is not None:
+            self.file.close()
+        stamp = time.strftime("%Y%m%dT%H%M%S")
+        self.path = os.path.join(SPAN_DIR, f"spans-{component}-{os.getpid()}-{stamp}.jsonl")
+        self.file = open(self.path, "ab")
+        self.size = 0
+        self.counters["files"] += 1
+        old = sorted(glob.glob(os.path.join(SPAN_DIR, f"spans-{component}-*.jsonl")), key=os.path.getmtime)
+        for path in old[:-ROTATE_KEEP]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+_writer = _Writer()
+
+
+def start_export(component: str):
+    """Start the writer thread; no-op when span recording is off."""
+    if not ENABLED:
+        return
+    _writer.start(component)
+    print(f"[spans] recording OTLP/JSON spans to {SPAN_DIR}")
+
+
+def stats() -> dict:
+    return dict(_writer.counters, enabled=ENABLED, queued=len(_writer.queue), file=_writer.path)
+
+
+# -----------------------
+# Reading
+# -----------------------
+
+def read_spans(paths: List[str]) -> Iterator[dict]:
+    """Flatten exported files into span dicts, each with its resource's service.name and host.name."""
+    for path in paths:
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    req = json.loads(line)
+                except ValueError:
+                    continue  # a line cut short by a crash
+                for rs in req.get("resourceSpans", ()):
+                    res = {a["key"]: next(iter(a["value"].values())) for a in rs["resource"]["attributes"]}
+                    for ss in rs.get("scopeSpans", ()):
+                        for sp in ss.get("spans", ()):
+                            sp["service"] = res.get("service.name", "")
+                            sp["host"] = res.get("host.name", "")
+                            yield sp
+
+
+def timeline(paths: List[str], trace: str) -> List[dict]:
+    """Every span of one trace (full ID or a prefix such as a log tag), ordered by start time."""
+    found = [sp for sp in read_spans(paths) if sp["traceId"].startswith(trace)]
+    found.sort(key=lambda sp: int(sp["startTimeUnixNano"]))
+    return found
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Print one flow's spans across hops from exported span files")
+    ap.add_argument("files", nargs="+", help="span files or directories")
+    ap.add_argument("--trace", required=True, help="trace ID, or the tag from a log line")
+    args = ap.parse_args()
+    files = []
+    for p in args.files:
+        files.extend(sorted(glob.glob(os.path.join(p, "spans-*.jsonl"))) if os.path.isdir(p) else [p])
+    spans = timeline(files, args.trace)
+    if not spans:
+        raise SystemExit(f"no spans for trace {args.trace}")
+    t0 = int(spans[0]["startTimeUnixNano"])
+    for sp in spans:
+        start_ms = (int(sp["startTimeUnixNano"]) - t0) / 1e6
+        dur_ms = (int(sp["endTimeUnixNano"]) - int(sp["startTimeUnixNano"])) / 1e6
+        attrs = " ".join(f"{a['key']}={next(iter(a['value'].values()))}" for a in sp["attributes"])
+        print(f"{start_ms:10.3f} ms  {dur_ms:10.3f} ms  {sp['host']:>12} {sp['service']:>20}  {sp['name']}  {attrs}")
@@ -0,0 +1,283 @@
+import asyncio
+import sys
+import time
+from typing import Callable, Optional
+
+# -----------------------
+# Task-free byte splice
+# -----------------------
+# Once a tunnel is established nothing about it needs a coroutine: each socket gets
+# a small protocol object whose data_received writes straight into the other
+# transport. Backpressure is the transports' own: when one side's write buffer
+# passes its high-water mark, reading on the other side is paused.
+
+# Shared upstream (mux connection) buffer above which target feeds stop reading
+FEED_HIGH_WATER = 256 * 1024
+
+_labels = {}
+
+
+def label(host: str, port: int) -> str:
+    """Interned "host:port" so thousands of tunnels to one target share a single string."""
+    key = (host, port)
+    s = _labels.get(key)
+    if s is None:
+        s = _labels[key] = sys.intern(f"{host}:{port}")
+    return s
+
+
+class _Side(asyncio.Protocol):
+    __slots__ = ("tunnel", "transport", "peer", "rx", "writer", "exc")
+
+    def __init__(self, tunnel: "Tunnel", writer: asyncio.StreamWriter):
+        self.tunnel = tunnel
+        self.transport = writer.transport
+        self.peer: Optional["_Side"] = None
+        self.rx = 0
+        # StreamWriter.__del__ closes its transport, so the writer must outlive the handover;
+        # the stream protocol and reader behind it are dead weight from here on
+        writer._protocol = writer._reader = None
+        self.writer = writer
+        self.exc: Optional[BaseException] = None  # what the connection ended with, if it failed
+
+    def data_received(self, data: bytes):
+        self.rx += len(data)
+        self.peer.transport.write(data)
+
+    def eof_received(self):
+        # Same as the old pipe(): EOF on one side closes the other once its buffer is flushed
+        self.peer.transport.close()
+        return False
+
+    def pause_writing(self):
+        self.peer.transport.pause_reading()
+
+    def resume_writing(self):
+        self.peer.transport.resume_reading()
+
+    def connection_lost(self, exc):
+        self.exc = exc
+        self.peer.transport.close()
+        self.tunnel.side_closed()
+
+
+class Tunnel:
+    """
+    Two spliced transports; on_close(label, bytes_a_to_b, bytes_b_to_a, seconds) runs once both are gone.
+    flow (flow_log.open_flow) reads the counters while the tunnel lives and is closed with it.
+    """
+    __slots__ = ("a", "b", "label", "on_close", "started", "open_sides", "flow")
+
+    def __init__(self, label: str, on_close: Optional[Callable] = None):
+        self.label = label
+        self.on_close = on_close
+        self.started = time.monotonic()
+        self.open_sides = 2
+        self.flow = None
+
+    @property
+    def up(self) -> int:
+        return self.a.rx
+
+    @property
+    def down(self) -> int:
+        return self.b.rx
+
+    @property
+    def closed(self) -> bool:
+        return self.open_sides == 0
+
+    def buffered(self) -> int:
+        """Bytes waiting in both sides' write buffers."""
+        if self.closed:
+            return 0
+        return self.a.transport.get_write_buffer_size() + self.b.transport.get_write_buffer_size()
+
+    def close(self):
+        self.a.transport.close()
+        self.b.transport.close()
+
+    def side_closed(self):
+        self.open_sides -= 1
+        if self.open_sides == 0:
+            a, b = self.a, self.b
+            if self.flow is not None:
+                self.flow.close()
+                self.flow = None
+            # Break the cycles so the tunnel is freed without waiting for the collector
+            a.peer = b.peer = a.writer = b.writer = None
+            if self.on_close:
+                self.on_close(self.label, a.rx, b.rx, time.monotonic() - self.started)
+
+
+def _take_buffered(reader: asyncio.StreamReader) -> bytes:
+    # Bytes the StreamReader already pulled in during the handshake (no public drain exists)
+    data = bytes(reader._buffer)
+    reader._buffer.clear()
+    return data
+
+
+def splice(a_reader: asyncio.StreamReader, a_writer: asyncio.StreamWriter,
+           b_reader: asyncio.StreamReader, b_writer: asyncio.StreamWriter,
+           label: str, on_close: Optional[Callable] = None, flow=None) -> Tunnel:
+    """
+    Hand two established stream pairs over to protocol callbacks and return immediately.
+    The caller must not close the writers afterwards; the tunnel closes itself.
+    """
+    tunnel = Tunnel(label, on_close)
+    if flow is not None:
+        tunnel.flow, flow.source = flow, tunnel
+    a = tunnel.a = _Side(tunnel, a_writer)
+    b = tunnel.b = _Side(tunnel, b_writer)
+    a.peer, b.peer = b, a
+
+    for side, reader in ((a, a_reader), (b, b_reader)):
+        if side.transport.is_closing():
+            # Already gone before the handover: no callbacks will come for it
+            side.exc = reader.exception()
+            side.peer.transport.close()
+            tunnel.side_closed()
+            continue
+        side.transport.set_protocol(side)
+
+    for src, dst, reader in ((a, b, a_reader), (b, a, b_reader)):
+        early = _take_buffered(reader)
+        if early:
+            src.rx += len(early)
+            dst.transport.write(early)
+        if reader.at_eof():
+            dst.transport.close()
+        elif not src.transport.is_reading() and not src.transport.is_closing():
+            # The StreamReader may have paused reading on a full buffer
+            src.transport.resume_reading()
+    return tunnel
+
+
+class Gate:
+    """Backpressure from one shared upstream writer (a mux connection) onto many feeds."""
+    __slots__ = ("writer", "paused", "waiter")
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+        self.paused = []
+        self.waiter: Optional[asyncio.Future] = None
+
+    def check(self, feed: "Feed"):
+        if self.writer.transport.get_write_buffer_size() <= FEED_HIGH_WATER:
+            return
+        feed.transport.pause_reading()
+        self.paused.append(feed)
+        if self.waiter is None:
+            # One drain waiter per upstream, however many feeds are parked behind it
+            self.waiter = asyncio.ensure_future(self._release())
+
+    async def _release(self):
+        try:
+            await self.writer.drain()
+        except Exception:
+            pass
+        finally:
+            paused, self.paused, self.waiter = self.paused, [], None
+            for feed in paused:
+                if not feed.transport.is_closing() and not feed.held:
+                    feed.transport.resume_reading()
+
+
+class Feed(asyncio.Protocol):
+    """
+    A target socket whose bytes go to on_data and whose end goes to on_close, without a task.
+    Writes towards the target go through write()/drain(); up/down count bytes to/from the target.
+    """
+    __slots__ = ("transport", "writer", "gate", "on_data", "on_close", "_drained", "up", "down", "flow", "held")
+
+    def __init__(self, writer: asyncio.StreamWriter, gate: Gate,
+                 on_data: Callable[[bytes], None], on_close: Callable[[], None]):
+        self.transport = writer.transport
+        writer._protocol = writer._reader = None  # see _Side
+        self.writer = writer
+        self.gate = gate
+        self.on_data = on_data
+        self.on_close = on_close
+        self._drained: Optional[asyncio.Future] = None
+        self.up = self.down = 0
+        self.flow = None
+        self.held = False  # paused by the upstream peer; the gate leaves it paused
+
+    def data_received(self, data: bytes):
+        self.down += len(data)
+        self.on_data(data)
+        self.gate.check(self)
+
+    def eof_received(self):
+        return False  # close; connection_lost reports the end
+
+    def pause_writing(self):
+        self._drained = asyncio.get_running_loop().create_future()
+
+    def resume_writing(self):
+        fut, self._drained = self._drained, None
+        if fut is not None and not fut.done():
+            fut.set_result(None)
+
+    def connection_lost(self, exc):
+        self.resume_writing()
+        on_close = self.on_close
+        self.on_data = self.on_close = self.writer = None
+        if self.flow is not None:
+            self.flow.close()
+            self.flow = None
+        if on_close:
+            on_close()
+
+    @property
+    def closed(self) -> bool:
+        return self.writer is None
+
+    def write(self, data: bytes):
+        self.up += len(data)
+        self.transport.write(data)
+
+    async def drain(self):
+        if self._drained is not None:
+            await asyncio.shield(self._drained)
+
+    def close(self):
+        self.transport.close()
+
+    def hold(self):
+        self.held = True
+        if not self.transport.is_closing():
+            self.transport.pause_reading()
+
+    def release(self):
+        self.held = False
+        if not self.transport.is_closing() and not self.transport.is_reading():
+            self.transport.resume_reading()
+
+
+def feed(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, gate: Gate,
+         on_data: Callable[[bytes], None], on_close: Callable[[], None], flow=None) -> Feed:
+    """Hand an established target stream pair over to a Feed; early bytes are delivered at once."""
+    f = Feed(writer, gate, on_data, on_close)
+    if flow is not None:
+        f.flow, flow.source = flow, f
+    if f.transport.is_closing():
+        # Already gone before the handover: no callbacks will come for it. The end is
+        # reported on the next loop pass, as connection_lost would be, once the caller
+        # has published the feed
+        early = _take_buffered(reader)
+        if early:
+            f.down += len(early)
+            on_data(early)
+        asyncio.get_running_loop().call_soon(f.connection_lost, reader.exception())
+        return f
+    f.transport.set_protocol(f)
+    early = _take_buffered(reader)
+    if early:
+        f.down += len(early)
+        on_data(early)
+    if reader.at_eof():
+        f.transport.close()
+    elif not f.transport.is_reading() and not f.transport.is_closing():
+        f.transport.resume_reading()
+    return f
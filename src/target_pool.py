@@ -0,0 +1,217 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+import breaker
+
+Dest = Tuple[str, int]
+Conn = Tuple[asyncio.StreamReader, asyncio.StreamWriter]
+ConnectFn = Callable[[str, int], Awaitable[Conn]]
+
+REFILL_BACKOFF = 5.0  # seconds to leave a route alone after a refill connect fails
+CONNECT_TIMEOUT = 10.0  # give up on a target well before the kernel's SYN retries do
+MAX_SEEN = 4096  # destinations tracked for learning; the least recently seen go first
+
+
+class _Route:
+    """Idle connections and demand counters for one destination."""
+    def __init__(self, min_idle: int, max_idle: int, learned: bool):
+        self.min_idle = min_idle
+        self.max_idle = max_idle
+        self.learned = learned
+        self.idle: Deque[Tuple[asyncio.StreamReader, asyncio.StreamWriter, float]] = deque()
+        self.connecting = 0
+        self.recent: Deque[float] = deque()  # acquire timestamps inside the demand window
+        self.last_used = time.monotonic()
+        self.retry_at = 0.0  # refill backoff after a failed connect
+
+
+class TargetPool:
+    """
+    Per-destination pool of pre-established target connections.
+
+    Routes are configured up front as {(host, port): (min_idle, max_idle)} or learned
+    once a destination sees learn_threshold connects inside learn_window seconds.
+    A background task keeps each route's idle set between min_idle and max_idle,
+    sized by recent demand, and drops connections that went stale or were closed
+    by the target. Refills use fill_connect when given (a connect that must really
+    reach the target before it returns; defaults to connect). acquire() never waits on the pool: a miss is a normal connect.
+    Connects go through a per-destination circuit breaker, so a target that keeps
+    failing is refused at once (breaker.BreakerOpen) instead of tying up a connect.
+    """
+    def __init__(self,
+                 connect: ConnectFn,
+                 routes: Optional[Dict[Dest, Tuple[int, int]]] = None,
+                 learn_threshold: int = 5,
+                 learn_window: float = 10.0,
+                 learned_min: int = 1,
+                 learned_max: int = 4,
+                 max_idle_age: float = 30.0,
+                 refill_interval: float = 0.5,
+                 fill_connect: Optional[ConnectFn] = None):
+        self.connect = connect
+        self.fill_connect = fill_connect or connect
+        self.routes: Dict[Dest, _Route] = {}
+        for dest, (mn, mx) in (routes or {}).items():
+            self.routes[dest] = _Route(mn, max(mn, mx), learned=False)
+        self.learn_threshold = learn_threshold
+        self.learn_window = learn_window
+        self.learned_min = learned_min
+        self.learned_max = learned_max
+        self.max_idle_age = max_idle_age
+        self.refill_interval = refill_interval
+        # Connect times per not-yet-pooled destination, least recently seen first
+        self._seen: "OrderedDict[Dest, Deque[float]]" = OrderedDict()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.hits = 0
+        self.misses = 0
+        self.breakers = breaker.Breakers("target")
+
+    def start(self):
+        """Start the background refill task; configured routes are warmed right away."""
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._refill_loop())
+
+    async def acquire(self, host: str, port: int) -> Conn:
+        """Hand out a live pooled connection to host:port, or connect a fresh one."""
+        self.start()
+        dest = (host, port)
+        now = time.monotonic()
+        route = self.routes.get(dest)
+        if route is None:
+            route = self._learn(dest, now)
+        if route is not None:
+            route.last_used = now
+            route.recent.append(now)
+            while route.idle:
+                reader, writer, created = route.idle.pop()
+                if self._alive(reader, writer, created, now):
+                    self.hits += 1
+                    self._wakeup.set()
+                    return reader, writer
+                writer.close()
+            self._wakeup.set()
+        self.misses += 1
+        return await self._connect(dest)
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "tracked": len(self._seen),
+            "breakers": self.breakers.stats(),
+            "routes": {
+                f"{h}:{p}": {"idle": len(r.idle), "connecting": r.connecting,
+                             "min": r.min_idle, "max": r.max_idle, "learned": r.learned}
+                for (h, p), r in self.routes.items()
+            },
+        }
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for route in self.routes.values():
+            while route.idle:
+                route.idle.pop()[1].close()
+
+    async def _connect(self, dest: Dest, connect: Optional[ConnectFn] = None) -> Conn:
+        async with self.breakers.guard(dest):
+            return await asyncio.wait_for((connect or self.connect)(dest[0], dest[1]), CONNECT_TIMEOUT)
+
+    def _learn(self, dest: Dest, now: float) -> Optional[_Route]:
+        seen = self._seen.get(dest)
+        if seen is None:
+            seen = self._seen[dest] = deque()
+            if len(self._seen) > MAX_SEEN:
+                self._seen.popitem(last=False)
+        else:
+            self._seen.move_to_end(dest)
+        seen.append(now)
+        while seen and now - seen[0] > self.learn_window:
+            seen.popleft()
+        if len(seen) < self.learn_threshold:
+            return None
+        del self._seen[dest]
+        route = self.routes[dest] = _Route(self.learned_min, self.learned_max, learned=True)
+        print(f"[pool] learned hot destination {dest[0]}:{dest[1]}")
+        return route
+
+    def _alive(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, created: float, now: float) -> bool:
+        # The transport keeps reading while idle, so a target-side close shows up as EOF
+        return (now - created < self.max_idle_age
+                and not writer.is_closing()
+                and not reader.at_eof()
+                and reader.exception() is None)
+
+    def _target_size(self, route: _Route, now: float) -> int:
+        # Keep roughly one second's worth of demand warm, clamped to the route limits
+        while route.recent and now - route.recent[0] > 1.0:
+            route.recent.popleft()
+        return max(route.min_idle, min(route.max_idle, len(route.recent)))
+
+    async def _refill_loop(self):
+        while True:
+            now = time.monotonic()
+            for dest, route in list(self.routes.items()):
+                self._refill(dest, route, now)
+            self._sweep_seen(now)
+            # A timer rather than wait_for: on 3.11, cancelling wait_for just after the event
+            # fired (acquire() sets it without yielding) can leave close() waiting forever
+            timer = asyncio.get_running_loop().call_later(self.refill_interval, self._wakeup.set)
+            try:
+                await self._wakeup.wait()
+            finally:
+                timer.cancel()
+            self._wakeup.clear()
+
+    def _sweep_seen(self, now: float):
+        # Destinations not seen for a whole window can no longer reach the threshold
+        while self._seen:
+            dest, seen = next(iter(self._seen.items()))
+            if now - seen[-1] <= self.learn_window:
+                break
+            del self._seen[dest]
+
+    def _refill(self, dest: Dest, route: _Route, now: float):
+        # Drop connections that died or aged out while idle
+        live = deque()
+        for entry in route.idle:
+            if self._alive(entry[0], entry[1], entry[2], now):
+                live.append(entry)
+            else:
+                entry[1].close()
+        route.idle = live
+
+        if route.learned and now - route.last_used > 5 * self.learn_window:
+            # Destination went cold: forget it
+            while route.idle:
+                route.idle.pop()[1].close()
+            if not route.connecting:
+                del self.routes[dest]
+            return
+
+        if now < route.retry_at or self.breakers.state(dest) != breaker.CLOSED:
+            return
+        want = self._target_size(route, now) - len(route.idle) - route.connecting
+        for _ in range(max(0, want)):
+            route.connecting += 1
+            asyncio.create_task(self._fill_one(dest, route))
+
+    async def _fill_one(self, dest: Dest, route: _Route):
+        try:
+            reader, writer = await self._connect(dest, self.fill_connect)
+        except Exception as e:
+            print(f"[pool] refill {dest[0]}:{dest[1]} failed: {e}")
+            route.retry_at = time.monotonic() + REFILL_BACKOFF
+            return
+        finally:
+            route.connecting -= 1
+        if len(route.idle) >= route.max_idle or self.routes.get(dest) is not route:
+            writer.close()
+            return
+        route.idle.append((reader, writer, time.monotonic()))
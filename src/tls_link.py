@@ -0,0 +1,173 @@
+import asyncio
+import errno
+import os
+import socket
+import ssl
+import stat
+import time
+from typing import Dict, Optional, Tuple
+
+import fastopen
+import instrument
+
+# -----------------------
+# TLS for the PPP <-> DCS link
+# -----------------------
+# Mutual TLS with certificates from a private CA (scripts/gen_link_certs.sh).
+# Off unless SOCKS_PROXY_TLS_CERT is set; each side points at its own cert/key:
+#   SOCKS_PROXY_TLS_CA           CA bundle that signed the peer
+#   SOCKS_PROXY_TLS_CERT / _KEY  this side's certificate and key
+#   SOCKS_PROXY_TLS_SERVER_NAME  name the PPP expects in the DCS certificate
+#
+# The per-flow SOCKS5 path opens one TLS connection per captured flow, so the
+# client context resumes the last session it got from the DCS (TLS 1.3 tickets):
+# a resumed handshake skips the certificate exchange and verification. The mux
+# path keeps one TLS connection open and only resumes when it reconnects.
+# Sessions are kept per DCS endpoint: a ticket from one DCS is useless to another.
+#
+# A host that starts with "/" is a Unix socket path (the port is ignored): a
+# co-located DCS or mux server is then reached without the TCP loopback stack.
+
+TLS_CA = os.environ.get("SOCKS_PROXY_TLS_CA", "")
+TLS_CERT = os.environ.get("SOCKS_PROXY_TLS_CERT", "")
+TLS_KEY = os.environ.get("SOCKS_PROXY_TLS_KEY", "")
+TLS_SERVER_NAME = os.environ.get("SOCKS_PROXY_TLS_SERVER_NAME", "dcs")
+
+# Tickets the DCS hands out per full handshake; each resumption consumes one on the client side
+SERVER_TICKETS = 4
+# Unix listening sockets: owner and group may connect
+UNIX_MODE = 0o660
+
+
+def enabled() -> bool:
+    return bool(TLS_CERT)
+
+
+def is_unix(host: str) -> bool:
+    return host.startswith("/")
+
+
+class ResumingContext(ssl.SSLContext):
+    """
+    Client context for one DCS endpoint that offers the last session it saw on every
+    new connection. asyncio has no session argument, so it is injected in wrap_bio,
+    which asyncio calls for each connection it sets up.
+    """
+    session: Optional[ssl.SSLSession] = None
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        if session is None and not server_side:
+            session = self.session
+        return super().wrap_bio(incoming, outgoing, server_side=server_side,
+                                server_hostname=server_hostname, session=session)
+
+
+_server_ctx: Optional[ssl.SSLContext] = None
+_client_ctx: Dict[Tuple[str, int], ResumingContext] = {}
+counters = {"full": 0, "resumed": 0, "failed": 0}
+
+
+def server_context() -> Optional[ssl.SSLContext]:
+    """DCS side: requires a client certificate signed by TLS_CA. None when TLS is off."""
+    global _server_ctx
+    if not enabled():
+        return None
+    if _server_ctx is None:
+        ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ctx.minimum_version = ssl.TLSVersion.TLSv1_2
+        ctx.load_cert_chain(TLS_CERT, TLS_KEY)
+        ctx.load_verify_locations(TLS_CA)
+        ctx.verify_mode = ssl.CERT_REQUIRED
+        ctx.num_tickets = SERVER_TICKETS
+        _server_ctx = ctx
+    return _server_ctx
+
+
+def client_context(host: str = "", port: int = 0) -> Optional[ResumingContext]:
+    """PPP side: verifies the DCS against TLS_CA and presents our certificate. None when TLS is off."""
+    if not enabled():
+        return None
+    ctx = _client_ctx.get((host, port))
+    if ctx is None:
+        ctx = ResumingContext(ssl.PROTOCOL_TLS_CLIENT)
+        ctx.minimum_version = ssl.TLSVersion.TLSv1_2
+        ctx.load_verify_locations(TLS_CA)
+        ctx.load_cert_chain(TLS_CERT, TLS_KEY)
+        _client_ctx[(host, port)] = ctx
+    return ctx
+
+
+async def open_connection(host: str, port: int, prefix: str = "link") -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    """asyncio.open_connection with link TLS when enabled; records handshake time per kind."""
+    ctx = client_context(host, port)
+    # With TCP Fast Open the first write (greeting or ClientHello) rides in the SYN
+    sock = await fastopen.connect(host, port) if fastopen.ENABLED and not is_unix(host) else None
+    if ctx is None:
+        if is_unix(host):
+            return await asyncio.open_unix_connection(host)
+        if sock is not None:
+            return await asyncio.open_connection(sock=sock)
+        return await asyncio.open_connection(host, port)
+    t0 = time.perf_counter()
+    try:
+        if is_unix(host):
+            reader, writer = await asyncio.open_unix_connection(host, ssl=ctx, server_hostname=TLS_SERVER_NAME)
+        elif sock is not None:
+            reader, writer = await asyncio.open_connection(sock=sock, ssl=ctx, server_hostname=TLS_SERVER_NAME)
+        else:
+            reader, writer = await asyncio.open_connection(host, port, ssl=ctx, server_hostname=TLS_SERVER_NAME)
+    except Exception:
+        counters["failed"] += 1
+        ctx.session = None  # don't keep offering a session the server rejects
+        raise
+    kind = "resumed" if writer.get_extra_info("ssl_object").session_reused else "full"
+    counters[kind] += 1
+    if instrument.ENABLED:
+        instrument.histogram(prefix, f"tls_{kind}").record(int((time.perf_counter() - t0) * 1e6))
+    return reader, writer
+
+
+async def start_unix_server(handler, path: str, ssl_ctx: Optional[ssl.SSLContext] = None) -> asyncio.AbstractServer:
+    """
+    Listen on a Unix socket, replacing a stale socket file left by an earlier run.
+    A socket file that still accepts connections belongs to a live instance: OSError.
+    """
+    if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            os.unlink(path)  # nobody listening: stale
+        else:
+            raise OSError(errno.EADDRINUSE, f"{path} is in use by a running instance")
+        finally:
+            probe.close()
+    server = await asyncio.start_unix_server(handler, path, ssl=ssl_ctx)
+    os.chmod(path, UNIX_MODE)
+    return server
+
+
+def close_unix_server(server: Optional[asyncio.AbstractServer], path: str):
+    """Stop a start_unix_server() listener and remove its socket file."""
+    if server is None:
+        return
+    server.close()
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def remember(writer: asyncio.StreamWriter):
+    """
+    Keep this connection's session for the next connect. Call after the first reply
+    from the server: TLS 1.3 tickets arrive after the handshake, with the first data.
+    """
+    sslobj = writer.get_extra_info("ssl_object")
+    if (sslobj is not None and isinstance(sslobj.context, ResumingContext)
+            and sslobj.session is not None and sslobj.session.has_ticket):
+        sslobj.context.session = sslobj.session
+
+
+def stats() -> dict:
+    return dict(counters, cached_sessions=sum(1 for c in _client_ctx.values() if c.session is not None))
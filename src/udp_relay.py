@@ -0,0 +1,207 @@
+import asyncio
+import socket
+import struct
+import time
+from typing import Dict, Optional, Tuple
+
+import socks5_commands as sc
+
+# Relay socket buffers; bursts of telemetry/video datagrams need more than the default
+UDP_RCVBUF = 4 * 1024 * 1024
+UDP_SNDBUF = 4 * 1024 * 1024
+# A remote may answer the client only while the client talked to it recently
+NAT_ENTRY_TTL = 30.0
+# Association is torn down after this long without any datagram
+ASSOC_IDLE_TIMEOUT = 120.0
+
+_PORT = struct.Struct("!H")
+
+
+def parse_udp_header(data) -> Tuple[int, Optional[str], int, int]:
+    """
+    Parse the SOCKS5 UDP request header without copying the payload.
+    Returns (atyp, host, port, payload_offset); host is None for unsupported/fragmented datagrams.
+      RSV(2) FRAG(1) ATYP(1) DST.ADDR DST.PORT(2) DATA
+    """
+    if len(data) < 10 or data[2] != 0:
+        return 0, None, 0, 0  # short, or fragmented (FRAG != 0 is not supported)
+    atyp = data[3]
+    if atyp == sc.ATYP_IPV4:
+        host = socket.inet_ntop(socket.AF_INET, data[4:8])
+        off = 8
+    elif atyp == sc.ATYP_IPV6:
+        if len(data) < 22:
+            return atyp, None, 0, 0
+        host = socket.inet_ntop(socket.AF_INET6, data[4:20])
+        off = 20
+    elif atyp == sc.ATYP_DOMAIN:
+        ln = data[4]
+        off = 5 + ln
+        if len(data) < off + 2:
+            return atyp, None, 0, 0
+        host = bytes(data[5:off]).decode("utf-8", errors="replace")
+    else:
+        return atyp, None, 0, 0
+    return atyp, host, _PORT.unpack_from(data, off)[0], off + 2
+
+
+def pack_udp_header(host: str, port: int) -> bytes:
+    try:
+        return b"\x00\x00\x00" + bytes((sc.ATYP_IPV4,)) + socket.inet_pton(socket.AF_INET, host) + _PORT.pack(port)
+    except OSError:
+        return b"\x00\x00\x00" + bytes((sc.ATYP_IPV6,)) + socket.inet_pton(socket.AF_INET6, host) + _PORT.pack(port)
+
+
+class UdpAssociation(asyncio.DatagramProtocol):
+    """
+    One UDP ASSOCIATE: a single relay socket serves both the client and the remotes.
+
+    Client datagrams are unwrapped and sent to their destination, which opens a NAT
+    entry for that remote. Remote datagrams are only relayed back while their entry
+    is fresh, prefixed with a pre-built reply header via sendmsg (no concatenation)
+    whenever the transport has nothing queued; otherwise they queue behind it.
+    """
+    def __init__(self, client_ip: str, client_port: int = 0):
+        self.client_ip = client_ip
+        self.client_addr: Optional[Tuple[str, int]] = (client_ip, client_port) if client_port else None
+        self.transport: Optional[asyncio.DatagramTransport] = None
+        self.sock: Optional[socket.socket] = None
+        # remote (ip, port) -> (expires_at, reply_header)
+        self.nat: Dict[Tuple[str, int], Tuple[float, bytes]] = {}
+        self.dns: Dict[str, str] = {}
+        self.last_activity = time.monotonic()
+        self.closed = asyncio.Event()
+        self.rx_client = self.tx_remote = self.rx_remote = self.tx_client = 0
+        self.dropped = 0
+
+    @property
+    def sockname(self) -> Tuple[str, int]:
+        return self.sock.getsockname()[:2]
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.closed.set()
+
+    def datagram_received(self, data: bytes, addr):
+        now = time.monotonic()
+        self.last_activity = now
+        addr = addr[:2]
+        if addr[0] == self.client_ip and (self.client_addr is None or addr == self.client_addr):
+            if self.client_addr is None:
+                self.client_addr = addr  # lock onto the first client port we see
+            self._from_client(memoryview(data), now)
+            return
+
+        entry = self.nat.get(addr)
+        if entry is None or entry[0] < now:
+            self.dropped += 1
+            return
+        self.rx_remote += 1
+        if self.transport.get_write_buffer_size():
+            # Earlier datagrams are still queued in the transport: queue behind them, in order
+            self.transport.sendto(entry[1] + data, self.client_addr)
+            self.tx_client += 1
+            return
+        try:
+            self.sock.sendmsg((entry[1], data), (), 0, self.client_addr)
+            self.tx_client += 1
+        except (BlockingIOError, InterruptedError):
+            # Kernel buffer full: fall back to the transport's own queue
+            self.transport.sendto(entry[1] + data, self.client_addr)
+            self.tx_client += 1
+        except OSError:
+            self.dropped += 1
+
+    def _from_client(self, view: memoryview, now: float):
+        self.rx_client += 1
+        atyp, host, port, off = parse_udp_header(view)
+        if host is None:
+            self.dropped += 1
+            return
+        if atyp == sc.ATYP_DOMAIN:
+            ip = self.dns.get(host)
+            if ip is None:
+                asyncio.ensure_future(self._resolve_and_send(host, port, bytes(view[off:])))
+                return
+            host = ip
+        self._send_remote(host, port, view[off:], now)
+
+    def _send_remote(self, ip: str, port: int, payload, now: float):
+        key = (ip, port)
+        entry = self.nat.get(key)
+        if entry is None:
+            try:
+                hdr = pack_udp_header(ip, port)
+            except OSError:
+                self.dropped += 1
+                return
+        else:
+            hdr = entry[1]
+        self.nat[key] = (now + NAT_ENTRY_TTL, hdr)
+        try:
+            self.transport.sendto(payload, key)
+            self.tx_remote += 1
+        except Exception:
+            self.dropped += 1
+
+    async def _resolve_and_send(self, host: str, port: int, payload: bytes):
+        loop = asyncio.get_running_loop()
+        try:
+            infos = await loop.getaddrinfo(host, port, family=self.sock.family, type=socket.SOCK_DGRAM)
+        except OSError:
+            self.dropped += 1
+            return
+        ip = infos[0][4][0]
+        self.dns[host] = ip
+        self._send_remote(ip, port, payload, time.monotonic())
+
+    def expire(self, now: float):
+        stale = [k for k, (exp, _) in self.nat.items() if exp < now]
+        for k in stale:
+            del self.nat[k]
+
+    def stats(self) -> dict:
+        return {"rx_client": self.rx_client, "tx_remote": self.tx_remote, "rx_remote": self.rx_remote,
+                "tx_client": self.tx_client, "dropped": self.dropped, "nat": len(self.nat)}
+
+    async def serve(self, control_reader: asyncio.StreamReader):
+        """Keep the association alive until the TCP control connection closes or it idles out."""
+        async def control_closed():
+            try:
+                while await control_reader.read(4096):
+                    pass
+            except Exception:
+                pass
+
+        watcher = asyncio.ensure_future(control_closed())
+        try:
+            while not watcher.done() and not self.closed.is_set():
+                await asyncio.wait({watcher}, timeout=NAT_ENTRY_TTL / 2)
+                now = time.monotonic()
+                self.expire(now)
+                if now - self.last_activity > ASSOC_IDLE_TIMEOUT:
+                    break
+        finally:
+            watcher.cancel()
+            self.transport.close()
+
+
+async def open_association(bind_host: str, client_ip: str, client_port: int = 0,
+                           rcvbuf: int = UDP_RCVBUF, sndbuf: int = UDP_SNDBUF) -> UdpAssociation:
+    """Bind a relay socket next to the control connection and start relaying for client_ip."""
+    family = socket.AF_INET6 if ":" in bind_host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+    except OSError:
+        pass
+    sock.bind((bind_host, 0))
+    sock.setblocking(False)
+    loop = asyncio.get_running_loop()
+    assoc = UdpAssociation(client_ip, client_port)
+    assoc.sock = sock
+    await loop.create_datagram_endpoint(lambda: assoc, sock=sock)
+    return assoc